@@ -2,7 +2,7 @@ from mappers.synthea_mapper import SyntheaETLPipeline
 from mappers.custom_mapper import CustomETLPipeline
 from mappers.main_mapper import BaseETLPipeline
 from scripts.loaders.connector import ConnectToDatabase
-from scripts.csv_gen.main import CSVGen
+from scripts.csv_gen.main import CSVGen, EXPORT_FORMAT, EXPORT_MODE
 from scripts.usagi.main import MapCodeGen
 import ast
 
@@ -20,6 +20,15 @@ def main():
     
     etl.run()
 
+# load the transformed data spilled to SPILL_DIR by an earlier run.
+def replay():
+    mapper_class = os.getenv("MAPPER_CLASS")
+    if mapper_class:
+        etl = SyntheaETLPipeline()
+    else:
+        etl = CustomETLPipeline()
+    etl.replay(etl.etl_mapping, etl.files_to_map)
+
 def generate_csv():
     # tables we want to generate csv files from
     table_names=os.getenv("TABLE_NAMES")
@@ -35,7 +44,11 @@ def generate_csv():
     # creating connection to the database
     db_conn = BaseETLPipeline()
     # creating the CSVGen object
-    csv_gen = CSVGen(db_conn.db_connector._conn, table_names, csv_results, schema)
+    # tables are streamed over a native connection unless CSV_STREAMING is disabled;
+    # the Parquet and Arrow exports and the incremental exports always need it.
+    streaming = os.getenv("CSV_STREAMING", "true").lower() in ("1", "true", "yes") or EXPORT_FORMAT != "csv" or EXPORT_MODE == "incremental"
+    native_connect = db_conn.db_connector.open_native_connection if streaming else None
+    csv_gen = CSVGen(db_conn.db_connector._conn, table_names, csv_results, schema, native_connect=native_connect)
     csv_gen.generate_csv()
 
 # this part create the ddl scripts.
@@ -80,7 +93,8 @@ def generate_mapping():
         vocab_schema=vocab_schema,
         file_name=file_name)
     # generator.run()    
-    get_data = generator.save_usagi(file_name="usagi_result.csv")
+    # append mode diffs against source_to_concept_map here, upsert mode lets the database merge.
+    get_data = generator.usagi_rows(file_name="usagi_result.csv")
     generator.push_usagi(
         connector=loader.db_connector, 
         data=get_data,
@@ -90,9 +104,31 @@ def generate_mapping():
 
 
 
+# apply the pushed Usagi mappings to the rows that are still unmapped.
+def apply_mapping():
+    table_names = os.getenv("NULL_CONCEPT_TABLES")
+    if table_names:
+        table_names = ast.literal_eval(table_names)
+    else:
+        table_names = []
+
+    loader = BaseETLPipeline()
+    schema = os.getenv("DB_SCHEMA")
+    vocab_schema = os.getenv("VOCAB_SCHEMA") or schema
+    generator = MapCodeGen(
+        db_conn=loader.db_connector._conn,
+        table_names=table_names,
+        save_dir=os.getenv("USAGI_RESULT"),
+        schema=schema,
+        vocab_schema=vocab_schema)
+    generator.apply_usagi()
+
+
 if __name__ == "__main__":
     # main()
+    # replay()
     generate_mapping()
+    # apply_mapping()
     # generate_csv()
     # generate_ddl()
     # load_vocab()
@@ -0,0 +1,61 @@
+import logging
+from typing import Optional
+import pandas as pd
+from scripts.loaders.load_obser_period import LoadObservationPeriod
+from scripts.loaders.load_condition import LoadCondition
+from scripts.loaders.load_drug import LoadDrug
+
+# derived table -> the base tables it is derived from and the loader method that rebuilds it.
+# drug_era also rebuilds dose_era from the same drug_exposure scan.
+DERIVED_TABLES = {
+    "observation_period": {
+        "base": ("visit_occurrence", "observation_period"),
+        "loader": LoadObservationPeriod,
+        "table": "observation_period",
+        "method": "recompute_periods",
+    },
+    "condition_era": {
+        "base": ("condition_occurrence",),
+        "loader": LoadCondition,
+        "table": "condition_occurrence",
+        "method": "load_era_data",
+    },
+    "drug_era": {
+        "base": ("drug_exposure",),
+        "loader": LoadDrug,
+        "table": "drug_exposure",
+        "method": "load_era_data",
+    },
+}
+
+
+def has_derived_tables(table: str) -> bool:
+    """Check if a base table feeds any derived table."""
+    return any(table in spec["base"] for spec in DERIVED_TABLES.values())
+
+
+def changed_derived_tables(changed_rows: dict) -> list:
+    """Get the derived tables whose base tables received rows in this run."""
+    return [
+        name for name, spec in DERIVED_TABLES.items()
+        if any(changed_rows.get(base, 0) for base in spec["base"])
+    ]
+
+
+def build_derived(connector, name: str, affected_persons: Optional[set] = None):
+    """Rebuild one derived table with its loader."""
+    spec = DERIVED_TABLES[name]
+    loader = spec["loader"](connector, pd.DataFrame(), spec["table"], affected_persons=affected_persons)
+    getattr(loader, spec["method"])()
+
+
+def run_derived(name: str, affected_persons: Optional[set] = None):
+    """
+    Rebuild one derived table in a worker process, with its own database connection.
+    """
+    from mappers.main_mapper import BaseETLPipeline
+
+    pipeline = BaseETLPipeline()
+    logging.info(f"Building {name} in a worker process.")
+    build_derived(pipeline.db_connector, name, affected_persons)
+    return name
@@ -1,5 +1,10 @@
 import os
+import logging
 import time
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 from dotenv import load_dotenv
 import sys
@@ -8,6 +13,11 @@ import sys
 # sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
 from scripts.loaders.connector import ConnectToDatabase
+from scripts.loaders.query_utils import QueryUtils
+from scripts.loaders.run_manifest import RunManifest
+from scripts.loaders.parquet_spill import ParquetSpill
+from mappers.sharding import GLOBAL_TABLES, has_shard_key, partition_file, run_shard
+from mappers.derived import DERIVED_TABLES, build_derived, changed_derived_tables, has_derived_tables, run_derived
 
 class BaseETLPipeline:
     def __init__(self):
@@ -24,6 +34,29 @@ class BaseETLPipeline:
             "vocab_schema": os.getenv("VOCAB_SCHEMA") or os.getenv("DB_SCHEMA"),
         }
         self.file_path = os.getenv("FILE_PATH")
+        # optional run manifest used to skip finished tables and resume failed runs.
+        manifest_path = os.getenv("RUN_MANIFEST")
+        # incremental runs only read rows appended since the last run; the watermarks live in the manifest.
+        self.incremental = os.getenv("INCREMENTAL", "false").lower() in ("1", "true", "yes")
+        if self.incremental and not manifest_path:
+            manifest_path = "run_manifest.json"
+        self.manifest = RunManifest(manifest_path) if manifest_path else None
+        # person_ids touched by the current incremental run, shared with the loaders.
+        self.affected_persons = set() if self.incremental else None
+        # number of person-hash shards processed in parallel worker processes.
+        self.shards = int(os.getenv("SHARDS", "1"))
+        self.shard_dir = os.getenv("SHARD_DIR")
+        # optional Parquet copy of the transformed data, replayable with replay().
+        spill_dir = os.getenv("SPILL_DIR")
+        self.spill = ParquetSpill(spill_dir) if spill_dir else None
+        # only transform and spill, the load is done later by replay().
+        self.spill_only = self.spill is not None and os.getenv("SPILL_ONLY", "false").lower() in ("1", "true", "yes")
+        # rows loaded per base table, used to skip derived tables whose base did not change.
+        self.changed_rows = {}
+        # base tables an earlier, interrupted run loaded without building their derived tables.
+        self.resumed_derived = set(self.manifest.derived_pending()) if self.manifest is not None else set()
+        # worker processes used to build the derived tables (eras, observation periods).
+        self.post_load_workers = int(os.getenv("POST_LOAD_WORKERS", "1"))
         self.db_connector = ConnectToDatabase(**self.db_config)
     
     def process_file(self, file, file_name, etl_mapping, custom: bool = False):
@@ -34,21 +67,201 @@ class BaseETLPipeline:
 
             
             file_path = os.path.join(self.file_path, file_name[0])
+            fingerprint = None
+            if self.manifest is not None:
+                fingerprint = self.manifest.fingerprint(file_path)
+                if self.manifest.is_complete(get_file, fingerprint):
+                    print(f"Skipping {file}, already loaded from an unchanged source file.")
+                    return
+                self.manifest.start_table(get_file, fingerprint)
             print(f"Loading {file} data...")
+            watermark = self.manifest.get_watermark(get_file) if self.incremental else None
             if custom:
-                etl_instance = etl_class(file_path=file_path, table_name=file, fields_map=fields)
+                etl_instance = etl_class(file_path=file_path, table_name=file, fields_map=fields, watermark=watermark)
             else:
-                etl_instance = etl_class(file_path=file_path, table_name=file, fields_map=fields)
+                etl_instance = etl_class(file_path=file_path, table_name=file, fields_map=fields, watermark=watermark)
             etl_instance.run_mapping(fields=fields)
-            load_result = loader_class(self.db_connector, etl_instance.get_omopped_data(), file)
-            load_result.load_data()
+            omop_data = etl_instance.get_omopped_data()
+            if self.spill is not None:
+                self.spill.write(get_file, file, omop_data, fingerprint=fingerprint, watermark=etl_instance.get_watermark())
+            if self.incremental and omop_data.empty:
+                print(f"No new {file} rows since the last run.")
+            elif self.spill_only:
+                print(f"Spilled {file} data, load it with replay.")
+            else:
+                load_result = loader_class(
+                    self.db_connector,
+                    omop_data,
+                    file,
+                    manifest=self.manifest,
+                    manifest_key=get_file,
+                    affected_persons=self.affected_persons,
+                )
+                load_result.load_data()
+                self.changed_rows[file] = self.changed_rows.get(file, 0) + load_result.rows_loaded
+                # flagged before the entry is finished, so a crash before the post-load stage
+                # still builds the derived tables on the next run.
+                if self.manifest is not None and load_result.rows_loaded and has_derived_tables(file):
+                    self.manifest.mark_derived_pending(file)
+            # spilled entries are completed by replay(), once their rows are loaded.
+            if self.manifest is not None and not self.spill_only:
+                self.manifest.finish_table(get_file, watermark=etl_instance.get_watermark())
             time.sleep(1)
             print("\n\n")
         else:
             print(f"Skipping {file}, no ETL mapping found.")
 
+    def run_post_load(self):
+        """
+        Build the derived tables (observation_period, condition_era, drug_era and dose_era)
+        once, after all base tables are loaded. Derived tables whose base tables received
+        no rows are skipped; with POST_LOAD_WORKERS > 1 they are built in parallel processes.
+        Base tables flagged as pending in the run manifest by an interrupted run are built
+        too, for every person since the persons of that run are not known any more.
+        """
+        changed = {table: rows for table, rows in self.changed_rows.items() if rows}
+        pending = self.manifest.derived_pending() if self.manifest is not None else []
+        changed.update({table: 1 for table in pending if table not in changed})
+        names = changed_derived_tables(changed)
+        self.changed_rows = {}
+        if not names:
+            print("No base rows changed, skipping derived tables.")
+            return
+        persons = {
+            name: None if self.resumed_derived.intersection(DERIVED_TABLES[name]["base"]) else self.affected_persons
+            for name in names
+        }
+        built, failed = [], []
+        workers = min(self.post_load_workers, len(names))
+        if workers <= 1:
+            for name in names:
+                print(f"Building {name}...")
+                try:
+                    build_derived(self.db_connector, name, persons[name])
+                    built.append(name)
+                except Exception as e:
+                    logging.error(f"Failed to build {name}: {e}")
+                    failed.append(name)
+        else:
+            # spawn keeps the embedded R session of this process out of the workers.
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                futures = {executor.submit(run_derived, name, persons[name]): name for name in names}
+                for future in as_completed(futures):
+                    try:
+                        print(f"Built {future.result()}.")
+                        built.append(futures[future])
+                    except Exception as e:
+                        logging.error(f"Failed to build {futures[future]}: {e}")
+                        failed.append(futures[future])
+        if self.manifest is not None:
+            # a base table stays pending while any of its derived tables failed.
+            kept = {base for name in failed for base in DERIVED_TABLES[name]["base"]}
+            done = {base for name in built for base in DERIVED_TABLES[name]["base"]} - kept
+            self.manifest.clear_derived_pending(done)
+            self.resumed_derived -= done
+
+    def replay(self, etl_mapping, files_to_map):
+        """
+        Load the transformed data spilled by an earlier run, without running any ETL class.
+        Entries are replayed in the order of files_to_map so dimension tables load first.
+        """
+        if self.spill is None:
+            print("SPILL_DIR is not set, nothing to replay.")
+            return
+        print("Connecting to database...")
+        for get_file in files_to_map:
+            if get_file not in etl_mapping:
+                continue
+            # the entry may be spilled by this process, by the shards of a sharded run, or both.
+            spills = [spill for spill in [self.spill] + self.spill.shards() if spill.has(get_file)]
+            if not spills:
+                print(f"Skipping {get_file}, no complete spill found.")
+                continue
+            _, loader_class, _ = etl_mapping[get_file]
+            records = [spill.describe(get_file) for spill in spills]
+            if self.manifest is not None:
+                self.manifest.start_table(get_file, records[0].get("fingerprint"))
+            for spill, record in zip(spills, records):
+                print(f"Replaying {record['rows']} {record['table']} rows from {spill.entry_dir(get_file)}...")
+                omop_data = spill.read(get_file)
+                load_result = loader_class(
+                    self.db_connector,
+                    omop_data,
+                    record["table"],
+                    manifest=self.manifest,
+                    manifest_key=get_file,
+                    affected_persons=self.affected_persons,
+                )
+                load_result.load_data()
+                self.changed_rows[record["table"]] = self.changed_rows.get(record["table"], 0) + load_result.rows_loaded
+                if self.manifest is not None and load_result.rows_loaded and has_derived_tables(record["table"]):
+                    self.manifest.mark_derived_pending(record["table"])
+            # the watermark of a spill-only run only moves once its rows are in the database.
+            if self.manifest is not None:
+                self.manifest.finish_table(get_file, watermark=records[0].get("watermark"))
+            time.sleep(1)
+            print("\n\n")
+        self.run_post_load()
+        print("Replay Completed.")
+
+    def run_sharded(self, etl_mapping, files_to_map, custom: bool = False):
+        """
+        Run the pipeline with every source file partitioned by a hash of the patient identifier.
+        Person independent tables are loaded first in this process, then each shard runs
+        the remaining tables in its own worker process and database connection.
+        """
+        if self.incremental:
+            print("Incremental mode is not supported with shards; running a full sharded load.")
+        global_files, shard_files = {}, {}
+        for file, file_name in files_to_map.items():
+            table = file.rsplit("_", 1)[0]
+            source = os.path.join(self.file_path, file_name[0])
+            if table in GLOBAL_TABLES or not has_shard_key(source):
+                global_files[file] = file_name
+            else:
+                shard_files[file] = file_name
+
+        for file, file_name in global_files.items():
+            self.process_file(file, file_name, etl_mapping, custom)
+
+        # spills of an earlier sharded run would otherwise be replayed next to this one.
+        if self.spill is not None:
+            self.spill.clear_shards()
+        root = self.shard_dir or tempfile.mkdtemp(prefix="etl_shards_")
+        shard_dirs = [os.path.join(root, f"shard_{index:03d}") for index in range(self.shards)]
+        for shard_dir in shard_dirs:
+            os.makedirs(shard_dir, exist_ok=True)
+        try:
+            for source in sorted({file_name[0] for file_name in shard_files.values()}):
+                partition_file(os.path.join(self.file_path, source), shard_dirs)
+
+            workers = min(self.shards, os.cpu_count() or 1)
+            # spawn keeps the embedded R session of this process out of the workers.
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                futures = [
+                    executor.submit(run_shard, index, shard_dir, etl_mapping, shard_files, custom)
+                    for index, shard_dir in enumerate(shard_dirs)
+                ]
+                for future in as_completed(futures):
+                    shard_index, persons = future.result()
+                    print(f"Shard {shard_index} completed ({persons} persons loaded).")
+        finally:
+            if not self.shard_dir:
+                shutil.rmtree(root, ignore_errors=True)
+
     def run(self, etl_mapping, files_to_map, custom: bool = False):
         print("Connecting to database...")
+        if self.shards > 1:
+            self.run_sharded(etl_mapping, files_to_map, custom)
+            print("ETL Pipeline Execution Completed.")
+            return
         for file, file_name in files_to_map.items():
             self.process_file(file, file_name, etl_mapping, custom)
+        self.run_post_load()
+        if self.incremental:
+            print(f"{len(self.affected_persons)} persons affected by this run.")
+        if QueryUtils.stcm_hits or QueryUtils.stcm_misses:
+            print(QueryUtils.stcm_summary())
         print("ETL Pipeline Execution Completed.")
@@ -0,0 +1,78 @@
+import os
+import logging
+import pandas as pd
+from tqdm import tqdm
+
+# column holding the patient identifier in each source file (defaults to "patient").
+SHARD_KEYS = {"patients.csv": "id"}
+# tables that do not depend on a person and are loaded once, before the shards run.
+GLOBAL_TABLES = ("location", "provider", "care_site")
+
+
+def shard_key(file_name: str) -> str:
+    """Get the patient identifier column of a source file."""
+    return SHARD_KEYS.get(os.path.basename(file_name).lower(), "patient")
+
+
+def has_shard_key(file_path: str) -> bool:
+    """Check if a source file carries the patient identifier column."""
+    header = pd.read_csv(file_path, nrows=0).columns.str.lower()
+    return shard_key(file_path) in header
+
+
+def shard_of(values: pd.Series, shards: int):
+    """Assign every value to a shard with a stable (process independent) hash."""
+    hashed = pd.util.hash_pandas_object(values.astype(str), index=False).to_numpy()
+    return hashed % shards
+
+
+def partition_file(file_path: str, shard_dirs: list, chunk_size: int = 100000):
+    """
+    Split a source file into one file per shard using a hash of the patient identifier,
+    so every row of a person lands in the same shard whatever file it comes from.
+    """
+    file_name = os.path.basename(file_path)
+    key = shard_key(file_name)
+    shards = len(shard_dirs)
+    written = [False] * shards
+    chunks = pd.read_csv(file_path, chunksize=chunk_size, low_memory=False, dtype=str)
+    for chunk in tqdm(chunks, desc=f"Partitioning {file_name} into {shards} shards..."):
+        key_column = next(column for column in chunk.columns if column.lower() == key)
+        assignment = shard_of(chunk[key_column], shards)
+        for index, shard_dir in enumerate(shard_dirs):
+            part = chunk[assignment == index]
+            if part.empty and written[index]:
+                continue
+            part.to_csv(
+                os.path.join(shard_dir, file_name),
+                mode="a" if written[index] else "w",
+                header=not written[index],
+                index=False,
+            )
+            written[index] = True
+
+
+def run_shard(shard_index: int, shard_dir: str, etl_mapping: dict, files_to_map: dict, custom: bool = False):
+    """
+    Run the person dependent part of the pipeline on one shard.
+    Runs in its own worker process, with its own database connection.
+    """
+    from mappers.main_mapper import BaseETLPipeline
+
+    pipeline = BaseETLPipeline()
+    pipeline.file_path = shard_dir
+    # shard files are rebuilt on every run, so they are neither checkpointed nor watermarked.
+    pipeline.manifest = None
+    pipeline.incremental = False
+    # era builders of a shard only rebuild the persons of that shard.
+    pipeline.affected_persons = set()
+    # every shard spills to its own directory; replay reads all of them.
+    if pipeline.spill is not None:
+        pipeline.spill = pipeline.spill.shard(shard_index)
+    logging.info(f"Shard {shard_index}: processing {len(files_to_map)} tables from {shard_dir}")
+    for file, file_name in files_to_map.items():
+        pipeline.process_file(file, file_name, etl_mapping, custom)
+    # shards already run in parallel, so their derived tables are built in process.
+    pipeline.post_load_workers = 1
+    pipeline.run_post_load()
+    return shard_index, len(pipeline.affected_persons)
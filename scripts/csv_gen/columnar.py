@@ -0,0 +1,185 @@
+import os
+import shutil
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# information_schema data type -> Arrow type of the exported column; anything else is exported as text.
+ARROW_TYPES = {
+    "smallint": pa.int16(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "real": pa.float32(),
+    "double precision": pa.float64(),
+    "numeric": pa.float64(),
+    "boolean": pa.bool_(),
+    "date": pa.date32(),
+    "timestamp without time zone": pa.timestamp("us"),
+    "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+}
+
+# output format -> file extension.
+EXTENSIONS = {"parquet": "parquet", "arrow": "arrow"}
+
+
+def arrow_schema(columns) -> pa.Schema:
+    """Build the Arrow schema of (column name, information_schema data type) pairs."""
+    return pa.schema([(name, ARROW_TYPES.get(data_type, pa.string())) for name, data_type in columns])
+
+
+def select_expression(name: str, data_type: str) -> str:
+    """Select a column so the driver returns values Arrow can take as they are."""
+    if data_type == "numeric":
+        return f'"{name}"::double precision AS "{name}"'
+    if data_type not in ARROW_TYPES:
+        return f'"{name}"::text AS "{name}"'
+    return f'"{name}"'
+
+
+def rows_to_batch(rows: list, schema: pa.Schema) -> pa.RecordBatch:
+    """Convert fetched rows (tuples in schema order) into a record batch."""
+    columns = list(zip(*rows)) if rows else [[] for _ in schema]
+    return pa.record_batch(
+        [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+class PartitionedWriter:
+    """
+    Write streamed record batches of one table to Parquet or Arrow IPC files.
+
+    Without a partition the table goes to ``<table>.<ext>``. Partitioned by year or by
+    person bucket, every partition gets its own file in a hive style directory
+    ``<table>/<key>=<value>/part-0.<ext>``. Parquet rows are buffered per partition until
+    a full row group can be written, so memory is bounded by one row group per open
+    partition. Output is written under a temporary name and moved in place on close.
+    """
+
+    def __init__(self, save_dir: str, table: str, schema: pa.Schema, export_format: str = "parquet",
+                 partition_by: str = None, partition_column: str = None, person_buckets: int = 16,
+                 row_group_rows: int = 500000, compression: str = "zstd"):
+        """
+        Initialise the PartitionedWriter class.
+        Args:
+            save_dir: str - Directory of the exported files.
+            table: str - The exported table.
+            schema: pa.Schema - Schema of the batches.
+            export_format: str - "parquet" or "arrow" (Arrow IPC file).
+            partition_by: str - None, "year" or "person_bucket".
+            partition_column: str - Date column for "year", person column for "person_bucket".
+            person_buckets: int - Number of person_id buckets.
+            row_group_rows: int - Rows per Parquet row group.
+            compression: str - Parquet/Arrow IPC compression codec.
+        """
+        if export_format not in EXTENSIONS:
+            raise ValueError(f"Unsupported export format: {export_format}")
+        self._schema = schema
+        self._format = export_format
+        self._partition_by = partition_by
+        self._partition_column = partition_column
+        self._person_buckets = person_buckets
+        self._row_group_rows = row_group_rows
+        self._compression = compression
+        extension = EXTENSIONS[export_format]
+        if partition_by:
+            self._final_path = os.path.join(save_dir, table)
+        else:
+            self._final_path = os.path.join(save_dir, f"{table}.{extension}")
+        self._tmp_path = f"{self._final_path}.tmp"
+        self._extension = extension
+        self._writers = {}
+        self._buffers = {}
+        self.rows_written = 0
+        if os.path.isdir(self._tmp_path):
+            shutil.rmtree(self._tmp_path)
+        if partition_by:
+            os.makedirs(self._tmp_path, exist_ok=True)
+
+    def partition_keys(self, batch: pa.RecordBatch):
+        """Get the partition value of every row of a batch."""
+        column = batch.column(batch.schema.get_field_index(self._partition_column))
+        if self._partition_by == "year":
+            return pc.year(column)
+        if self._partition_by == "person_bucket":
+            person_ids = pc.cast(column, pa.int64())
+            # integer division truncates, so this is person_id % buckets for the (positive) ids.
+            return pc.subtract(person_ids, pc.multiply(pc.divide(person_ids, self._person_buckets), self._person_buckets))
+        raise ValueError(f"Unsupported partition: {self._partition_by}")
+
+    def write(self, batch: pa.RecordBatch):
+        """Write a batch, split by partition."""
+        self.rows_written += batch.num_rows
+        if not self._partition_by:
+            self._write_partition(None, batch)
+            return
+        keys = self.partition_keys(batch)
+        for value in pc.unique(keys).to_pylist():
+            mask = pc.is_null(keys) if value is None else pc.equal(keys, value)
+            self._write_partition(value, batch.filter(mask))
+
+    def _partition_path(self, value) -> str:
+        if value is None and self._partition_by is None:
+            return self._tmp_path
+        key = "year" if self._partition_by == "year" else "person_bucket"
+        label = "null" if value is None else str(value)
+        directory = os.path.join(self._tmp_path, f"{key}={label}")
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"part-0.{self._extension}")
+
+    def _write_partition(self, value, batch: pa.RecordBatch):
+        writer = self._writers.get(value)
+        if writer is None:
+            path = self._partition_path(value)
+            if self._format == "parquet":
+                writer = pq.ParquetWriter(path, self._schema, compression=self._compression)
+            else:
+                writer = pa.ipc.new_file(path, self._schema, options=pa.ipc.IpcWriteOptions(compression=self._compression))
+            self._writers[value] = writer
+            self._buffers[value] = []
+        if self._format == "arrow":
+            writer.write_batch(batch)
+            return
+        buffered = self._buffers[value]
+        buffered.append(batch)
+        if sum(part.num_rows for part in buffered) >= self._row_group_rows:
+            self._flush(value)
+
+    def _flush(self, value, final: bool = False):
+        """Write the buffered rows of a partition as full row groups; on ``final`` write the rest too."""
+        buffered = self._buffers.get(value)
+        if not buffered:
+            return
+        table = pa.Table.from_batches(buffered, schema=self._schema)
+        rows = table.num_rows if final else table.num_rows - table.num_rows % self._row_group_rows
+        if rows:
+            self._writers[value].write_table(table.slice(0, rows), row_group_size=self._row_group_rows)
+        self._buffers[value] = table.slice(rows).to_batches() if rows < table.num_rows else []
+
+    def close(self):
+        """Flush the buffered rows, close the files and move the output in place."""
+        if not self._writers and not self._partition_by:
+            # an empty table still gets a file with its schema.
+            self._write_partition(None, rows_to_batch([], self._schema))
+        for value, writer in self._writers.items():
+            if self._format == "parquet":
+                self._flush(value, final=True)
+            writer.close()
+        if os.path.isdir(self._final_path):
+            shutil.rmtree(self._final_path)
+        os.replace(self._tmp_path, self._final_path)
+        logging.info(f"✅ Saved: {self._final_path} ({self.rows_written} rows)")
+        return self._final_path
+
+    def abort(self):
+        """Close the files and remove the partial output."""
+        for writer in self._writers.values():
+            try:
+                writer.close()
+            except Exception:
+                pass
+        if os.path.isdir(self._tmp_path):
+            shutil.rmtree(self._tmp_path)
+        elif os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
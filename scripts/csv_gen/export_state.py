@@ -0,0 +1,63 @@
+import os
+import json
+import logging
+
+
+class ExportState:
+    """
+    High-water marks of the incremental exports, kept in a JSON file.
+
+    Every exported table remembers the transaction horizon of its last export, so the
+    next run only exports the rows written since. Marks are keyed by ``schema.table``.
+    """
+
+    def __init__(self, path: str, tables: dict = None):
+        """
+        Initialise the ExportState class.
+        Args:
+            path: str - The JSON state file.
+            tables: dict - schema.table -> {"key", "mark", "run_id"} of the previous exports.
+        """
+        self._path = path
+        self._tables = tables or {}
+
+    @classmethod
+    def load(cls, path: str):
+        """Read the state file; a missing or unreadable file starts without marks."""
+        if not os.path.exists(path):
+            return cls(path)
+        try:
+            with open(path) as handle:
+                return cls(path, json.load(handle).get("tables", {}))
+        except Exception as e:
+            logging.error(f"Failed to read the export state {path}, exporting full tables: {e}")
+            return cls(path)
+
+    def mark(self, table: str, key: str):
+        """Get the high-water mark of a table, None when it was not exported with that kind of mark yet."""
+        entry = self._tables.get(table)
+        if entry is None or entry.get("key") != key:
+            return None
+        return entry.get("mark")
+
+    def update(self, table: str, key: str, mark: int, run_id: str):
+        """Set the high-water mark of a table after its export succeeded."""
+        self._tables[table] = {"key": key, "mark": mark, "run_id": run_id}
+
+    def save(self):
+        """Write the state file, replacing the previous one only once fully written."""
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as handle:
+            json.dump({"tables": self._tables}, handle, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._path)
+
+    @staticmethod
+    def write_manifest(save_dir: str, run_id: str, manifest: dict) -> str:
+        """Write the manifest of an export run next to its files."""
+        path = os.path.join(save_dir, f"manifest_{run_id}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as handle:
+            json.dump(manifest, handle, indent=2)
+        os.replace(tmp_path, path)
+        return path
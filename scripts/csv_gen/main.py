@@ -1,21 +1,72 @@
 import os
+import re
+import shutil
 import pandas as pd
 from rpy2.robjects.packages import importr
 import logging
 import pyarrow.feather as feather
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from scripts.csv_gen.columnar import PartitionedWriter, arrow_schema, rows_to_batch, select_expression
+from scripts.csv_gen.export_state import ExportState
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)  # Use DEBUG level for detailed logging
 
+# bytes buffered before they are written to the CSV file when a table is streamed.
+CSV_CHUNK_BYTES = int(os.getenv("CSV_CHUNK_BYTES", str(8 * 1024 * 1024)))
+# "csv", "parquet" (zstd) or "arrow" (Arrow IPC); the columnar formats need a native connection.
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "csv").lower()
+# optional partitioning of the columnar exports: "year" or "person_bucket".
+EXPORT_PARTITION = os.getenv("EXPORT_PARTITION", "").lower() or None
+# date column used by the year partition; defaults to the first date column of each table.
+EXPORT_PARTITION_COLUMN = os.getenv("EXPORT_PARTITION_COLUMN", "").lower() or None
+EXPORT_PERSON_BUCKETS = int(os.getenv("EXPORT_PERSON_BUCKETS", "16"))
+# rows fetched per server-side cursor batch and rows per Parquet row group.
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "100000"))
+PARQUET_ROW_GROUP_ROWS = int(os.getenv("PARQUET_ROW_GROUP_ROWS", "500000"))
+# tables exported concurrently, each worker on its own native connection; 1 exports them in turn.
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "1"))
+# CSV tables estimated above this many rows are split into <table>_id ranges exported concurrently.
+EXPORT_SPLIT_ROWS = int(os.getenv("EXPORT_SPLIT_ROWS", "5000000"))
+# "full" dumps whole tables; "incremental" only exports the rows inserted since the last export.
+EXPORT_MODE = os.getenv("EXPORT_MODE", "full").lower()
+# high-water marks of the incremental exports; defaults to export_state.json in the save directory.
+EXPORT_STATE_FILE = os.getenv("EXPORT_STATE_FILE", "")
+# transaction ids wrap around on this ring in the xmin system column of a row.
+XID_RING = 2 ** 32
+
 
 class CSVGen:
-    def __init__(self, db_conn, table_names: list, save_dir: str, schema: str):
+    def __init__(self, db_conn, table_names: list, save_dir: str, schema: str, native_connect=None,
+                 chunk_bytes: int = CSV_CHUNK_BYTES, export_format: str = EXPORT_FORMAT,
+                 partition_by: str = EXPORT_PARTITION, partition_column: str = EXPORT_PARTITION_COLUMN,
+                 person_buckets: int = EXPORT_PERSON_BUCKETS, batch_rows: int = EXPORT_BATCH_ROWS,
+                 row_group_rows: int = PARQUET_ROW_GROUP_ROWS, workers: int = EXPORT_WORKERS,
+                 split_rows: int = EXPORT_SPLIT_ROWS, mode: str = EXPORT_MODE,
+                 state_file: str = EXPORT_STATE_FILE):
         """
         Initialize the CSVGen class.
 
         :param db_conn: Database connection object
         :param table_names: List of table names to export
         :param save_dir: Directory where CSV files will be saved
+        :param native_connect: Optional callable returning a psycopg connection. When given,
+            every table is streamed with COPY TO STDOUT straight into its CSV file, so memory
+            use does not grow with the table size.
+        :param chunk_bytes: Bytes buffered before they are written to the file when streaming.
+        :param export_format: "csv", "parquet" or "arrow". Parquet and Arrow IPC files are
+            written incrementally from server-side cursor batches of ``batch_rows`` rows.
+        :param partition_by: None, "year" (of ``partition_column`` or the first date column)
+            or "person_bucket" (person_id modulo ``person_buckets``) for the columnar formats.
+        :param row_group_rows: Rows per Parquet row group.
+        :param workers: Tables exported concurrently over their own native connections, all
+            reading one exported snapshot. CSV tables above ``split_rows`` rows are split into
+            ranges of their ``<table>_id`` column, exported concurrently and stitched in order.
+        :param mode: "full" or "incremental". Incremental runs export the rows written by
+            the transactions since the mark kept in ``state_file`` to delta files and list
+            them in a ``manifest_<run id>.json``.
         """
         self._conn = db_conn
         self._db_connector = importr('DatabaseConnector')
@@ -23,6 +74,18 @@ class CSVGen:
         self._table_names = table_names
         self._save_dir = save_dir
         self._schema = schema
+        self._native_connect = native_connect
+        self._chunk_bytes = chunk_bytes
+        self._export_format = export_format.lower()
+        self._partition_by = partition_by
+        self._partition_column = partition_column
+        self._person_buckets = person_buckets
+        self._batch_rows = batch_rows
+        self._row_group_rows = row_group_rows
+        self._workers = max(1, workers)
+        self._split_rows = max(1, split_rows)
+        self._mode = mode.lower()
+        self._state_file = state_file or os.path.join(save_dir, "export_state.json")
         # Ensure the save directory exists
         os.makedirs(self._save_dir, exist_ok=True)
 
@@ -60,12 +123,299 @@ class CSVGen:
 
     def generate_csv(self):
         """Generate CSV files for all tables in the list."""
-        for table in self._table_names:
-            # if empty skip
-            if not table:
+        # if empty skip
+        tables = [table for table in self._table_names if table]
+        if self._mode == "incremental":
+            self._export_incremental(tables)
+            return
+        if self._workers > 1 and self._native_connect is not None:
+            self._export_parallel(tables)
+            return
+        for table in tables:
+            if self._export_format != "csv":
+                self._stream_columnar(table)
+            elif self._native_connect is not None:
+                self._stream_csv(table)
+            else:
+                self._generate_csv(table)
+
+    def _export_incremental(self, tables):
+        """
+        Export the rows written since the previous export. CDM ids are hashed, so they do not
+        grow with the inserts; the mark of a table is instead the transaction horizon of its
+        last export (the xmin of a snapshot: every older transaction has finished). Each run
+        exports the rows whose last writing transaction (their ``xmin``) lies between the
+        previous mark and the current horizon into ``<table>_<run id>`` files. Tables without
+        a usable mark are exported in full. The marks are only moved for tables whose export
+        succeeded, and the run is described in ``manifest_<run id>.json``.
+        """
+        if self._native_connect is None:
+            logging.error("Incremental export needs a native connection, skipping...")
+            return None
+        try:
+            with self._connection() as conn:
+                high = int(conn.execute(
+                    "SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint"
+                ).fetchone()[0])
+        except Exception as e:
+            logging.error(f"Failed to read the transaction horizon, incremental export skipped: {e}")
+            return None
+        run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        state = ExportState.load(self._state_file)
+        export = self._stream_csv if self._export_format == "csv" else self._stream_columnar
+        entries = []
+        for table in tables:
+            low = state.mark(f"{self._schema}.{table}", "xmin")
+            entry = {"table": table, "key": "xmin", "from": low, "until": high,
+                     "mode": "delta" if low is not None else "full", "file": None}
+            if low is not None and not 0 <= high - low < XID_RING // 2:
+                # a restored database or a horizon too far ahead to compare on the xmin ring.
+                logging.warning(f"The mark of {self._schema}.{table} does not fit the current transactions; exporting it in full.")
+                low, entry["from"], entry["mode"] = None, None, "full"
+            if low is not None and high == low:
+                entries.append(entry)
                 continue
-            self._generate_csv(table)
-    
+            path = export(table, where=self._xmin_filter(low, high), name=f"{table}_{run_id}")
+            if path is None:
+                continue
+            entry["file"] = os.path.relpath(path, self._save_dir)
+            entries.append(entry)
+            state.update(f"{self._schema}.{table}", "xmin", high, run_id)
+        manifest = {
+            "run_id": run_id,
+            "schema": self._schema,
+            "format": self._export_format,
+            "tables": entries,
+        }
+        manifest_path = ExportState.write_manifest(self._save_dir, run_id, manifest)
+        state.save()
+        logging.info(f"✅ Saved: {manifest_path} ({sum(1 for entry in entries if entry['file'])} files)")
+        return manifest_path
+
+    @staticmethod
+    def _xmin_filter(low, high):
+        """
+        Filter the rows last written by a transaction in [low, high). The marks are 64-bit
+        transaction ids and ``xmin`` holds their low 32 bits, so the rows are compared by
+        their distance from ``low`` on the wrapping ring. No filter without a mark.
+        """
+        if low is None:
+            return None
+        return f"(xmin::text::bigint - {low % XID_RING} + {XID_RING}) % {XID_RING} < {high - low}"
+
+    @contextmanager
+    def _connection(self, snapshot=None):
+        """Open a native connection, reading the exported ``snapshot`` when one is given."""
+        with self._native_connect() as conn:
+            if snapshot:
+                conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                conn.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+            yield conn
+
+    @staticmethod
+    def _export_snapshot(conn):
+        """Export the snapshot of a repeatable read transaction, so every worker sees the same data."""
+        conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        snapshot = conn.execute("SELECT pg_export_snapshot()").fetchone()[0]
+        if not re.fullmatch(r"[0-9A-Fa-f-]+", snapshot):
+            raise ValueError(f"Unexpected snapshot id: {snapshot}")
+        return snapshot
+
+    def _key_ranges(self, cursor, table_name):
+        """
+        Split a table into half-open ranges of its ``<table>_id`` column, about ``split_rows``
+        rows each by the planner estimate. Returns the key, the ranges and the column names,
+        or None when the table is not split.
+        """
+        key = f"{table_name}_id"
+        columns = self._table_columns(cursor, table_name)
+        if dict(columns).get(key) not in ("integer", "bigint"):
+            return None
+        cursor.execute(
+            "SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE oid = %s::regclass",
+            (f"{self._schema}.{table_name}",),
+        )
+        parts = -(-int(cursor.fetchone()[0]) // self._split_rows)
+        if parts <= 1:
+            return None
+        cursor.execute(f'SELECT MIN("{key}"), MAX("{key}") FROM {self._schema}.{table_name}')
+        low, high = cursor.fetchone()
+        if low is None:
+            return None
+        step = -(-(high - low + 1) // parts)
+        bounds = [(start, min(start + step, high + 1)) for start in range(low, high + 1, step)]
+        return key, bounds, [name for name, _ in columns]
+
+    def _export_parallel(self, tables):
+        """
+        Export the tables on a pool of ``workers`` threads. Split tables are written as one
+        part file per range and appended to the first part in range order once all succeed.
+        """
+        with self._native_connect() as conn:
+            snapshot = self._export_snapshot(conn)
+            splits = {}
+            if self._export_format == "csv":
+                with conn.cursor() as cursor:
+                    for table in tables:
+                        splits[table] = self._key_ranges(cursor, table)
+            export = self._stream_csv if self._export_format == "csv" else self._stream_columnar
+            # the exporting transaction stays open until every worker is done with its snapshot.
+            with ThreadPoolExecutor(max_workers=self._workers) as pool:
+                pending = []
+                for table in tables:
+                    if splits.get(table) is None:
+                        pool.submit(export, table, snapshot)
+                        continue
+                    key, bounds, columns = splits[table]
+                    logging.info(f"Exporting {self._schema}.{table} in {len(bounds)} ranges of {key}.")
+                    parts = [
+                        pool.submit(self._copy_range, table, columns, key, bounds[part], part, snapshot)
+                        for part in range(len(bounds))
+                    ]
+                    pending.append((table, parts))
+                for table, parts in pending:
+                    self._stitch(table, parts)
+
+    def _copy_range(self, table_name, columns, key, bounds, part, snapshot=None):
+        """Export one key range of a table to its part file; only the first part has the header."""
+        start, stop = bounds
+        select = ", ".join(f'"{column}" AS "{column.upper()}"' for column in columns)
+        where = f'"{key}" >= {int(start)} AND "{key}" < {int(stop)}'
+        if part == 0:
+            where = f'({where} OR "{key}" IS NULL)'
+        header = "true" if part == 0 else "false"
+        copy_sql = (f"COPY (SELECT {select} FROM {self._schema}.{table_name} WHERE {where}) "
+                    f"TO STDOUT WITH (FORMAT csv, HEADER {header})")
+        path = os.path.join(self._save_dir, f"{table_name}.csv.part{part}.tmp")
+        with self._connection(snapshot) as conn:
+            self._copy_to_file(conn, copy_sql, path)
+        return path
+
+    def _stitch(self, table_name, parts):
+        """Append the part files of a table to the first one, in range order, and move it in place."""
+        file_path = os.path.join(self._save_dir, f"{table_name}.csv")
+        paths = [os.path.join(self._save_dir, f"{table_name}.csv.part{part}.tmp") for part in range(len(parts))]
+        try:
+            for future in parts:
+                future.result()
+            with open(paths[0], "ab") as handle:
+                for path in paths[1:]:
+                    with open(path, "rb") as part_file:
+                        shutil.copyfileobj(part_file, handle, self._chunk_bytes)
+                    os.remove(path)
+            os.replace(paths[0], file_path)
+            logging.info(f"✅ Saved: {file_path} ({len(parts)} ranges)")
+        except Exception as e:
+            logging.error(f"Failed to export {self._schema}.{table_name}: {e}")
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _table_columns(self, cursor, table_name):
+        """Get the (column name, data type) pairs of a table in column order."""
+        cursor.execute(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position",
+            (self._schema, table_name),
+        )
+        return [(row[0], row[1]) for row in cursor.fetchall()]
+
+    def _partition_for(self, columns):
+        """Get the partition and its column for a table; tables without the column are not partitioned."""
+        names = [name for name, _ in columns]
+        if self._partition_by == "year":
+            dates = [name for name, data_type in columns if data_type.startswith(("date", "timestamp"))]
+            column = self._partition_column if self._partition_column in names else (dates[0] if dates else None)
+            return ("year", column) if column else (None, None)
+        if self._partition_by == "person_bucket" and "person_id" in names:
+            return "person_bucket", "person_id"
+        return None, None
+
+    def _stream_columnar(self, table_name, snapshot=None, where=None, name=None):
+        """
+        Export a table to Parquet or Arrow IPC. Rows are read from a server-side cursor in
+        batches of ``batch_rows`` and written as they arrive, optionally partitioned.
+        ``where`` filters the rows and ``name`` replaces the table name of the output.
+        Returns the output path, or None when the export failed.
+        """
+        if self._native_connect is None:
+            logging.error(f"{self._export_format} export needs a native connection, skipping {table_name}...")
+            return None
+        writer = None
+        try:
+            with self._connection(snapshot) as conn:
+                with conn.cursor() as cursor:
+                    columns = self._table_columns(cursor, table_name)
+                if not columns:
+                    logging.error(f"Table {self._schema}.{table_name} not found, skipping...")
+                    return None
+                schema = arrow_schema(columns)
+                partition_by, partition_column = self._partition_for(columns)
+                writer = PartitionedWriter(
+                    self._save_dir, name or table_name, schema, self._export_format,
+                    partition_by, partition_column, self._person_buckets, self._row_group_rows,
+                )
+                select = ", ".join(select_expression(name, data_type) for name, data_type in columns)
+                # a named cursor keeps the result on the server; rows arrive batch by batch.
+                with conn.cursor(name=f"export_{table_name}") as cursor:
+                    cursor.itersize = self._batch_rows
+                    query = f"SELECT {select} FROM {self._schema}.{table_name}"
+                    cursor.execute(f"{query} WHERE {where}" if where else query)
+                    while True:
+                        rows = cursor.fetchmany(self._batch_rows)
+                        if not rows:
+                            break
+                        writer.write(rows_to_batch(rows, schema))
+            return writer.close()
+        except Exception as e:
+            logging.error(f"Failed to export {self._schema}.{table_name}: {e}")
+            if writer is not None:
+                writer.abort()
+            return None
+
+    def _stream_csv(self, table_name, snapshot=None, where=None, name=None):
+        """
+        Stream a table into its CSV file with COPY TO STDOUT, in chunks of at most
+        ``chunk_bytes``. The file is written under a temporary name and renamed once complete.
+        ``where`` filters the rows and ``name`` replaces the table name of the file.
+        Returns the file path, or None when the export failed.
+        """
+        file_path = os.path.join(self._save_dir, f"{name or table_name}.csv")
+        tmp_path = f"{file_path}.tmp"
+        try:
+            with self._connection(snapshot) as conn:
+                with conn.cursor() as cursor:
+                    columns = [name for name, _ in self._table_columns(cursor, table_name)]
+                if not columns:
+                    logging.error(f"Table {self._schema}.{table_name} not found, skipping...")
+                    return None
+                # upper case headers, as querySql returned them.
+                select = ", ".join(f'"{column}" AS "{column.upper()}"' for column in columns)
+                query = f"SELECT {select} FROM {self._schema}.{table_name}"
+                if where:
+                    query = f"{query} WHERE {where}"
+                copy_sql = f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+                written = self._copy_to_file(conn, copy_sql, tmp_path)
+            os.replace(tmp_path, file_path)
+            logging.info(f"✅ Saved: {file_path} ({written} bytes streamed)")
+            return file_path
+        except Exception as e:
+            logging.error(f"Failed to export {self._schema}.{table_name}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+
+    def _copy_to_file(self, conn, copy_sql, path):
+        """Write the output of a COPY TO STDOUT statement to a file; returns the bytes written."""
+        written = 0
+        with conn.cursor() as cursor:
+            with open(path, "wb", buffering=self._chunk_bytes) as handle:
+                with cursor.copy(copy_sql) as copy:
+                    for data in copy:
+                        handle.write(data)
+                        written += len(data)
+        return written
+
     def _generate_csv(self, table_name):
         """Generate a CSV file for a specific table."""
         query = f"""
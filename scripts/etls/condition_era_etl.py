@@ -1,20 +1,42 @@
 import asyncio
 import logging
 import pandas as pd
+from typing import Optional
+from .era_sql import ERA_BACKEND, SqlEraBuilder, delete_person_eras, replace_person_eras
+from .era_kernel import collapse_frame, era_ids, report_id_collisions
 
 
 class ConditionEraETL:
-    def __init__(self, query_utils, push_to_db, schema: str):
+    def __init__(self, query_utils, push_to_db, schema: str, backend: Optional[str] = None):
         self._query_utils = query_utils
         self._push_to_db = push_to_db
         self._schema = schema
+        # "sql" computes the eras inside the database instead of in pandas.
+        self._backend = (backend or ERA_BACKEND).lower()
 
-    def build(self, window_size: int = 30):
-        """Load condition era data into OMOP condition_era table."""
+    def build(self, window_size: int = 30, person_ids: Optional[set] = None):
+        """Load condition era data into OMOP condition_era table.
+
+        :param window_size: Maximum gap in days between exposures of the same era.
+        :param person_ids: Optional set of persons touched by the current load. Only their
+            exposures are read and only their eras are deleted and rebuilt; None builds
+            eras for every person.
+        """
         try:
-            queried_condition_occurrence = self._query_utils.retrieve_condition_occurrence()
+            if person_ids is not None and not person_ids:
+                logging.info("No persons affected by this load; condition eras are unchanged.")
+                return
+            if self._backend == 'sql':
+                SqlEraBuilder(self._query_utils, self._schema).build('condition_era', window_size, person_ids)
+                return
+            if person_ids is not None:
+                queried_condition_occurrence = self._query_utils.retrieve_condition_occurrence(person_ids=person_ids)
+            else:
+                queried_condition_occurrence = self._query_utils.retrieve_condition_occurrence()
             if queried_condition_occurrence.empty:
                 logging.info("No Condition Occurrence records found in the database.")
+                if person_ids is not None:
+                    delete_person_eras(self._query_utils, 'condition_era', person_ids)
                 return
 
             sorted_data = queried_condition_occurrence.sort_values(
@@ -40,37 +62,37 @@ class ConditionEraETL:
                 sorted_data['condition_start_date'] + pd.Timedelta(days=30)
             )
 
-            sorted_data['prev_date'] = sorted_data.groupby(
-                ['person_id', 'condition_concept_id']
-            )['condition_end_date'].shift(1)
-            sorted_data['new_era'] = (
-                sorted_data['prev_date'].isna()
-            ) | ((sorted_data['condition_start_date'] - sorted_data['prev_date']).dt.days > window_size)
-            sorted_data['era'] = sorted_data.groupby(
-                ['person_id', 'condition_concept_id']
-            )['new_era'].cumsum()
-            sorted_data = sorted_data.groupby(['person_id', 'condition_concept_id', 'era']).agg(
-                condition_era_start_date=('condition_start_date', 'first'),
-                condition_era_end_date=('condition_end_date', 'last'),
-            ).reset_index()
+            sorted_data = collapse_frame(
+                sorted_data, ['person_id', 'condition_concept_id'],
+                'condition_start_date', 'condition_end_date', window_size
+            ).rename(columns={
+                'era_start_date': 'condition_era_start_date',
+                'era_end_date': 'condition_era_end_date',
+                'exposure_count': 'condition_occurrence_count',
+            }).drop(columns=['gap_days'])
 
-            sorted_data['condition_era_source'] = sorted_data[
-                ['person_id', 'condition_concept_id', 'condition_era_start_date', 'condition_era_end_date']
-            ].astype(str).agg('_'.join, axis=1)
-            sorted_data['condition_era_id'] = sorted_data['condition_era_source'].apply(
-                self._query_utils.unique_id_generator, source_type='condition era'
-            )
+            era_key = ['person_id', 'condition_concept_id', 'condition_era_start_date', 'condition_era_end_date']
+            sorted_data['condition_era_id'] = era_ids(sorted_data, era_key, 'condition era', self._query_utils)
 
-            queried_condition_era = self._query_utils.retrieve_condition_era()
-            existing_condition_era = set(queried_condition_era['condition_era_id'])
-            filtered_data = sorted_data[
-                ~sorted_data['condition_era_id'].isin(existing_condition_era)
-            ]
+            if person_ids is not None:
+                # the eras of the affected persons are rebuilt from scratch.
+                report_id_collisions(sorted_data, 'condition_era_id', era_key)
+                replace_person_eras(
+                    self._query_utils, self._push_to_db, self._schema, 'condition_era',
+                    sorted_data.drop_duplicates(subset=['condition_era_id'], keep='first'), person_ids
+                )
+                return
+            else:
+                queried_condition_era = self._query_utils.retrieve_condition_era()
+                existing_condition_era = set(queried_condition_era['condition_era_id'])
+                report_id_collisions(sorted_data, 'condition_era_id', era_key, existing_condition_era)
+                filtered_data = sorted_data[
+                    ~sorted_data['condition_era_id'].isin(existing_condition_era)
+                ]
             if filtered_data.empty:
                 logging.info("No new data to insert for condition era; all records already exist in the target table.")
                 return
 
-            filtered_data.drop(columns=['era', 'condition_era_source'], inplace=True)
             filtered_data = filtered_data.drop_duplicates(subset=['condition_era_id'], keep='first')
 
             asyncio.run(self._push_to_db(
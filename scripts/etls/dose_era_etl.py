@@ -1,94 +1,97 @@
 import asyncio
 import logging
 import pandas as pd
+from typing import Optional
+from .era_sql import ERA_BACKEND, SqlEraBuilder, delete_person_eras, replace_person_eras
+from .era_kernel import collapse_frame, era_ids, report_id_collisions
+from .drug_era_etl import normalize_drug_exposure, retrieve_drug_exposure
 
 
 class DoseEraETL:
-    def __init__(self, query_utils, push_to_db, schema: str):
+    def __init__(self, query_utils, push_to_db, schema: str, backend: Optional[str] = None):
         self._query_utils = query_utils
         self._push_to_db = push_to_db
         self._schema = schema
+        # "sql" computes the eras inside the database instead of in pandas.
+        self._backend = (backend or ERA_BACKEND).lower()
 
-    def build(self, window_size: int = 30):
-        """Load dose era data into OMOP dose_era table."""
+    def build(self, window_size: int = 30, person_ids: Optional[set] = None):
+        """Load dose era data into OMOP dose_era table.
+
+        :param window_size: Maximum gap in days between exposures of the same era.
+        :param person_ids: Optional set of persons touched by the current load. Only their
+            exposures are read and only their eras are deleted and rebuilt; None builds
+            eras for every person.
+        """
         try:
-            queried_drug_exposure = self._query_utils.retrieve_drug_exposure()
+            if person_ids is not None and not person_ids:
+                logging.info("No persons affected by this load; dose eras are unchanged.")
+                return
+            if self._backend == 'sql':
+                SqlEraBuilder(self._query_utils, self._schema).build('dose_era', window_size, person_ids)
+                return
+            queried_drug_exposure = retrieve_drug_exposure(self._query_utils, person_ids)
             if queried_drug_exposure.empty:
                 logging.info("No drug exposure records found in the database.")
+                if person_ids is not None:
+                    delete_person_eras(self._query_utils, 'dose_era', person_ids)
                 return
+            self.build_from(normalize_drug_exposure(queried_drug_exposure), window_size, person_ids)
 
-            sorted_data = queried_drug_exposure.sort_values(
-                by=['person_id', 'drug_concept_id', 'drug_exposure_start_date']
-            )
-            sorted_data['drug_exposure_start_date'] = sorted_data['drug_exposure_start_date'].fillna(
-                sorted_data.groupby('person_id')['drug_exposure_start_date'].transform('min')
-            )
-            mask = sorted_data['drug_exposure_start_date'].isna() & sorted_data['drug_exposure_end_date'].notna()
-            sorted_data.loc[mask, 'drug_exposure_start_date'] = (
-                sorted_data.loc[mask, 'drug_exposure_end_date'] - pd.Timedelta(days=30)
-            )
-            median_date = sorted_data['drug_exposure_start_date'].median()
-            sorted_data['drug_exposure_start_date'] = sorted_data['drug_exposure_start_date'].fillna(median_date)
-            sorted_data['drug_exposure_end_date'] = sorted_data['drug_exposure_end_date'].fillna(
-                sorted_data.groupby('person_id')['drug_exposure_end_date'].transform('max')
-            )
-            sorted_data['drug_exposure_end_date'] = sorted_data['drug_exposure_end_date'].fillna(
-                sorted_data['drug_exposure_start_date'] + pd.Timedelta(days=30)
-            )
+        except Exception as e:
+            logging.error(f"Failed to load data into table: {e}")
 
-            if 'dose_unit_concept_id' in sorted_data.columns:
-                sorted_data['unit_concept_id'] = sorted_data['dose_unit_concept_id'].fillna(0).astype(int)
-            else:
-                sorted_data['unit_concept_id'] = 0
+    def build_from(self, normalized: pd.DataFrame, window_size: int = 30, person_ids: Optional[set] = None):
+        """Build dose eras from drug exposures already sorted and imputed by normalize_drug_exposure."""
+        sorted_data = normalized[['person_id', 'drug_concept_id', 'drug_exposure_start_date', 'drug_exposure_end_date']].copy()
 
-            if 'dose_value' in sorted_data.columns:
-                sorted_data['dose_value'] = pd.to_numeric(sorted_data['dose_value'], errors='coerce')
-            elif 'quantity' in sorted_data.columns:
-                sorted_data['dose_value'] = pd.to_numeric(sorted_data['quantity'], errors='coerce')
-            else:
-                sorted_data['dose_value'] = None
+        if 'dose_unit_concept_id' in normalized.columns:
+            sorted_data['unit_concept_id'] = normalized['dose_unit_concept_id'].fillna(0).astype(int)
+        else:
+            sorted_data['unit_concept_id'] = 0
 
-            sorted_data['dose_value'] = sorted_data['dose_value'].fillna(1.0)
+        if 'dose_value' in normalized.columns:
+            sorted_data['dose_value'] = pd.to_numeric(normalized['dose_value'], errors='coerce')
+        elif 'quantity' in normalized.columns:
+            sorted_data['dose_value'] = pd.to_numeric(normalized['quantity'], errors='coerce')
+        else:
+            sorted_data['dose_value'] = None
 
-            sorted_data['prev_date'] = sorted_data.groupby(
-                ['person_id', 'drug_concept_id', 'unit_concept_id', 'dose_value']
-            )['drug_exposure_end_date'].shift(1)
-            sorted_data['new_era'] = (sorted_data['prev_date'].isna()) | (
-                (sorted_data['drug_exposure_start_date'] - sorted_data['prev_date']).dt.days > window_size
-            )
-            sorted_data['era'] = sorted_data.groupby(
-                ['person_id', 'drug_concept_id', 'unit_concept_id', 'dose_value']
-            )['new_era'].cumsum()
-            sorted_data = sorted_data.groupby(
-                ['person_id', 'drug_concept_id', 'unit_concept_id', 'dose_value', 'era']
-            ).agg(
-                dose_era_start_date=('drug_exposure_start_date', 'first'),
-                dose_era_end_date=('drug_exposure_end_date', 'last'),
-            ).reset_index()
+        sorted_data['dose_value'] = sorted_data['dose_value'].fillna(1.0)
 
-            sorted_data['dose_era_source'] = sorted_data[
-                ['person_id', 'drug_concept_id', 'unit_concept_id', 'dose_value', 'dose_era_start_date', 'dose_era_end_date']
-            ].astype(str).agg('_'.join, axis=1)
-            sorted_data['dose_era_id'] = sorted_data['dose_era_source'].apply(
-                self._query_utils.unique_id_generator, source_type='dose era'
-            )
+        sorted_data = collapse_frame(
+            sorted_data, ['person_id', 'drug_concept_id', 'unit_concept_id', 'dose_value'],
+            'drug_exposure_start_date', 'drug_exposure_end_date', window_size
+        ).rename(columns={
+            'era_start_date': 'dose_era_start_date',
+            'era_end_date': 'dose_era_end_date',
+        }).drop(columns=['exposure_count', 'gap_days'])
 
+        era_key = ['person_id', 'drug_concept_id', 'unit_concept_id', 'dose_value', 'dose_era_start_date', 'dose_era_end_date']
+        sorted_data['dose_era_id'] = era_ids(sorted_data, era_key, 'dose era', self._query_utils)
+
+        if person_ids is not None:
+            # the eras of the affected persons are rebuilt from scratch.
+            report_id_collisions(sorted_data, 'dose_era_id', era_key)
+            replace_person_eras(
+                self._query_utils, self._push_to_db, self._schema, 'dose_era',
+                sorted_data.drop_duplicates(subset=['dose_era_id'], keep='first'), person_ids
+            )
+            return
+        else:
             queried_dose_era = self._query_utils.retrieve_dose_era()
             existing_dose_era = set(queried_dose_era['dose_era_id'])
+            report_id_collisions(sorted_data, 'dose_era_id', era_key, existing_dose_era)
             filtered_data = sorted_data[~sorted_data['dose_era_id'].isin(existing_dose_era)]
-            if filtered_data.empty:
-                logging.info("No new data to insert for dose era; all records already exist in the target table.")
-                return
-
-            filtered_data.drop(columns=['era', 'dose_era_source'], inplace=True)
-            filtered_data = filtered_data.drop_duplicates(subset=['dose_era_id'], keep='first')
+        if filtered_data.empty:
+            logging.info("No new data to insert for dose era; all records already exist in the target table.")
+            return
 
-            asyncio.run(self._push_to_db(
-                batch_size=250000,
-                data=filtered_data,
-                table_name='dose_era'
-            ))
-            logging.info(f"Loaded data into table '{self._schema}.dose_era'.")
+        filtered_data = filtered_data.drop_duplicates(subset=['dose_era_id'], keep='first')
 
-        except Exception as e:
-            logging.error(f"Failed to load data into table: {e}")
+        asyncio.run(self._push_to_db(
+            batch_size=250000,
+            data=filtered_data,
+            table_name='dose_era'
+        ))
+        logging.info(f"Loaded data into table '{self._schema}.dose_era'.")
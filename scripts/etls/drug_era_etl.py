@@ -1,82 +1,135 @@
 import asyncio
 import logging
 import pandas as pd
+from typing import Optional
+from .era_sql import ERA_BACKEND, SqlEraBuilder, delete_person_eras, replace_person_eras
+from .era_kernel import collapse_frame, era_ids, report_id_collisions
+from .ingredient_map import INGREDIENT_ROLLUP, IngredientMap
+
+
+def normalize_drug_exposure(queried_drug_exposure: pd.DataFrame) -> pd.DataFrame:
+    """Sort drug exposures by person, concept and start date and impute missing dates.
+
+    The result is shared by the drug era and dose era builders, so the imputation
+    only runs once per drug_exposure scan.
+    """
+    sorted_data = queried_drug_exposure.sort_values(
+        by=['person_id', 'drug_concept_id', 'drug_exposure_start_date']
+    )
+
+    sorted_data['drug_exposure_start_date'] = sorted_data['drug_exposure_start_date'].fillna(
+        sorted_data.groupby('person_id')['drug_exposure_start_date'].transform('min')
+    )
+    mask = sorted_data['drug_exposure_start_date'].isna() & sorted_data['drug_exposure_end_date'].notna()
+    sorted_data.loc[mask, 'drug_exposure_start_date'] = (
+        sorted_data.loc[mask, 'drug_exposure_end_date'] - pd.Timedelta(days=30)
+    )
+    median_date = sorted_data['drug_exposure_start_date'].median()
+    sorted_data['drug_exposure_start_date'] = sorted_data['drug_exposure_start_date'].fillna(median_date)
+
+    sorted_data['drug_exposure_end_date'] = sorted_data['drug_exposure_end_date'].fillna(
+        sorted_data.groupby('person_id')['drug_exposure_end_date'].transform('max')
+    )
+    sorted_data['drug_exposure_end_date'] = sorted_data['drug_exposure_end_date'].fillna(
+        sorted_data['drug_exposure_start_date'] + pd.Timedelta(days=30)
+    )
+    return sorted_data
+
+
+def retrieve_drug_exposure(query_utils, person_ids: Optional[set] = None) -> pd.DataFrame:
+    """Retrieve the drug exposures the eras are built from, optionally only those of some persons."""
+    if person_ids is not None:
+        return query_utils.retrieve_drug_exposure(person_ids=person_ids)
+    return query_utils.retrieve_drug_exposure()
 
 
 class DrugEraETL:
-    def __init__(self, query_utils, push_to_db, schema: str):
+    def __init__(
+        self,
+        query_utils,
+        push_to_db,
+        schema: str,
+        backend: Optional[str] = None,
+        ingredient_map: Optional[IngredientMap] = None,
+    ):
         self._query_utils = query_utils
         self._push_to_db = push_to_db
         self._schema = schema
+        # "sql" computes the eras inside the database instead of in pandas.
+        self._backend = (backend or ERA_BACKEND).lower()
+        # drug concepts are rolled up to their ingredients when a map is given or INGREDIENT_ROLLUP is set.
+        self._ingredient_map = ingredient_map
+
+    def build(self, window_size: int = 30, person_ids: Optional[set] = None):
+        """Load drug era data into OMOP drug_era table.
 
-    def build(self, window_size: int = 30):
-        """Load drug era data into OMOP drug_era table."""
+        :param window_size: Maximum gap in days between exposures of the same era.
+        :param person_ids: Optional set of persons touched by the current load. Only their
+            exposures are read and only their eras are deleted and rebuilt; None builds
+            eras for every person.
+        """
         try:
-            queried_drug_exposure = self._query_utils.retrieve_drug_exposure()
+            if person_ids is not None and not person_ids:
+                logging.info("No persons affected by this load; drug eras are unchanged.")
+                return
+            if self._backend == 'sql':
+                SqlEraBuilder(self._query_utils, self._schema).build('drug_era', window_size, person_ids)
+                return
+            queried_drug_exposure = retrieve_drug_exposure(self._query_utils, person_ids)
             if queried_drug_exposure.empty:
                 logging.info("No drug exposure records found in the database.")
+                if person_ids is not None:
+                    delete_person_eras(self._query_utils, 'drug_era', person_ids)
                 return
+            self.build_from(normalize_drug_exposure(queried_drug_exposure), window_size, person_ids)
 
-            sorted_data = queried_drug_exposure.sort_values(
-                by=['person_id', 'drug_concept_id', 'drug_exposure_start_date']
-            )
+        except Exception as e:
+            logging.error(f"Failed to load data into table: {e}")
 
-            sorted_data['drug_exposure_start_date'] = sorted_data['drug_exposure_start_date'].fillna(
-                sorted_data.groupby('person_id')['drug_exposure_start_date'].transform('min')
-            )
-            mask = sorted_data['drug_exposure_start_date'].isna() & sorted_data['drug_exposure_end_date'].notna()
-            sorted_data.loc[mask, 'drug_exposure_start_date'] = (
-                sorted_data.loc[mask, 'drug_exposure_end_date'] - pd.Timedelta(days=30)
-            )
-            median_date = sorted_data['drug_exposure_start_date'].median()
-            sorted_data['drug_exposure_start_date'] = sorted_data['drug_exposure_start_date'].fillna(median_date)
+    def build_from(self, normalized: pd.DataFrame, window_size: int = 30, person_ids: Optional[set] = None):
+        """Build drug eras from drug exposures already sorted and imputed by normalize_drug_exposure."""
+        sorted_data = normalized[['person_id', 'drug_concept_id', 'drug_exposure_start_date', 'drug_exposure_end_date']].copy()
+        if self._ingredient_map is None and INGREDIENT_ROLLUP:
+            self._ingredient_map = IngredientMap.load(self._query_utils)
+        if self._ingredient_map is not None:
+            sorted_data = self._ingredient_map.roll_up(sorted_data, 'drug_concept_id')
 
-            sorted_data['drug_exposure_end_date'] = sorted_data['drug_exposure_end_date'].fillna(
-                sorted_data.groupby('person_id')['drug_exposure_end_date'].transform('max')
-            )
-            sorted_data['drug_exposure_end_date'] = sorted_data['drug_exposure_end_date'].fillna(
-                sorted_data['drug_exposure_start_date'] + pd.Timedelta(days=30)
-            )
+        sorted_data = collapse_frame(
+            sorted_data, ['person_id', 'drug_concept_id'],
+            'drug_exposure_start_date', 'drug_exposure_end_date', window_size
+        ).rename(columns={
+            'era_start_date': 'drug_era_start_date',
+            'era_end_date': 'drug_era_end_date',
+            'exposure_count': 'drug_exposure_count',
+        })
 
-            sorted_data['prev_date'] = sorted_data.groupby(
-                ['person_id', 'drug_concept_id']
-            )['drug_exposure_end_date'].shift(1)
-            sorted_data['new_era'] = (
-                sorted_data['prev_date'].isna()
-            ) | ((sorted_data['drug_exposure_start_date'] - sorted_data['prev_date']).dt.days > window_size)
-
-            sorted_data['era'] = sorted_data.groupby(
-                ['person_id', 'drug_concept_id']
-            )['new_era'].cumsum()
-            sorted_data = sorted_data.groupby(['person_id', 'drug_concept_id', 'era']).agg(
-                drug_era_start_date=('drug_exposure_start_date', 'first'),
-                drug_era_end_date=('drug_exposure_end_date', 'last'),
-            ).reset_index()
-
-            sorted_data['drug_era_source'] = sorted_data[
-                ['person_id', 'drug_concept_id', 'drug_era_start_date', 'drug_era_end_date']
-            ].astype(str).agg('_'.join, axis=1)
-            sorted_data['drug_era_id'] = sorted_data['drug_era_source'].apply(
-                self._query_utils.unique_id_generator, source_type='drug era'
-            )
+        era_key = ['person_id', 'drug_concept_id', 'drug_era_start_date', 'drug_era_end_date']
+        sorted_data['drug_era_id'] = era_ids(sorted_data, era_key, 'drug era', self._query_utils)
 
+        if person_ids is not None:
+            # the eras of the affected persons are rebuilt from scratch.
+            report_id_collisions(sorted_data, 'drug_era_id', era_key)
+            replace_person_eras(
+                self._query_utils, self._push_to_db, self._schema, 'drug_era',
+                sorted_data.drop_duplicates(subset=['drug_era_id'], keep='first'), person_ids
+            )
+            return
+        else:
             queried_drug_era = self._query_utils.retrieve_drug_era()
             existing_drug_era = set(queried_drug_era['drug_era_id'])
+            report_id_collisions(sorted_data, 'drug_era_id', era_key, existing_drug_era)
             filtered_data = sorted_data[~sorted_data['drug_era_id'].isin(existing_drug_era)]
 
-            if filtered_data.empty:
-                logging.info("No new data to insert for drug era; all records already exist in the target table.")
-                return
+        if filtered_data.empty:
+            logging.info("No new data to insert for drug era; all records already exist in the target table.")
+            return
 
-            filtered_data.drop(columns=['era', 'drug_era_source'], inplace=True)
-            filtered_data = filtered_data.drop_duplicates(subset=['drug_era_id'], keep='first')
+        filtered_data = filtered_data.drop_duplicates(subset=['drug_era_id'], keep='first')
 
-            asyncio.run(self._push_to_db(
-                batch_size=250000,
-                data=filtered_data,
-                table_name='drug_era'
-            ))
-            logging.info(f"Loaded data into table '{self._schema}.drug_era'.")
+        asyncio.run(self._push_to_db(
+            batch_size=250000,
+            data=filtered_data,
+            table_name='drug_era'
+        ))
+        logging.info(f"Loaded data into table '{self._schema}.drug_era'.")
 
-        except Exception as e:
-            logging.error(f"Failed to load data into table: {e}")
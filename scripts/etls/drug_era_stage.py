@@ -0,0 +1,53 @@
+import logging
+from typing import Optional
+from .era_sql import ERA_BACKEND, delete_person_eras
+from .drug_era_etl import DrugEraETL, normalize_drug_exposure, retrieve_drug_exposure
+from .dose_era_etl import DoseEraETL
+
+
+class DrugEraStage:
+    """
+    Build drug_era and dose_era from a single drug_exposure scan.
+
+    drug_exposure is read and normalized once and both era builders work on the same
+    sorted, imputed frame. Meant to run once after every drug_exposure entry has loaded.
+    """
+
+    def __init__(self, query_utils, push_to_db, schema: str, backend: Optional[str] = None):
+        """
+        Initialise the DrugEraStage class.
+        Args:
+            query_utils: QueryUtils - Used to read drug_exposure and the existing eras.
+            push_to_db: coroutine - Used to push the eras to the database.
+            schema: str - The CDM schema.
+            backend: str - "pandas" or "sql"; defaults to ERA_BACKEND.
+        """
+        self._query_utils = query_utils
+        self._backend = (backend or ERA_BACKEND).lower()
+        self._drug_era = DrugEraETL(query_utils, push_to_db, schema, self._backend)
+        self._dose_era = DoseEraETL(query_utils, push_to_db, schema, self._backend)
+
+    def build(self, drug_window_size: int = 30, dose_window_size: int = 30, person_ids: Optional[set] = None):
+        """Build drug_era and dose_era, reading drug_exposure only once."""
+        try:
+            if person_ids is not None and not person_ids:
+                logging.info("No persons affected by this load; drug and dose eras are unchanged.")
+                return
+            if self._backend == 'sql':
+                # the sql backend never downloads drug_exposure, so there is no scan to share.
+                self._drug_era.build(drug_window_size, person_ids)
+                self._dose_era.build(dose_window_size, person_ids)
+                return
+            queried_drug_exposure = retrieve_drug_exposure(self._query_utils, person_ids)
+            if queried_drug_exposure.empty:
+                logging.info("No drug exposure records found in the database.")
+                if person_ids is not None:
+                    delete_person_eras(self._query_utils, 'drug_era', person_ids)
+                    delete_person_eras(self._query_utils, 'dose_era', person_ids)
+                return
+            normalized = normalize_drug_exposure(queried_drug_exposure)
+            self._drug_era.build_from(normalized, drug_window_size, person_ids)
+            self._dose_era.build_from(normalized, dose_window_size, person_ids)
+
+        except Exception as e:
+            logging.error(f"Failed to load data into table: {e}")
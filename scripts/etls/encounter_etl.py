@@ -1,15 +1,40 @@
+import numpy as np
 import pandas as pd
 # loading...
 import logging
 import uuid
 from typing import Optional
 from .main_etl import ETLEntity
+from .era_kernel import group_codes
 
 class Encounters(ETLEntity):
     ENCOUNTER_CLASS_MAP = {'inpatient': 9201, 'outpatient': 9202, 'wellness': 9202,
                            'ambulatory': 38004207, 
                            'emergency': 9203, 'urgentcare': 8782}
 
+    def load_data(self):
+        """Load the encounters.
+
+        Incremental runs read the appended rows first, then every earlier encounter of the
+        patients they belong to. Visits are merged across the whole history of those
+        patients, as a full run would, instead of only across the appended rows.
+        """
+        super().load_data()
+        if self._watermark is None or self._source_data.empty or 'patient' not in self._source_data.columns:
+            return
+        patients = set(self._source_data['patient'].dropna())
+        try:
+            chunks = pd.read_csv(self._path, chunksize=self._chunk_size, low_memory=False)
+            history = []
+            for chunk in chunks:
+                chunk = chunk.rename(columns=str.lower)
+                history.append(chunk[chunk['patient'].isin(patients)])
+            self._source_data = pd.concat(history, ignore_index=True)
+            logging.info(f"Read the encounter history of {len(patients)} patients with new encounters.")
+        except Exception as e:
+            # the appended rows are still loaded, merged only among themselves.
+            logging.error(f"Failed to read the encounter history of the new encounters, merging only the new ones: {e}")
+
     def map_data(self, mapper = {}):
         """Map the specific fields for the visit occurrence entity."""
         try:
@@ -66,25 +91,85 @@ class Encounters(ETLEntity):
         self._source_data['visit_source_value'] = self._source_data['id']
 
     def _aggregate_data(self, gap_threshold = 1):
-        """Aggregate data by person_source_value and visit_concept_id."""
-
-        # sort data before processing gaps.
-        self._source_data = self._source_data.sort_values(['person_source_value', 'visit_concept_id', 'visit_start_date'])
-        # calculate the gap between visits.
-        self._source_data['prev_visit_end_date'] = self._source_data.groupby(['person_source_value', 'visit_concept_id'])['visit_end_datetime'].shift(1)
-        self._source_data['visit_gap'] = (self._source_data['visit_start_datetime'] - self._source_data['prev_visit_end_date']).dt.days.fillna(0)
-        # filter out visits that are within the gap threshold.
-        self._source_data['new_visit'] = (self._source_data['visit_gap'] > gap_threshold).astype(int)
-        self._source_data['new_visit'] = self._source_data['new_visit'].cumsum()
-
-        self._source_data = self._source_data.groupby(['person_source_value', 'visit_concept_id', 'new_visit']).agg(
-            visit_start_date = ('visit_start_date', 'min'),
-            visit_end_date = ('visit_end_date', 'max'),
-            visit_start_datetime = ('visit_start_datetime', 'min'),
-            visit_end_datetime = ('visit_end_datetime', 'max'),
-            visit_type_concept_id = ('visit_type_concept_id', 'first'),
-            visit_occurrence_id = ('visit_occurrence_id', 'first'),
-            care_site_source_value = ('care_site_source_value', 'first'),
-            provider_source_value = ('provider_source_value', 'first'),
-            visit_source_value = ('visit_source_value', 'first')
-        ).reset_index()
+        """Aggregate data by person_source_value and visit_concept_id.
+
+        Visits of the same person and visit concept are merged when a visit starts at most
+        ``gap_threshold`` days after the end of the previous one (sorted by start date).
+        The rows are sorted once on integer codes; merge boundaries, min/max values and
+        first non-null values are found with NumPy and gathered by row index.
+        """
+        data = self._source_data.dropna(subset=['person_source_value', 'visit_concept_id'])
+        keys = ['person_source_value', 'visit_concept_id']
+        firsts = ['visit_type_concept_id', 'visit_occurrence_id', 'care_site_source_value',
+                  'provider_source_value', 'visit_source_value']
+        columns = keys + ['new_visit', 'visit_start_date', 'visit_end_date',
+                          'visit_start_datetime', 'visit_end_datetime'] + firsts
+        if data.empty:
+            self._source_data = pd.DataFrame(columns=columns)
+            return
+
+        # one stable sort on (person, visit concept, start date).
+        group = group_codes(data, keys)
+        start_days = self._datetime_values(data['visit_start_datetime'], wall_time=True).astype('datetime64[D]').astype(np.int64)
+        offset = start_days - start_days.min()
+        span = int(offset.max()) + 1
+        if group.max() >= (2 ** 62) // span:
+            group = pd.factorize(group, sort=True)[0].astype(np.int64)
+        order = np.argsort(group * span + offset, kind='stable')
+        n = len(order)
+
+        start = self._datetime_values(data['visit_start_datetime'])[order]
+        end = self._datetime_values(data['visit_end_datetime'])[order]
+        sorted_group = group[order]
+        group_starts = np.ones(n, dtype=bool)
+        group_starts[1:] = sorted_group[1:] != sorted_group[:-1]
+
+        # gap in whole days to the end of the previous visit of the same group; 0 when there is none.
+        gap = np.zeros(n, dtype=np.int64)
+        previous_end = end[:-1]
+        valid = ~(np.isnat(start[1:]) | np.isnat(previous_end))
+        gap[1:][valid] = (start[1:][valid] - previous_end[valid]) // np.timedelta64(1, 'D')
+        gap[group_starts] = 0
+        new_visit = np.cumsum(gap > gap_threshold)
+        visit_starts = group_starts.copy()
+        visit_starts[1:] |= new_visit[1:] != new_visit[:-1]
+        first_row = np.flatnonzero(visit_starts)
+        last_row = np.append(first_row[1:], n)
+
+        def gather(column, positions):
+            return data[column].iloc[order[positions]].reset_index(drop=True)
+
+        def extreme_row(values, maximum):
+            # row of the min/max of every visit; NaT only wins when the whole visit is NaT.
+            numbers = values.view(np.int64)
+            if not maximum:
+                numbers = np.where(np.isnat(values), np.iinfo(np.int64).max, numbers)
+            reduce = np.maximum if maximum else np.minimum
+            best = np.repeat(reduce.reduceat(numbers, first_row), last_row - first_row)
+            rows = np.where(numbers == best, np.arange(n), n)
+            return np.minimum.reduceat(rows, first_row)
+
+        start_row = extreme_row(start, maximum=False)
+        end_row = extreme_row(end, maximum=True)
+        result = gather('person_source_value', first_row).to_frame()
+        result['visit_concept_id'] = gather('visit_concept_id', first_row)
+        result['new_visit'] = new_visit[first_row]
+        # the dates are the dates of the earliest start and latest end datetimes.
+        result['visit_start_date'] = gather('visit_start_date', start_row)
+        result['visit_end_date'] = gather('visit_end_date', end_row)
+        result['visit_start_datetime'] = gather('visit_start_datetime', start_row)
+        result['visit_end_datetime'] = gather('visit_end_datetime', end_row)
+        for column in firsts:
+            present = data[column].notna().to_numpy()[order]
+            rows = np.minimum.reduceat(np.where(present, np.arange(n), n), first_row)
+            found = rows < last_row
+            values = gather(column, np.where(found, rows, first_row))
+            result[column] = values if found.all() else values.where(found, None)
+        self._source_data = result
+
+    @staticmethod
+    def _datetime_values(series: pd.Series, wall_time: bool = False) -> np.ndarray:
+        """Get datetime64 values of a datetime column; tz-aware values as UTC or, with wall_time, local time."""
+        if series.dt.tz is not None:
+            series = series.dt.tz_localize(None) if wall_time else series.dt.tz_convert(None)
+        return series.to_numpy()
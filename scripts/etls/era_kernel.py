@@ -0,0 +1,280 @@
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "uuid" keeps the uuid5 era ids of unique_id_generator, "vectorized" hashes the
+# era columns with numpy. The two give different ids, so pick one per database.
+ERA_ID_HASH = os.getenv("ERA_ID_HASH", "uuid").lower()
+# era ids are reduced to the same id space as unique_id_generator (integer CDM columns).
+ERA_ID_SPACE = 10 ** 9
+# worker processes used to collapse eras; each one handles a contiguous range of persons.
+ERA_WORKERS = int(os.getenv("ERA_WORKERS", "1"))
+# below this many exposures per worker the pool costs more than it saves.
+PARALLEL_MIN_ROWS = 500000
+
+# largest value a combined int64 key is allowed to reach.
+_KEY_LIMIT = 2 ** 62
+
+
+def group_codes(data: pd.DataFrame, keys: list) -> np.ndarray:
+    """
+    Get one int64 code per row for the combination of ``keys``.
+    Codes follow the sort order of the key values, so sorting by code sorts by the keys.
+    """
+    group = np.zeros(len(data), dtype=np.int64)
+    cardinality = 1
+    for key in keys:
+        codes, uniques = pd.factorize(data[key], sort=True)
+        if cardinality * len(uniques) >= _KEY_LIMIT:
+            # re-number the combinations seen so far to keep the combined code in range.
+            group, seen = pd.factorize(group, sort=True)
+            group = group.astype(np.int64)
+            cardinality = len(seen)
+        group = group * len(uniques) + codes
+        cardinality *= len(uniques)
+    return group
+
+
+def to_day_numbers(values) -> np.ndarray:
+    """Convert dates to int64 day numbers (days since 1970-01-01)."""
+    return pd.to_datetime(values).to_numpy().astype("datetime64[D]").astype(np.int64)
+
+
+def from_day_numbers(days: np.ndarray) -> pd.Series:
+    """Convert int64 day numbers back to timestamps."""
+    return pd.Series(days.astype("datetime64[D]").astype("datetime64[ns]"))
+
+
+def collapse_eras(group_starts: np.ndarray, start_days: np.ndarray, end_days: np.ndarray, window_size: int):
+    """
+    Collapse sorted exposures into eras (gaps and islands).
+
+    The rows must be sorted by group and by start day inside each group. An exposure
+    starts a new era when it opens a new group or when it starts more than
+    ``window_size`` days after the running maximum end day of the earlier exposures
+    of the same group.
+
+    Args:
+        group_starts: bool array - True on the first row of every group.
+        start_days: int64 array - Start day number of every exposure.
+        end_days: int64 array - End day number of every exposure.
+        window_size: int - Maximum gap in days between exposures of the same era.
+    Returns:
+        dict of arrays, one entry per era: ``first_row`` (index of the era's first
+        exposure), ``start``, ``end``, ``count`` and ``gap_days`` (days of the era
+        not covered by any exposure).
+    """
+    n = len(start_days)
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return {"first_row": empty, "start": empty, "end": empty, "count": empty, "gap_days": empty}
+
+    start_days = np.asarray(start_days, dtype=np.int64)
+    end_days = np.maximum(np.asarray(end_days, dtype=np.int64), start_days)
+    group_starts = np.asarray(group_starts, dtype=bool).copy()
+    group_starts[0] = True
+
+    # running max of the end day per group: every group is lifted above all earlier
+    # groups so a single maximum.accumulate never carries a value across groups.
+    group_id = np.cumsum(group_starts) - 1
+    base = end_days.min()
+    span = int(end_days.max() - base) + 1
+    lift = group_id * span
+    running_end = np.maximum.accumulate(end_days - base + lift) - lift + base
+
+    previous_end = np.empty(n, dtype=np.int64)
+    previous_end[0] = 0
+    previous_end[1:] = running_end[:-1]
+    era_starts = group_starts | (start_days - previous_end > window_size)
+
+    first_row = np.flatnonzero(era_starts)
+    era_start = np.minimum.reduceat(start_days, first_row)
+    era_end = np.maximum.reduceat(end_days, first_row)
+    count = np.diff(np.append(first_row, n))
+
+    # days each exposure adds to the union of the era's exposures.
+    covered = np.where(
+        era_starts,
+        end_days - start_days,
+        np.maximum(end_days - np.maximum(start_days, previous_end), 0),
+    )
+    gap_days = (era_end - era_start) - np.add.reduceat(covered, first_row)
+    return {"first_row": first_row, "start": era_start, "end": era_end, "count": count, "gap_days": gap_days}
+
+
+def _sort_and_collapse(group: np.ndarray, start_days: np.ndarray, end_days: np.ndarray, window_size: int):
+    """Sort exposures by (group, start day) and collapse them; first_row indexes the unsorted arrays."""
+    # one int64 sort key (group, start day) instead of a multi-key lexsort.
+    offset = start_days - start_days.min()
+    span = int(offset.max()) + 1
+    if group.max() >= _KEY_LIMIT // span:
+        group = pd.factorize(group, sort=True)[0].astype(np.int64)
+    order = np.argsort(group * span + offset)
+    sorted_group = group[order]
+    group_starts = np.ones(len(order), dtype=bool)
+    group_starts[1:] = sorted_group[1:] != sorted_group[:-1]
+    eras = collapse_eras(group_starts, start_days[order], end_days[order], window_size)
+    eras["first_row"] = order[eras["first_row"]]
+    return eras
+
+
+_ERA_FIELDS = ("first_row", "start", "end", "count", "gap_days")
+
+
+def _collapse_range(shm_name: str, n: int, lo: int, hi: int, window_size: int):
+    """
+    Collapse the exposures [lo, hi) of the shared arrays in a worker process.
+    The eras are written to the shared output arrays starting at ``lo``; returns (lo, number of eras).
+    """
+    block = shared_memory.SharedMemory(name=shm_name)
+    try:
+        arrays = np.ndarray((3 + len(_ERA_FIELDS), n), dtype=np.int64, buffer=block.buf)
+        group, start_days, end_days = arrays[0, lo:hi], arrays[1, lo:hi], arrays[2, lo:hi]
+        eras = _sort_and_collapse(group.copy(), start_days.copy(), end_days.copy(), window_size)
+        eras["first_row"] = eras["first_row"] + lo
+        size = len(eras["first_row"])
+        for index, field in enumerate(_ERA_FIELDS):
+            arrays[3 + index, lo:lo + size] = eras[field]
+        del arrays, group, start_days, end_days
+        return lo, size
+    finally:
+        block.close()
+
+
+def collapse_parallel(person: np.ndarray, group: np.ndarray, start_days: np.ndarray, end_days: np.ndarray,
+                      window_size: int, workers: int):
+    """
+    Collapse exposures in a process pool, one contiguous range of persons per task.
+
+    The exposures are ordered by person range and placed in one shared memory block
+    together with the output arrays, so neither the inputs nor the eras are pickled.
+    Returns the same arrays as the single process path, in the same order.
+    """
+    n = len(start_days)
+    # contiguous person ranges with about the same number of exposures each.
+    person_order = np.argsort(person, kind="stable")
+    sorted_person = person[person_order]
+    cuts = np.searchsorted(sorted_person, sorted_person[np.linspace(0, n - 1, workers + 1).astype(np.int64)[1:-1]])
+    bounds = [int(value) for value in np.unique(np.concatenate(([0], cuts, [n])))]
+
+    block = shared_memory.SharedMemory(create=True, size=(3 + len(_ERA_FIELDS)) * n * 8)
+    try:
+        arrays = np.ndarray((3 + len(_ERA_FIELDS), n), dtype=np.int64, buffer=block.buf)
+        arrays[0] = group[person_order]
+        arrays[1] = start_days[person_order]
+        arrays[2] = end_days[person_order]
+        # spawn keeps an embedded R session of the parent out of the workers.
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            ranges = list(executor.map(
+                _collapse_range,
+                [block.name] * (len(bounds) - 1),
+                [n] * (len(bounds) - 1),
+                bounds[:-1],
+                bounds[1:],
+                [window_size] * (len(bounds) - 1),
+            ))
+        eras = {
+            field: np.concatenate([arrays[3 + index, lo:lo + size] for lo, size in ranges])
+            for index, field in enumerate(_ERA_FIELDS)
+        }
+        eras["first_row"] = person_order[eras["first_row"]]
+        del arrays
+        return eras
+    finally:
+        block.close()
+        block.unlink()
+
+
+def collapse_frame(data: pd.DataFrame, keys: list, start_column: str, end_column: str, window_size: int,
+                   workers: int = None) -> pd.DataFrame:
+    """
+    Collapse the exposures of a frame into eras per ``keys``.
+
+    The first key must be the person column. With more than one worker (ERA_WORKERS)
+    and enough exposures, contiguous person ranges are collapsed in a process pool.
+    Returns one row per era with the key columns, ``era_start_date``,
+    ``era_end_date``, ``exposure_count`` and ``gap_days``.
+    """
+    columns = keys + ["era_start_date", "era_end_date", "exposure_count", "gap_days"]
+    if data.empty:
+        return pd.DataFrame(columns=columns)
+
+    start_days = to_day_numbers(data[start_column])
+    end_days = to_day_numbers(data[end_column])
+    group = group_codes(data, keys)
+    workers = min(ERA_WORKERS if workers is None else workers, max(len(data) // PARALLEL_MIN_ROWS, 1))
+    if workers > 1:
+        person = pd.factorize(data[keys[0]], sort=True)[0]
+        eras = collapse_parallel(person, group, start_days, end_days, window_size, workers)
+    else:
+        eras = _sort_and_collapse(group, start_days, end_days, window_size)
+
+    result = data[keys].iloc[eras["first_row"]].reset_index(drop=True)
+    result["era_start_date"] = from_day_numbers(eras["start"])
+    result["era_end_date"] = from_day_numbers(eras["end"])
+    result["exposure_count"] = eras["count"]
+    result["gap_days"] = eras["gap_days"]
+    return result[columns]
+
+
+def _splitmix64(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer on uint64 arrays (wraps modulo 2**64)."""
+    values = values + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _column_words(series: pd.Series) -> np.ndarray:
+    """Get the uint64 words hashed for a column: day numbers for dates, bits for numbers."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return to_day_numbers(series).view(np.uint64)
+    if pd.api.types.is_float_dtype(series):
+        values = series.to_numpy(dtype=np.float64, na_value=np.nan) + 0.0  # + 0.0 turns -0.0 into 0.0
+        return values.view(np.uint64)
+    return series.to_numpy(dtype=np.int64).view(np.uint64)
+
+
+def hash_columns(data: pd.DataFrame, columns: list, source_type: str) -> np.ndarray:
+    """
+    Hash the given int, float and date columns row by row into deterministic 63-bit ids.
+    Works on the numpy buffers of the columns, without building per row strings.
+    """
+    seed = np.frombuffer(source_type.encode("utf-8").ljust(8, b"\0")[:8], dtype=np.uint64)[0]
+    hashed = np.full(len(data), _splitmix64(np.array([seed], dtype=np.uint64))[0], dtype=np.uint64)
+    for column in columns:
+        hashed = _splitmix64(hashed ^ _column_words(data[column]))
+    return (hashed >> np.uint64(1)).astype(np.int64)
+
+
+def era_ids(data: pd.DataFrame, columns: list, source_type: str, query_utils) -> pd.Series:
+    """
+    Build the era ids of a frame from its natural key columns.
+    Uses the vectorized hash when ERA_ID_HASH is "vectorized", else unique_id_generator.
+    """
+    if ERA_ID_HASH == "vectorized":
+        return pd.Series(hash_columns(data, columns, source_type) % ERA_ID_SPACE, index=data.index)
+    era_source = data[columns].astype(str).agg('_'.join, axis=1)
+    return era_source.apply(query_utils.unique_id_generator, source_type=source_type)
+
+
+def report_id_collisions(data: pd.DataFrame, id_column: str, key_columns: list, existing_ids=None):
+    """
+    Log how many distinct eras share an id within the batch, and how many ids already exist.
+    Returns (batch collisions, ids matching an existing era id).
+    """
+    distinct = data.drop_duplicates(subset=key_columns)
+    collisions = int(distinct[id_column].duplicated().sum())
+    matched = int(data[id_column].isin(existing_ids).sum()) if existing_ids is not None else 0
+    if collisions:
+        logging.warning(f"{collisions} {id_column} collisions between distinct eras; the later eras are dropped.")
+    logging.info(f"{matched} of {len(data)} {id_column} values already exist in the target table.")
+    return collisions, matched
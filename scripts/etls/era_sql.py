@@ -0,0 +1,270 @@
+import os
+import asyncio
+import logging
+from typing import Optional
+from dotenv import load_dotenv
+from scripts.loaders.staging import StagingMerge
+
+load_dotenv()
+
+# "pandas" builds eras in python, "sql" builds them inside the database.
+ERA_BACKEND = os.getenv("ERA_BACKEND", "pandas").lower()
+
+# era table -> how it is derived from its clinical table.
+ERA_SPECS = {
+    "condition_era": {
+        "source": "condition_occurrence",
+        "concept": "condition_concept_id",
+        "start": "condition_start_date",
+        "end": "condition_end_date",
+        "era_start": "condition_era_start_date",
+        "era_end": "condition_era_end_date",
+        "count": "condition_occurrence_count",
+        # missing end dates only fall back to start + 30 days.
+        "person_max_end": False,
+        "dose": False,
+        "gap_days": False,
+    },
+    "drug_era": {
+        "source": "drug_exposure",
+        "concept": "drug_concept_id",
+        "start": "drug_exposure_start_date",
+        "end": "drug_exposure_end_date",
+        "era_start": "drug_era_start_date",
+        "era_end": "drug_era_end_date",
+        "count": "drug_exposure_count",
+        "person_max_end": True,
+        "dose": False,
+        # days of the era not covered by any exposure.
+        "gap_days": True,
+    },
+    "dose_era": {
+        "source": "drug_exposure",
+        "concept": "drug_concept_id",
+        "start": "drug_exposure_start_date",
+        "end": "drug_exposure_end_date",
+        "era_start": "dose_era_start_date",
+        "era_end": "dose_era_end_date",
+        "count": None,
+        "person_max_end": True,
+        "dose": True,
+        "gap_days": False,
+    },
+}
+
+
+class SqlEraBuilder:
+    """
+    Build condition, drug and dose eras inside PostgreSQL.
+
+    Exposures are collapsed with a gaps-and-islands query: a row starts a new era
+    when its start date is more than ``window_size`` days after the latest end date
+    seen so far for the same person and concept, and the running SUM of those starts
+    numbers the eras. The eras are written with a single INSERT ... SELECT, so no
+    clinical rows leave the database.
+    """
+
+    def __init__(self, query_utils, schema: str):
+        """
+        Initialise the SqlEraBuilder class.
+        Args:
+            query_utils: QueryUtils - Used to run the statements.
+            schema: str - The CDM schema holding the clinical and era tables.
+        """
+        self._query_utils = query_utils
+        self._schema = schema
+
+    def dose_columns(self, source: str):
+        """Get the unit and dose expressions of a dose era, based on the columns the source table has."""
+        columns = set(self._query_utils.retrieve_table_columns(source)['column_name'])
+        unit = "COALESCE(dose_unit_concept_id, 0)" if "dose_unit_concept_id" in columns else "0"
+        if "dose_value" in columns:
+            dose = "COALESCE(dose_value::numeric, 1.0)"
+        elif "quantity" in columns:
+            dose = "COALESCE(quantity::numeric, 1.0)"
+        else:
+            dose = "1.0"
+        return unit, dose
+
+    def build_sql(self, era: str, window_size: int, person_filter: str = "", unit: str = "0", dose: str = "1.0") -> str:
+        """Build the INSERT ... SELECT computing the eras of one era table."""
+        query, target_columns, select_columns, natural_key = self._era_query(era, window_size, person_filter, unit, dose)
+        return f"""{query}
+        INSERT INTO {self._schema}.{era} ({', '.join(target_columns)})
+        SELECT DISTINCT ON (e.era_id) {', '.join(select_columns)}
+        FROM keyed AS e
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {self._schema}.{era} AS t WHERE {natural_key}
+        )
+        ORDER BY e.era_id
+        ON CONFLICT DO NOTHING
+        """
+
+    def stage_sql(self, era: str, staging: str, window_size: int, person_filter: str, unit: str = "0", dose: str = "1.0") -> str:
+        """Build the CREATE TABLE ... AS computing the eras of some persons into a staging table."""
+        query, target_columns, select_columns, _ = self._era_query(era, window_size, person_filter, unit, dose)
+        selected = ", ".join(f"{column} AS {target}" for column, target in zip(select_columns, target_columns))
+        return f"""
+        CREATE UNLOGGED TABLE {self._schema}.{staging} AS{query}
+        SELECT DISTINCT ON (e.era_id) {selected}
+        FROM keyed AS e
+        ORDER BY e.era_id
+        """
+
+    def _era_query(self, era: str, window_size: int, person_filter: str = "", unit: str = "0", dose: str = "1.0"):
+        """Build the WITH ... keyed query of the eras, with the target and select columns and the natural key."""
+        spec = ERA_SPECS[era]
+        groups = ["person_id", "concept_id"] + (["unit_concept_id", "dose_value"] if spec["dose"] else [])
+        partition = ", ".join(groups)
+        dose_select = f", {unit} AS unit_concept_id, {dose} AS dose_value" if spec["dose"] else ""
+        fallback_end = "MAX(raw_end) OVER (PARTITION BY person_id), " if spec["person_max_end"] else ""
+        # the era id is derived from the same natural key the pandas backend hashes.
+        source_key = " || '_' || ".join(f"e.{column}::text" for column in groups + ["era_start", "era_end"])
+        era_id = f"(('x' || substr(md5('{era.replace('_', ' ')}_' || {source_key}), 1, 15))::bit(60)::bigint % 1000000000)"
+        target_columns = era_columns(era)
+        select_columns = ["e.era_id", "e.person_id", "e.concept_id"]
+        if spec["dose"]:
+            select_columns += ["e.unit_concept_id", "e.dose_value"]
+        select_columns += ["e.era_start", "e.era_end"]
+        if spec["count"]:
+            select_columns.append("e.exposure_count")
+        if spec["gap_days"]:
+            select_columns.append("e.gap_days")
+        natural_key = " AND ".join(
+            [f"t.person_id = e.person_id", f"t.{spec['concept']} = e.concept_id"]
+            + ([f"t.unit_concept_id = e.unit_concept_id", f"t.dose_value = e.dose_value"] if spec["dose"] else [])
+            + [f"t.{spec['era_start']} = e.era_start", f"t.{spec['era_end']} = e.era_end"]
+        )
+        where = f"WHERE {person_filter}" if person_filter else ""
+        query = f"""
+        WITH source AS (
+            SELECT person_id, {spec['concept']} AS concept_id{dose_select},
+                COALESCE(
+                    {spec['start']},
+                    MIN({spec['start']}) OVER (PARTITION BY person_id),
+                    {spec['end']} - 30
+                ) AS start_date,
+                {spec['end']} AS raw_end
+            FROM {self._schema}.{spec['source']}
+            {where}
+        ), imputed AS (
+            -- rows without any date of their own or of their person get the median start
+            -- date of the scanned rows, as the pandas backend does.
+            SELECT source.*, COALESCE(
+                start_date,
+                (SELECT DATE '1970-01-01' + FLOOR(
+                    PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY start_date - DATE '1970-01-01')
+                )::int FROM source)
+            ) AS imputed_start
+            FROM source
+        ), filled AS (
+            -- end dates before the start are moved to the start, as in the pandas backend.
+            SELECT {partition}, imputed_start AS start_date,
+                GREATEST(COALESCE(raw_end, {fallback_end}imputed_start + 30), imputed_start) AS end_date
+            FROM imputed
+            WHERE imputed_start IS NOT NULL
+        ), {collapse_ctes(partition, window_size)}, keyed AS (
+            SELECT e.*, {era_id} AS era_id
+            FROM eras AS e
+        )"""
+        return query, target_columns, select_columns, natural_key
+
+    def build(self, era: str, window_size: int = 30, person_ids: Optional[set] = None) -> int:
+        """
+        Compute the eras of one era table in the database and return the number of rows inserted.
+        When person_ids is given, only the eras of those persons are rebuilt.
+        """
+        spec = ERA_SPECS[era]
+        unit, dose = self.dose_columns(spec["source"]) if spec["dose"] else ("0", "1.0")
+        if person_ids is None:
+            inserted = self._query_utils.execute_sql(self.build_sql(era, window_size, unit=unit, dose=dose))
+        else:
+            # the eras of every chunk of persons are computed into a staging table and swapped
+            # in one statement, so a failure never leaves those persons without eras.
+            staging = f"stg_{era}_{os.getpid()}"
+            inserted = 0
+            try:
+                for ids in self._query_utils.person_chunks(person_ids):
+                    self._query_utils.execute_sql(f"DROP TABLE IF EXISTS {self._schema}.{staging}")
+                    self._query_utils.execute_sql(
+                        self.stage_sql(era, staging, window_size, f"person_id IN ({ids})", unit=unit, dose=dose)
+                    )
+                    inserted += self._query_utils.execute_sql(
+                        self._query_utils.replace_person_rows_sql(era, staging, f"{era}_id", era_columns(era), ids)
+                    )
+            finally:
+                self._query_utils.execute_sql(f"DROP TABLE IF EXISTS {self._schema}.{staging}")
+        logging.info(f"Inserted {inserted} rows into '{self._schema}.{era}' in the database.")
+        return inserted
+
+
+def collapse_ctes(partition: str, window_size: int) -> str:
+    """
+    Gaps-and-islands CTEs collapsing ``filled`` (the partition columns, start_date and
+    end_date) into ``eras``: a row starts a new era when it starts more than ``window_size``
+    days after the latest end date so far, and the running SUM of the starts numbers the eras.
+    ``gap_days`` is the era length minus the days its exposures cover: every exposure covers
+    the days it runs past the latest end date so far.
+    """
+    return f"""ordered AS (
+            SELECT *,
+                MAX(end_date) OVER (
+                    PARTITION BY {partition} ORDER BY start_date, end_date
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                ) AS previous_end
+            FROM filled
+        ), marked AS (
+            SELECT *,
+                CASE WHEN start_date - previous_end <= {int(window_size)} THEN 0 ELSE 1 END AS new_era
+            FROM ordered
+        ), numbered AS (
+            SELECT *,
+                SUM(new_era) OVER (
+                    PARTITION BY {partition} ORDER BY start_date, end_date
+                    ROWS UNBOUNDED PRECEDING
+                ) AS era,
+                CASE
+                    WHEN new_era = 1 OR start_date >= previous_end THEN end_date - start_date
+                    WHEN end_date <= previous_end THEN 0
+                    ELSE end_date - previous_end
+                END AS covered
+            FROM marked
+        ), eras AS (
+            SELECT {partition}, MIN(start_date) AS era_start, MAX(end_date) AS era_end,
+                COUNT(*) AS exposure_count,
+                MAX(end_date) - MIN(start_date) - SUM(covered) AS gap_days
+            FROM numbered
+            GROUP BY {partition}, era
+        )"""
+
+
+def era_columns(era: str) -> list:
+    """Columns written to an era table, in the order of SqlEraBuilder."""
+    spec = ERA_SPECS[era]
+    columns = [f"{era}_id", "person_id", spec["concept"]]
+    if spec["dose"]:
+        columns += ["unit_concept_id", "dose_value"]
+    columns += [spec["era_start"], spec["era_end"]]
+    if spec["count"]:
+        columns.append(spec["count"])
+    if spec["gap_days"]:
+        columns.append("gap_days")
+    return columns
+
+
+def delete_person_eras(query_utils, era: str, person_ids: set):
+    """Delete the eras of affected persons that have no exposures left."""
+    deleted = query_utils.delete_person_rows(era, person_ids)
+    logging.info(f"Deleted {deleted} {era} rows of {len(person_ids)} affected persons without exposures.")
+
+
+def replace_person_eras(query_utils, push_to_db, schema: str, era: str, data, person_ids: set) -> int:
+    """
+    Replace the eras of the affected persons by the rebuilt ones.
+    The rows are pushed to a staging table first and only swapped in once all of them
+    arrived, one statement per chunk of persons, so a failed push keeps the old eras.
+    Returns the number of inserted rows.
+    """
+    columns = [column for column in era_columns(era) if column in data.columns]
+    staging = StagingMerge(query_utils, push_to_db, schema)
+    return asyncio.run(staging.replace_persons(data, era, f"{era}_id", columns, person_ids))
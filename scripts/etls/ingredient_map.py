@@ -0,0 +1,108 @@
+import os
+import re
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# roll drug concepts up to their ingredients before drug eras are collapsed.
+INGREDIENT_ROLLUP = os.getenv("INGREDIENT_ROLLUP", "false").lower() in ("1", "true", "yes")
+# directory holding one cached ingredient map per vocabulary version.
+INGREDIENT_CACHE_DIR = os.getenv("INGREDIENT_CACHE_DIR", ".cache")
+
+
+class IngredientMap:
+    """
+    Drug concept -> RxNorm ingredient lookup built from concept_ancestor.
+
+    The map is two int32 arrays sorted by drug concept. A drug made of several
+    ingredients appears once per ingredient. It is built once per vocabulary version
+    and cached as a Parquet file, so era runs never join the vocabulary themselves.
+    """
+
+    def __init__(self, concepts: np.ndarray, ingredients: np.ndarray):
+        """
+        Initialise the IngredientMap class.
+        Args:
+            concepts: array - Drug concept ids.
+            ingredients: array - Ingredient concept id of every drug concept, same length.
+        """
+        order = np.lexsort((ingredients, concepts))
+        self._concepts = np.asarray(concepts, dtype=np.int32)[order]
+        self._ingredients = np.asarray(ingredients, dtype=np.int32)[order]
+
+    def __len__(self):
+        return len(self._concepts)
+
+    @staticmethod
+    def cache_path(cache_dir: str, version: str) -> str:
+        """Path of the cached map of a vocabulary version."""
+        safe_version = re.sub(r"[^A-Za-z0-9._-]+", "_", version)
+        return os.path.join(cache_dir, f"ingredient_map_{safe_version}.parquet")
+
+    @classmethod
+    def read(cls, path: str):
+        """Read a cached map."""
+        table = pq.read_table(path)
+        return cls(
+            table.column("descendant_concept_id").to_numpy(),
+            table.column("ingredient_concept_id").to_numpy(),
+        )
+
+    def write(self, path: str):
+        """Write the map to a Parquet file."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        table = pa.table({
+            "descendant_concept_id": pa.array(self._concepts, type=pa.int32()),
+            "ingredient_concept_id": pa.array(self._ingredients, type=pa.int32()),
+        })
+        tmp_path = f"{path}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, query_utils, cache_dir: str = INGREDIENT_CACHE_DIR):
+        """Load the map of the current vocabulary version, building and caching it when missing."""
+        version = query_utils.retrieve_vocabulary_version() or "unknown"
+        path = cls.cache_path(cache_dir, version)
+        if os.path.exists(path):
+            return cls.read(path)
+        logging.info(f"Building the ingredient map for vocabulary version {version}.")
+        ancestors = query_utils.retrieve_ingredient_ancestors()
+        ingredient_map = cls(
+            ancestors['descendant_concept_id'].to_numpy(dtype=np.int64),
+            ancestors['ingredient_concept_id'].to_numpy(dtype=np.int64),
+        )
+        ingredient_map.write(path)
+        logging.info(f"Cached {len(ingredient_map)} ingredient mappings in {path}.")
+        return ingredient_map
+
+    def roll_up(self, data: pd.DataFrame, column: str = 'drug_concept_id') -> pd.DataFrame:
+        """
+        Replace the drug concepts of a frame by their ingredients.
+        Rows of multi-ingredient drugs are repeated once per ingredient; concepts without
+        an ingredient keep their own id.
+        """
+        if not len(self) or data.empty:
+            return data.copy()
+        concepts = data[column].to_numpy(dtype=np.int64)
+        left = np.searchsorted(self._concepts, concepts, side='left')
+        right = np.searchsorted(self._concepts, concepts, side='right')
+        matches = right - left
+        repeats = np.maximum(matches, 1)
+        rows = np.repeat(np.arange(len(data)), repeats)
+        # position of every output row inside the ingredient range of its source row.
+        within = np.arange(len(rows)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        positions = np.repeat(left, repeats) + within
+        mapped = np.repeat(matches > 0, repeats)
+        rolled = data.iloc[rows].reset_index(drop=True)
+        rolled[column] = np.where(
+            mapped,
+            self._ingredients[np.minimum(positions, len(self) - 1)],
+            np.repeat(concepts, repeats),
+        ).astype(np.int64)
+        return rolled
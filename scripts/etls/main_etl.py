@@ -10,6 +10,7 @@ from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
 from Crypto.Util.Padding import pad, unpad
 import base64
+import csv
 import os
 import hashlib
 from .cdm_schema import CDM_SCHEMA
@@ -18,19 +19,34 @@ load_dotenv()
 env_key=os.getenv('ENCRYPT_KEY')
 SECRET_KEY=hashlib.sha256(env_key.encode()).digest()[:16]
 
+# number of leading bytes checksummed to detect rewritten source files.
+WATERMARK_HEAD_BYTES = 65536
+
 class ETLEntity(ABC):
-    def __init__(self, file_path: str, table_name: str, fields_map: Optional[list] = None, chunk_size: int = 100000):
+    def __init__(
+        self,
+        file_path: str,
+        table_name: str,
+        fields_map: Optional[list] = None,
+        chunk_size: int = 100000,
+        watermark: Optional[dict] = None,
+    ):
         """
         Initialise the AbstractEntity class.
         Args:
             file_path: str - This defines the file path.
             fields_map: list - This defines the fields to be mapped.
             omop_table: str - This defines the table we are mapping to.
+            watermark: dict - The watermark of the previous run. When given, only the
+                rows appended to the file since that run are read. An empty dict reads
+                the whole file but still records a new watermark.
         """
         self._path = file_path
         self._fields_map = fields_map if fields_map else []
         self._chunk_size = chunk_size
         self._target_table = table_name
+        self._watermark = watermark
+        self._new_watermark: Optional[dict] = None
         # Initialize data as DataFrames
         self._source_data = pd.DataFrame(columns=self._fields_map)
         self._omop_data = pd.DataFrame(columns=self._fields_map)
@@ -38,12 +54,15 @@ class ETLEntity(ABC):
     def load_data(self):
         """Load the source data from the file path."""
         try:
-            chunks = pd.read_csv(self._path, chunksize=self._chunk_size, low_memory=False)
-            # list to hold chunk while loading.
-            df_list = []
-            for chunk in tqdm(chunks, desc=f"Reading CSV for {self._target_table} in chunks..."):
-                df_list.append(chunk)
-            self._source_data = pd.concat(df_list, ignore_index=True).rename(columns=str.lower)
+            if self._watermark is not None:
+                self._source_data = self._load_appended_rows()
+            else:
+                chunks = pd.read_csv(self._path, chunksize=self._chunk_size, low_memory=False)
+                # list to hold chunk while loading.
+                df_list = []
+                for chunk in tqdm(chunks, desc=f"Reading CSV for {self._target_table} in chunks..."):
+                    df_list.append(chunk)
+                self._source_data = pd.concat(df_list, ignore_index=True).rename(columns=str.lower)
             logging.info(f"Data loaded successfully\n\n")
         
         except FileNotFoundError:
@@ -55,6 +74,68 @@ class ETLEntity(ABC):
         except Exception as e:
             logging.error(f"Unexpected error loading data: {e}")
 
+    def _load_appended_rows(self):
+        """Read only the rows appended after the stored watermark.
+
+        The watermark holds the byte offset reached by the previous run, the number of
+        rows read so far, the header and a checksum of the head of the file. When the
+        file was truncated or rewritten the whole file is read again.
+        """
+        with open(self._path, "rb") as handle:
+            header_line = handle.readline()
+            header = header_line.decode("utf-8").strip()
+            file_size = os.fstat(handle.fileno()).st_size
+
+            offset = self._watermark.get("offset", 0)
+            previous_rows = self._watermark.get("rows", 0)
+            unchanged = (
+                self._watermark.get("header") == header
+                and len(header_line) <= offset <= file_size
+                and self._head_checksum(handle, self._watermark.get("head_length", 0))
+                == self._watermark.get("head_sha256")
+            )
+            if not unchanged:
+                if self._watermark:
+                    logging.warning(f"{self._path} was rewritten since the last run; reading the whole file.")
+                offset = len(header_line)
+                previous_rows = 0
+
+            columns = next(csv.reader([header]))
+            df_list = []
+            end_offset = offset
+            if offset < file_size:
+                handle.seek(offset)
+                chunks = pd.read_csv(
+                    handle, names=columns, header=None, chunksize=self._chunk_size, low_memory=False
+                )
+                for chunk in tqdm(chunks, desc=f"Reading new CSV rows for {self._target_table} in chunks..."):
+                    df_list.append(chunk)
+                end_offset = handle.tell()
+            head_length = min(WATERMARK_HEAD_BYTES, end_offset)
+            head_checksum = self._head_checksum(handle, head_length)
+
+        data = pd.concat(df_list, ignore_index=True) if df_list else pd.DataFrame(columns=columns)
+        data = data.rename(columns=str.lower)
+        logging.info(f"Read {len(data)} new rows from {self._path} (skipped {previous_rows} rows already processed).")
+        self._new_watermark = {
+            "offset": end_offset,
+            "rows": previous_rows + len(data),
+            "header": header,
+            "head_length": head_length,
+            "head_sha256": head_checksum,
+        }
+        return data
+
+    @staticmethod
+    def _head_checksum(handle, length: int):
+        """Checksum the first bytes of the file to detect rewritten files."""
+        handle.seek(0)
+        return hashlib.sha256(handle.read(length)).hexdigest()
+
+    def get_watermark(self):
+        """Get the watermark reached by the last incremental read."""
+        return self._new_watermark
+
     def set_fields(self, fields):
         """Set the fields."""
         self._fields_map = fields
@@ -127,6 +208,9 @@ class ETLEntity(ABC):
     def run_mapping(self, fields):
         """Run the complete mapping process."""
         self.load_data()
+        if self._watermark is not None and self._source_data.empty:
+            logging.info(f"No new rows for {self._target_table} since the last run.")
+            return
         self.set_fields(fields=fields)
         self.map_data()
         self.map_data_to_fields()
@@ -46,6 +46,8 @@ class ConnectToDatabase:
         self._schema = db_schema
         self._vocab_schema = vocab_schema or db_schema
         self._db_connector = importr('DatabaseConnector')
+        # visit key index shared by the clinical loaders; rebuilt after visits are loaded.
+        self._visit_index = None
         self.create_connection()
 
     def create_connection(self):
@@ -60,3 +62,20 @@ class ConnectToDatabase:
         self._db_loader = CSVLoader(self._conn, self._conn_details)
 
         
+
+    def open_native_connection(self):
+        """
+        Open a psycopg connection to the same database, for streaming reads (COPY TO STDOUT,
+        server-side cursors) that should not go through R. The caller closes it.
+        """
+        import psycopg
+
+        # DatabaseConnector accepts "host/database" as the server of a PostgreSQL connection.
+        host = self._server.split("/")[0] if self._server else None
+        return psycopg.connect(
+            host=host,
+            port=self._port,
+            dbname=self._database,
+            user=self._user,
+            password=self._password,
+        )
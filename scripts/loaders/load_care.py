@@ -44,4 +44,5 @@ class LoadCareSite(LoadOmoppedData):
             logging.info(f"Loaded data into table '{self._schema}.{self._table}'.")
 
         except Exception as e:
-            logging.error(f"Failed to load data into table: {e}")
\ No newline at end of file
+            logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
\ No newline at end of file
@@ -31,28 +31,30 @@ class LoadCondition(LoadOmoppedData):
         """Load condition into condition occurrence table."""
         try:
             query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
-            condition_era_etl = ConditionEraETL(query_utils, self.push_to_db, self._schema)
-            # retrieve person records
-            queried_person = query_utils.retrieve_persons()
-            # join both tables using inner join.
-            self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
-            # retrieve past conditions
-            queried_conditions = query_utils.retrieve_conditions()
-            # get unique conditions.
-            existing_conditions = set(queried_conditions['condition_occurrence_id'])
-            # get existing visits
-            filtered_data = self._omopped_data[
-                ~self._omopped_data['condition_occurrence_id'].isin(existing_conditions)
-            ]
-            # check if there are new records to insert
-            if filtered_data.empty:
-                logging.info("No new data to insert for condition occurrence; all records already exist in the target table.")
-                condition_era_etl.build(condition_window_size)
-                return
+            if self.use_staging():
+                # existing rows, persons and visits are resolved inside the database.
+                filtered_data = self._omopped_data.copy()
+            else:
+                # retrieve person records
+                queried_person = query_utils.retrieve_persons()
+                # join both tables using inner join.
+                self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
+                # retrieve past conditions
+                queried_conditions = query_utils.retrieve_conditions()
+                # get unique conditions.
+                existing_conditions = set(queried_conditions['condition_occurrence_id'])
+                # get existing visits
+                filtered_data = self._omopped_data[
+                    ~self._omopped_data['condition_occurrence_id'].isin(existing_conditions)
+                ]
+                # check if there are new records to insert
+                if filtered_data.empty:
+                    logging.info("No new data to insert for condition occurrence; all records already exist in the target table.")
+                    return
             
-            queried_visits = query_utils.retrieve_visits()
-            # merge
-            filtered_data = filtered_data.merge(queried_visits, on='visit_source_value', how='left')
+            if not self.use_staging():
+                # resolve visits through the shared visit key index
+                filtered_data = self.resolve_visits(query_utils, filtered_data)
             # convert the condition source concept id to string
             filtered_data['condition_source_concept_id'] = filtered_data['condition_source_concept_id'].astype(str)
             # get the concept id
@@ -66,16 +68,28 @@ class LoadCondition(LoadOmoppedData):
             filtered_data['condition_source_concept_id'] = filtered_data['condition_source_concept_id'].map(unique_source_concept_id).astype(int)
             # strip the length
             filtered_data['condition_source_value'] = filtered_data['condition_source_value'].apply(query_utils.strip_length)
-            filtered_data.drop(columns=['person_source_value', 'visit_source_value'], inplace=True)            
-            # only keep the columns that are not duplicates
-            filtered_data = filtered_data.drop_duplicates(subset=['condition_occurrence_id'], keep='first')
-            # push the filtered data to the database
-            asyncio.run(self.push_to_db(
-                batch_size=250000,
-                data=filtered_data,
-                table_name=self._table
-            ))            
+            if self.use_staging():
+                self.merge_staged(query_utils, filtered_data, key='condition_occurrence_id')
+            else:
+                filtered_data.drop(columns=['person_source_value', 'visit_source_value'], inplace=True)            
+                # only keep the columns that are not duplicates
+                filtered_data = filtered_data.drop_duplicates(subset=['condition_occurrence_id'], keep='first')
+                # push the filtered data to the database
+                asyncio.run(self.push_to_db(
+                    batch_size=250000,
+                    data=filtered_data,
+                    table_name=self._table
+                ))            
             logging.info(f"Loaded data into table '{self._schema}.{self._table}'.")
-            condition_era_etl.build(condition_window_size)
         except Exception as e:
             logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
+
+    def load_era_data(self):
+        """Load condition era data; run by the post-load stage once condition occurrences are loaded."""
+        self.load_condition_era(condition_window_size)
+
+    def load_condition_era(self, window_size: int = condition_window_size):
+        """Load condition era data into OMOP condition era table."""
+        query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
+        ConditionEraETL(query_utils, self.push_to_db, self._schema).build(window_size, person_ids=self._affected_persons)
@@ -48,3 +48,4 @@ class LoadDeath(LoadOmoppedData):
 
         except Exception as e:
             logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
@@ -12,6 +12,7 @@ from dotenv import load_dotenv
 import os
 from scripts.etls.drug_era_etl import DrugEraETL
 from scripts.etls.dose_era_etl import DoseEraETL
+from scripts.etls.drug_era_stage import DrugEraStage
 
 load_dotenv()
 
@@ -34,36 +35,34 @@ class LoadDrug(LoadOmoppedData):
         """Load drug exposure data into OMOP drug exposure table."""
         try:
             query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
-            drug_era_etl = DrugEraETL(query_utils, self.push_to_db, self._schema)
-            dose_era_etl = DoseEraETL(query_utils, self.push_to_db, self._schema)
-            # retrieve person records
-            queried_person = query_utils.retrieve_persons()
-            # join both tables using inner join.
-            self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
-            # retrieve past drug records
-            queried_drugs = query_utils.retrieve_drugs()
-            # get unique drugs.
-            existing_drugs = set(queried_drugs['drug_exposure_id'])
-            # query existing drugs
-            filtered_data = self._omopped_data[
-                ~self._omopped_data['drug_exposure_id'].isin(existing_drugs)
-            ]
-            # check if there are new records to insert
-            if filtered_data.empty:
-                logging.info("No new data to insert for drug exposure; all records already exist in the target table.")
-                # load data into the drug era table.
-                drug_era_etl.build(drug_window_size)
-                dose_era_etl.build(dose_window_size)
-                return
+            if self.use_staging():
+                # existing rows, persons and visits are resolved inside the database.
+                filtered_data = self._omopped_data.copy()
+            else:
+                # retrieve person records
+                queried_person = query_utils.retrieve_persons()
+                # join both tables using inner join.
+                self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
+                # retrieve past drug records
+                queried_drugs = query_utils.retrieve_drugs()
+                # get unique drugs.
+                existing_drugs = set(queried_drugs['drug_exposure_id'])
+                # query existing drugs
+                filtered_data = self._omopped_data[
+                    ~self._omopped_data['drug_exposure_id'].isin(existing_drugs)
+                ]
+                # check if there are new records to insert
+                if filtered_data.empty:
+                    logging.info("No new data to insert for drug exposure; all records already exist in the target table.")
+                    return
             
             filtered_data = filtered_data.copy()
             filtered_data.loc[:, 'drug_exposure_start_date'] = filtered_data['drug_exposure_start_date'].fillna(filtered_data['drug_exposure_end_date'])
             filtered_data.loc[:, 'drug_exposure_start_date'].fillna(pd.to_datetime('2000-01-01'))
             filtered_data.loc[:, 'drug_exposure_end_date'] = filtered_data['drug_exposure_end_date'].fillna(filtered_data['drug_exposure_start_date'])
-            # retrieve visits
-            queried_visits = query_utils.retrieve_visits()
-            # merge
-            filtered_data = filtered_data.merge(queried_visits, on='visit_source_value', how='left')
+            if not self.use_staging():
+                # resolve visits through the shared visit key index
+                filtered_data = self.resolve_visits(query_utils, filtered_data)
             filtered_data['drug_source_concept_id'] = filtered_data['drug_source_concept_id'].astype(str)
             # retrieve concept id
             unique_concepts = filtered_data['drug_source_concept_id'].unique()
@@ -77,20 +76,41 @@ class LoadDrug(LoadOmoppedData):
             filtered_data['drug_source_concept_id'] = filtered_data['drug_source_concept_id'].map(source_concept_id_map).astype(int)
             # strip the length
             filtered_data['drug_source_value'] = filtered_data['drug_source_value'].apply(query_utils.strip_length)
-            # drop columns that are not needed
-            filtered_data.drop(columns=['person_source_value', 'visit_source_value'], inplace=True)            
-            # only keep the columns that are not duplicates
-            filtered_data = filtered_data.drop_duplicates(subset=['drug_exposure_id'], keep='first')
-            # push the filtered data to the database
-            asyncio.run(self.push_to_db(
-                batch_size=250000,
-                data=filtered_data,
-                table_name=self._table
-            ))
-            # load data into the drug era table.            
+            if self.use_staging():
+                self.merge_staged(query_utils, filtered_data, key='drug_exposure_id')
+            else:
+                # drop columns that are not needed
+                filtered_data.drop(columns=['person_source_value', 'visit_source_value'], inplace=True)            
+                # only keep the columns that are not duplicates
+                filtered_data = filtered_data.drop_duplicates(subset=['drug_exposure_id'], keep='first')
+                # push the filtered data to the database
+                asyncio.run(self.push_to_db(
+                    batch_size=250000,
+                    data=filtered_data,
+                    table_name=self._table
+                ))
             logging.info(f"Loaded data into table '{self._schema}.{self._table}'.")
-            drug_era_etl.build(drug_window_size)
-            dose_era_etl.build(dose_window_size)
 
         except Exception as e:
             logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
+
+    def load_era_data(self):
+        """
+        Load drug era and dose era data from one shared drug exposure scan.
+        Run by the post-load stage once every drug exposure entry (medications, immunizations) has been loaded.
+        """
+        query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
+        DrugEraStage(query_utils, self.push_to_db, self._schema).build(
+            drug_window_size, dose_window_size, person_ids=self._affected_persons
+        )
+
+    def load_drug_era_data(self, window_size: int = drug_window_size):
+        """Load drug era data into OMOP drug era table."""
+        query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
+        DrugEraETL(query_utils, self.push_to_db, self._schema).build(window_size, person_ids=self._affected_persons)
+
+    def load_dose_era_data(self, window_size: int = dose_window_size):
+        """Load dose era data into OMOP dose era table."""
+        query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
+        DoseEraETL(query_utils, self.push_to_db, self._schema).build(window_size, person_ids=self._affected_persons)
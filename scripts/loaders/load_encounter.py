@@ -7,6 +7,7 @@ import rpy2.robjects as ro
 from rpy2.robjects.packages import importr
 from rpy2.robjects import pandas2ri
 from .query_utils import QueryUtils
+from .staging import StagingMerge
 import asyncio
 
 # Configure logging
@@ -17,6 +18,16 @@ class LoadEncounter(LoadOmoppedData):
         """Load encounter data into the OMOP visit occurrence table."""
         try:
             query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
+            if self._affected_persons is not None:
+                # incremental runs map the whole history of the persons with new encounters.
+                self.replace_visits(query_utils)
+                return
+            if self.use_staging():
+                # person, provider and care site ids are resolved inside the database.
+                if self.merge_staged(query_utils, self._omopped_data, key='visit_occurrence_id'):
+                    self.invalidate_visit_index()
+                logging.info(f"Loaded data into table '{self._schema}.{self._table}'.")
+                return
             # retrieve person records
             queried_person = query_utils.retrieve_persons()
             # join both tables using inner join.
@@ -56,7 +67,39 @@ class LoadEncounter(LoadOmoppedData):
                 data=filtered_data,
                 table_name=self._table
             ))            
+            if self.rows_loaded:
+                # the clinical loaders must see the new visits.
+                self.invalidate_visit_index()
             logging.info(f"Loaded data into table '{self._schema}.{self._table}'.")
 
         except Exception as e:
-            logging.error(f"Failed to load data into table: {e}")
\ No newline at end of file
+            logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
+
+    def replace_visits(self, query_utils):
+        """
+        Replace the visits of the persons in the mapped data, which holds all of their visits.
+        Visits extended or merged by new encounters are updated or removed and new ones are
+        inserted, so the persons end up with the visits of a full run.
+        """
+        queried_person = query_utils.retrieve_persons()
+        data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
+        data = data.merge(query_utils.retrieve_providers(), on='provider_source_value', how='left')
+        data = data.merge(query_utils.retrieve_care_sites(), on='care_site_source_value', how='left')
+        data = data.drop(columns=['person_source_value', 'provider_source_value', 'care_site_source_value'])
+        data = data.drop_duplicates(subset=['visit_occurrence_id'], keep='first')
+        if data.empty:
+            logging.info("No visits to replace in visit occurrence.")
+            return
+        target_columns = set(query_utils.retrieve_table_columns(self._table)['column_name'])
+        columns = [column for column in data.columns if column in target_columns]
+        person_ids = {int(value) for value in data['person_id'].dropna()}
+        staging = StagingMerge(query_utils, self._db_loader.bulk_load_data, self._schema)
+        inserted = asyncio.run(staging.replace_persons(data, self._table, 'visit_occurrence_id', columns, person_ids))
+        self.rows_loaded += inserted
+        if self._manifest is not None and inserted:
+            self._manifest.record_batch(self._manifest_key, self._table, inserted)
+        self._affected_persons.update(person_ids)
+        # ids of merged visits may be gone; the clinical loaders must not resolve them.
+        self.invalidate_visit_index()
+        logging.info(f"Replaced the visits of {len(person_ids)} persons in '{self._schema}.{self._table}'.")
\ No newline at end of file
@@ -17,26 +17,29 @@ class LoadMeasurement(LoadOmoppedData):
         """Load measurement data into the OMOP Measurement table."""
         try:
             query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
-            # retrieve person records
-            queried_person = query_utils.retrieve_persons()
-            # join both tables using inner join.
-            self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
-            # retrieve past measurement records
-            queried_measurements = query_utils.retrieve_measurements()
-            # get unique measurements.
-            existing_measurements = set(queried_measurements['measurement_id'])
-            # query existing measurements
-            filtered_data = self._omopped_data[
-                ~self._omopped_data['measurement_id'].isin(existing_measurements)
-            ]
-            # check if there are new records to insert
-            if filtered_data.empty:
-                logging.info("No new data to insert for measurement; all records already exist in the target table.")
-                return     
-            # retrieve visits
-            queried_visits = query_utils.retrieve_visits()
-            # merge on visit source value
-            filtered_data = filtered_data.merge(queried_visits, on='visit_source_value', how='left')
+            if self.use_staging():
+                # existing rows, persons and visits are resolved inside the database.
+                filtered_data = self._omopped_data.copy()
+            else:
+                # retrieve person records
+                queried_person = query_utils.retrieve_persons()
+                # join both tables using inner join.
+                self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
+                # retrieve past measurement records
+                queried_measurements = query_utils.retrieve_measurements()
+                # get unique measurements.
+                existing_measurements = set(queried_measurements['measurement_id'])
+                # query existing measurements
+                filtered_data = self._omopped_data[
+                    ~self._omopped_data['measurement_id'].isin(existing_measurements)
+                ]
+                # check if there are new records to insert
+                if filtered_data.empty:
+                    logging.info("No new data to insert for measurement; all records already exist in the target table.")
+                    return     
+            if not self.use_staging():
+                # resolve visits through the shared visit key index
+                filtered_data = self.resolve_visits(query_utils, filtered_data)
             # get measurement unique concepts
             filtered_data['measurement_concept_id'] = filtered_data['measurement_concept_id'].astype(str)
             # get the unique concept id
@@ -66,17 +69,21 @@ class LoadMeasurement(LoadOmoppedData):
             filtered_data['measurement_type_concept_id'] = filtered_data['measurement_type_concept_id'].map(unique_type_id).astype(int)
             # strip the length
             filtered_data['measurement_source_value'] = filtered_data['measurement_source_value'].apply(query_utils.strip_length)
-            # drop columns that are not needed 
-            filtered_data.drop(columns=['person_source_value', 'visit_source_value'], inplace=True)            
-            # only keep the columns that are not duplicates
-            filtered_data = filtered_data.drop_duplicates(subset=['measurement_id'], keep='first')
-            # push the filtered data to the database
-            asyncio.run(self.push_to_db(
-                batch_size=250000,
-                data=filtered_data,
-                table_name=self._table
-            ))            
+            if self.use_staging():
+                self.merge_staged(query_utils, filtered_data, key='measurement_id')
+            else:
+                # drop columns that are not needed 
+                filtered_data.drop(columns=['person_source_value', 'visit_source_value'], inplace=True)            
+                # only keep the columns that are not duplicates
+                filtered_data = filtered_data.drop_duplicates(subset=['measurement_id'], keep='first')
+                # push the filtered data to the database
+                asyncio.run(self.push_to_db(
+                    batch_size=250000,
+                    data=filtered_data,
+                    table_name=self._table
+                ))            
             logging.info(f"Loaded data into table '{self._schema}.{self._table}'.")
 
         except Exception as e:
             logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
@@ -59,3 +59,36 @@ class LoadObservationPeriod(LoadOmoppedData):
 
         except Exception as e:
             logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
+
+    def recompute_periods(self):
+        """
+        Widen the observation periods so they cover every visit of the person.
+        Run by the post-load stage once visits are loaded; limited to the affected persons when they are known.
+        """
+        query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
+        if self._affected_persons is None:
+            filters = [""]
+        elif not self._affected_persons:
+            logging.info("No persons affected by this load; observation periods are unchanged.")
+            return
+        else:
+            filters = [f"WHERE person_id IN ({ids})" for ids in query_utils.person_chunks(self._affected_persons)]
+        updated = 0
+        for person_filter in filters:
+            updated += query_utils.execute_sql(f"""
+            UPDATE {self._schema}.observation_period AS op
+            SET observation_period_start_date = LEAST(op.observation_period_start_date, v.visit_start_date),
+                observation_period_end_date = GREATEST(op.observation_period_end_date, v.visit_end_date)
+            FROM (
+                SELECT person_id, MIN(visit_start_date) AS visit_start_date,
+                    MAX(COALESCE(visit_end_date, visit_start_date)) AS visit_end_date
+                FROM {self._schema}.visit_occurrence
+                {person_filter}
+                GROUP BY person_id
+            ) AS v
+            WHERE op.person_id = v.person_id
+              AND (op.observation_period_start_date > v.visit_start_date
+                   OR op.observation_period_end_date < v.visit_end_date)
+            """)
+        logging.info(f"Recomputed {updated} observation periods in '{self._schema}.observation_period'.")
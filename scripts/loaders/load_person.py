@@ -67,3 +67,4 @@ class LoadPerson(LoadOmoppedData):
 
         except Exception as e:
             logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
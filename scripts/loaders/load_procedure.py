@@ -17,26 +17,30 @@ class LoadProcedure(LoadOmoppedData):
         """Load procedure occurrence data."""
         try:
             query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
-            # retrieve person records
-            queried_person = query_utils.retrieve_persons()
-            # join both tables using inner join.
-            self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
-            # retrieve past procedures
-            queried_procedures = query_utils.retrieve_procedures()
-            # get unique procedures.
-            existing_procedures = set(queried_procedures['procedure_occurrence_id'])
-            # get existing visits
-            filtered_data = self._omopped_data[
-                ~self._omopped_data['procedure_occurrence_id'].isin(existing_procedures)
-            ]
-            # check if there are new records to insert
-            if filtered_data.empty:
-                logging.info("No new data to insert for procedure occurrence; all records already exist in the target table.")
-                return
+            if self.use_staging():
+                # existing rows, persons and visits are resolved inside the database.
+                filtered_data = self._omopped_data.copy()
+            else:
+                # retrieve person records
+                queried_person = query_utils.retrieve_persons()
+                # join both tables using inner join.
+                self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
+                # retrieve past procedures
+                queried_procedures = query_utils.retrieve_procedures()
+                # get unique procedures.
+                existing_procedures = set(queried_procedures['procedure_occurrence_id'])
+                # get existing visits
+                filtered_data = self._omopped_data[
+                    ~self._omopped_data['procedure_occurrence_id'].isin(existing_procedures)
+                ]
+                # check if there are new records to insert
+                if filtered_data.empty:
+                    logging.info("No new data to insert for procedure occurrence; all records already exist in the target table.")
+                    return
             
-            queried_visits = query_utils.retrieve_visits()
-            # merge
-            filtered_data = filtered_data.merge(queried_visits, on='visit_source_value', how='left')
+            if not self.use_staging():
+                # resolve visits through the shared visit key index
+                filtered_data = self.resolve_visits(query_utils, filtered_data)
             # convert the procedure source concept id to string
             filtered_data['procedure_source_concept_id'] = filtered_data['procedure_source_concept_id'].astype(str)
             # get the concept id
@@ -50,17 +54,21 @@ class LoadProcedure(LoadOmoppedData):
             filtered_data['procedure_source_concept_id'] = filtered_data['procedure_source_concept_id'].map(unique_source_concept_id).astype(int)
             # strip the length
             filtered_data['procedure_source_value'] = filtered_data['procedure_source_value'].apply(query_utils.strip_length)
-            # drop columns that are not needed 
-            filtered_data.drop(columns=['person_source_value', 'visit_source_value'], inplace=True)            
-            # only keep the columns that are not duplicates
-            filtered_data = filtered_data.drop_duplicates(subset=['procedure_occurrence_id'], keep='first')
-            # push the filtered data to the database
-            asyncio.run(self.push_to_db(
-                batch_size=250000,
-                data=filtered_data,
-                table_name=self._table
-            ))            
+            if self.use_staging():
+                self.merge_staged(query_utils, filtered_data, key='procedure_occurrence_id')
+            else:
+                # drop columns that are not needed 
+                filtered_data.drop(columns=['person_source_value', 'visit_source_value'], inplace=True)            
+                # only keep the columns that are not duplicates
+                filtered_data = filtered_data.drop_duplicates(subset=['procedure_occurrence_id'], keep='first')
+                # push the filtered data to the database
+                asyncio.run(self.push_to_db(
+                    batch_size=250000,
+                    data=filtered_data,
+                    table_name=self._table
+                ))            
             logging.info(f"Loaded data into table '{self._schema}.{self._table}'.")
 
         except Exception as e:
-            logging.error(f"Failed to load data into table: {e}")
\ No newline at end of file
+            logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
\ No newline at end of file
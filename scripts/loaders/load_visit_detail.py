@@ -18,29 +18,29 @@ class LoadVisitDetails(LoadOmoppedData):
         """Load encounter data into the OMOP visit details table."""
         try:
             query_utils = QueryUtils(self._conn, self._schema, self._table, self.get_csv_loader(), self._vocab_schema)
-            # retrieve person records
-            queried_person = query_utils.retrieve_persons()
-            # join both tables using inner join.
-            self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
-            # retrieve past visit details
-            queried_details = query_utils.retrieve_visit_details()
-            # get unique visit details.
-            existing_details = set(queried_details['visit_detail_id'])
-            # get existing visits
-            filtered_data = self._omopped_data[
-                ~self._omopped_data['visit_detail_id'].isin(existing_details)
-            ]
-            # check if there are new records to insert
-            queried_visits = query_utils.retrieve_visits()
-            sorted_data = filtered_data.sort_values(by='visit_source_value')
-            # get the unique visit source values
-            sorted_visits = queried_visits.sort_values(by='visit_source_value')
-            # merge
-            filtered_data = sorted_data.merge(sorted_visits, on='visit_source_value', how='inner')
+            if self.use_staging():
+                # existing rows, persons, visits, care sites and providers are resolved inside the database.
+                filtered_data = self._omopped_data.copy()
+            else:
+                # retrieve person records
+                queried_person = query_utils.retrieve_persons()
+                # join both tables using inner join.
+                self._omopped_data = self._omopped_data.merge(queried_person, on='person_source_value', how='inner')
+                # retrieve past visit details
+                queried_details = query_utils.retrieve_visit_details()
+                # get unique visit details.
+                existing_details = set(queried_details['visit_detail_id'])
+                # get existing visits
+                filtered_data = self._omopped_data[
+                    ~self._omopped_data['visit_detail_id'].isin(existing_details)
+                ]
+                # check if there are new records to insert
+                # keep the details of known visits, resolved through the shared visit key index
+                filtered_data = self.resolve_visits(query_utils, filtered_data, how='inner')
             
-            if filtered_data.empty:
-                logging.info("No new data to insert for visit occurrence; all records already exist in the target table.")
-                return
+                if filtered_data.empty:
+                    logging.info("No new data to insert for visit occurrence; all records already exist in the target table.")
+                    return
             
             # convert the visit detail source concept id to string
             filtered_data['visit_detail_concept_id'] = filtered_data['visit_detail_concept_id'].astype(str)
@@ -63,10 +63,11 @@ class LoadVisitDetails(LoadOmoppedData):
                     .fillna(0)
                     .astype(int)
                 )
-            # get all care sites
-            queried_care_sites = query_utils.retrieve_care_sites()
-            # merge based on care site
-            filtered_data = filtered_data.merge(queried_care_sites, on='care_site_source_value', how='left')
+            if not self.use_staging():
+                # get all care sites
+                queried_care_sites = query_utils.retrieve_care_sites()
+                # merge based on care site
+                filtered_data = filtered_data.merge(queried_care_sites, on='care_site_source_value', how='left')
             filtered_data['admitted_from_concept_id'] = filtered_data['admitted_from_concept_id'].astype(str)
             # replace nan with 0
             filtered_data['admitted_from_concept_id'] = filtered_data['admitted_from_concept_id'].replace('nan', '0')
@@ -77,23 +78,32 @@ class LoadVisitDetails(LoadOmoppedData):
             unique_concept_id = query_utils.retrieve_concept_id(code=unique_code, vocabulary=('SNOMED'))
             # merge the concept id
             filtered_data['admitted_from_concept_id'] = filtered_data['admitted_from_concept_id'].map(unique_concept_id).astype(int)
-            # get all providers
-            queried_providers = query_utils.retrieve_providers()
-            # merge based on provider
-            filtered_data = filtered_data.merge(queried_providers, on='provider_source_value', how='left')
-            # drop columns that are not needed 
-            filtered_data.drop(columns=['person_source_value', 'visit_source_value', 'provider_source_value', 'care_site_source_value'], inplace=True)            
-            # only keep the columns that are not duplicates
-            filtered_data = filtered_data.drop_duplicates(subset=['visit_detail_id'], keep='first')
             # # strip the length for admitted from source value.
             filtered_data['admitted_from_source_value'] = filtered_data['admitted_from_source_value'].apply(query_utils.strip_length)
-            # push the filtered data to the database
-            asyncio.run(self.push_to_db(
-                batch_size=250000,
-                data=filtered_data,
-                table_name=self._table
-            ))            
+            if self.use_staging():
+                self.merge_staged(
+                    query_utils,
+                    filtered_data,
+                    key='visit_detail_id',
+                    required=('person_id', 'visit_occurrence_id'),
+                )
+            else:
+                # get all providers
+                queried_providers = query_utils.retrieve_providers()
+                # merge based on provider
+                filtered_data = filtered_data.merge(queried_providers, on='provider_source_value', how='left')
+                # drop columns that are not needed 
+                filtered_data.drop(columns=['person_source_value', 'visit_source_value', 'provider_source_value', 'care_site_source_value'], inplace=True)            
+                # only keep the columns that are not duplicates
+                filtered_data = filtered_data.drop_duplicates(subset=['visit_detail_id'], keep='first')
+                # push the filtered data to the database
+                asyncio.run(self.push_to_db(
+                    batch_size=250000,
+                    data=filtered_data,
+                    table_name=self._table
+                ))            
             logging.info(f"Loaded data into table '{self._schema}.{self._table}'.")
 
         except Exception as e:
             logging.error(f"Failed to load data into table: {e}")
+            self.record_failure(e)
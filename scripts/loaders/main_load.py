@@ -6,17 +6,42 @@ from rpy2.robjects import pandas2ri
 from rpy2 import robjects as ro
 from rpy2.robjects.packages import importr
 from typing import Optional
+from dotenv import load_dotenv
+import asyncio
+import os
+from .staging import StagingMerge
+from .visit_index import VisitKeyIndex
+
+load_dotenv()
+
+# "pandas" resolves ids client side, "staging" merges through UNLOGGED staging tables.
+LOAD_STRATEGY = os.getenv("LOAD_STRATEGY", "pandas").lower()
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)  # Use DEBUG level for detailed logging
 
 class LoadOmoppedData(ABC):
-    def __init__(self, connector: object, omop_data: object, omop_table: str):
+    def __init__(
+        self,
+        connector: object,
+        omop_data: object,
+        omop_table: str,
+        manifest: Optional[object] = None,
+        manifest_key: Optional[str] = None,
+        affected_persons: Optional[set] = None,
+        load_strategy: Optional[str] = None,
+    ):
         """
         Initialize the DatabaseHandler with the given parameters.
         :param omop_data: The OMOP data to be loaded.
         :param omop_table: The target OMOP table name.
+        :param manifest: Optional RunManifest used to record committed batches.
+        :param manifest_key: The pipeline entry the batches are recorded under.
+        :param affected_persons: Optional set shared across an incremental run. The person_ids
+            of every pushed row are added to it and era builders only rebuild those persons.
+        :param load_strategy: "pandas" or "staging"; defaults to the LOAD_STRATEGY setting.
         """
+        self._connector = connector
         self._conn = connector._conn
         self._conn_details = connector._conn_details
         self._schema = connector._schema
@@ -26,6 +51,12 @@ class LoadOmoppedData(ABC):
         self._db_connector = importr('DatabaseConnector')
         self._filtered_data: Optional[object] = None
         self._db_loader = connector._db_loader
+        self._manifest = manifest
+        self._manifest_key = manifest_key or omop_table
+        self._affected_persons = affected_persons
+        self._load_strategy = (load_strategy or LOAD_STRATEGY).lower()
+        # rows this loader added to its own table; a zero count lets the pipeline skip derived tables.
+        self.rows_loaded = 0
     
     def get_csv_loader(self):
         """get the CSVLoader object."""
@@ -39,16 +70,100 @@ class LoadOmoppedData(ABC):
         """
         pass    
     
+    def use_staging(self) -> bool:
+        """Check if the rows are merged through a staging table inside the database."""
+        return self._load_strategy == "staging"
+
+    def merge_staged(self, query_utils, data, key: str, required=("person_id",), batch_size: int = 250000):
+        """
+        Load rows into an UNLOGGED staging table and merge them into the target table.
+        person_id, visit_occurrence_id, provider_id and care_site_id are resolved from the
+        source values and duplicates are skipped by a single INSERT ... SELECT.
+        Returns the number of inserted rows.
+        """
+        staging = StagingMerge(query_utils, self._db_loader.bulk_load_data, self._schema)
+        merged = asyncio.run(staging.load(data, self._table, key, required, batch_size))
+        inserted = int(merged['row_count'].sum()) if not merged.empty else 0
+        self.rows_loaded += inserted
+        if self._manifest is not None and inserted:
+            self._manifest.record_batch(self._manifest_key, self._table, inserted)
+        if self._affected_persons is not None and 'person_id' in merged.columns:
+            self._affected_persons.update(int(value) for value in merged['person_id'].dropna())
+        return inserted
+
+    def visit_index(self, query_utils):
+        """Get the visit key index of the run, built once and kept on the connector."""
+        index = getattr(self._connector, '_visit_index', None)
+        if index is None:
+            index = VisitKeyIndex.load(query_utils, self._schema)
+            self._connector._visit_index = index
+        return index
+
+    def resolve_visits(self, query_utils, data, how: str = 'left'):
+        """Add visit_occurrence_id to the rows by probing the visit key index on visit_source_value."""
+        return self.visit_index(query_utils).resolve(data, how=how)
+
+    def invalidate_visit_index(self):
+        """Drop the visit key index once visit_occurrence has changed."""
+        self._connector._visit_index = None
+
+    def record_failure(self, error):
+        """Record a failed load in the run manifest."""
+        if self._manifest is not None:
+            self._manifest.mark_failed(self._manifest_key, error)
+
+    def track_persons(self, data, table_name):
+        """Remember the persons touched by rows pushed into the loader's own table."""
+        if self._affected_persons is None or table_name != self._table or 'person_id' not in data.columns:
+            return
+        self._affected_persons.update(int(value) for value in data['person_id'].dropna().unique())
+
     async def push_to_db(self, batch_size, data, table_name):
-        """Push data to the database."""
+        """Push data to the database.
+
+        Only pushes into the loader's own table are recorded in the run manifest; other
+        tables (staging tables, derived tables) are pushed without an entry of their own.
+        """
+        if self._manifest is not None and table_name == self._table:
+            return await self._push_batches(batch_size, data, table_name)
         try:
             await self._db_loader.bulk_load_data(
                 batch_size=batch_size,
                 data=data,
                 table_name=table_name
             )
+            self.track_persons(data, table_name)
+            if table_name == self._table:
+                self.rows_loaded += len(data)
             
         except Exception as e:
             logging.error(f"Failed to load data into table: {e}")
         
         return
+
+    async def _push_batches(self, batch_size, data, table_name):
+        """Push data batch by batch, recording every committed batch in the run manifest.
+
+        Rows of batches committed by an interrupted run are already in the target
+        table, so the loaders' existing id filter removes them and the load resumes
+        after the last committed batch.
+        """
+        key = self._manifest_key
+        committed = self._manifest.committed_batches(key)
+        for batch_number, start in enumerate(range(0, len(data), batch_size), start=committed + 1):
+            batch = data.iloc[start:start + batch_size]
+            try:
+                await self._db_loader.bulk_load_data(
+                    batch_size=batch_size,
+                    data=batch,
+                    table_name=table_name
+                )
+            except Exception as e:
+                logging.error(f"Failed to load batch {batch_number} into table: {e}")
+                self._manifest.mark_failed(key, e)
+                return
+            self._manifest.record_batch(key, table_name, len(batch))
+            self.track_persons(batch, table_name)
+            self.rows_loaded += len(batch)
+            logging.info(f"Committed batch {batch_number} ({len(batch)} rows) into '{self._schema}.{table_name}'.")
+        return
@@ -0,0 +1,118 @@
+import os
+import json
+import shutil
+import logging
+from datetime import datetime, timezone
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)  # Use DEBUG level for detailed logging
+
+# name of the file describing a finished spill of a pipeline entry.
+SPILL_MANIFEST = "_spill.json"
+
+
+class ParquetSpill:
+    """
+    Partitioned Parquet copy of the transformed (schema coerced) OMOP data.
+
+    Every pipeline entry (e.g. ``drug_exposure_medication``) is written to its own
+    directory as ``part-00000.parquet``, ``part-00001.parquet``, ... A ``_spill.json``
+    file is written last, so an entry is only replayed once all of its parts are on disk.
+    Sharded runs spill every shard to its own ``shard_NNN`` directory below the spill directory.
+    """
+
+    def __init__(self, spill_dir: str, rows_per_part: int = 250000):
+        """
+        Initialise the ParquetSpill class.
+        Args:
+            spill_dir: str - This defines the directory the Parquet files are written to.
+            rows_per_part: int - This defines the number of rows written per Parquet file.
+        """
+        self._spill_dir = spill_dir
+        self._rows_per_part = rows_per_part
+
+    def shard(self, index: int):
+        """Spill of one shard of a sharded run, so parallel shards never write the same entry."""
+        return ParquetSpill(os.path.join(self._spill_dir, f"shard_{index:03d}"), self._rows_per_part)
+
+    def shards(self) -> list:
+        """Spills of the shards written below this spill directory, in shard order."""
+        if not os.path.isdir(self._spill_dir):
+            return []
+        return [
+            ParquetSpill(os.path.join(self._spill_dir, name), self._rows_per_part)
+            for name in sorted(os.listdir(self._spill_dir))
+            if name.startswith("shard_") and os.path.isdir(os.path.join(self._spill_dir, name))
+        ]
+
+    def clear_shards(self):
+        """Remove the shard spills of an earlier sharded run."""
+        for spill in self.shards():
+            shutil.rmtree(spill._spill_dir, ignore_errors=True)
+
+    def entry_dir(self, key: str) -> str:
+        """Directory holding the parts of a pipeline entry."""
+        return os.path.join(self._spill_dir, key)
+
+    def write(self, key: str, table_name: str, data: pd.DataFrame, fingerprint=None, watermark=None) -> int:
+        """
+        Write the transformed data of a pipeline entry, replacing any earlier spill of it.
+        The source file fingerprint and the incremental watermark are kept with the spill,
+        so replay can complete the run manifest entry once the rows are loaded.
+        Returns the number of parts written.
+        """
+        target = self.entry_dir(key)
+        tmp_target = f"{target}.tmp"
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        os.makedirs(tmp_target)
+        schema = pa.Schema.from_pandas(data, preserve_index=False)
+        parts = 0
+        for start in range(0, max(len(data), 1), self._rows_per_part):
+            part = data.iloc[start:start + self._rows_per_part]
+            table = pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+            pq.write_table(table, os.path.join(tmp_target, f"part-{parts:05d}.parquet"))
+            parts += 1
+        with open(os.path.join(tmp_target, SPILL_MANIFEST), "w", encoding="utf-8") as handle:
+            json.dump(
+                {
+                    "table": table_name,
+                    "rows": int(len(data)),
+                    "parts": parts,
+                    "fingerprint": fingerprint,
+                    "watermark": watermark,
+                    "written_at": datetime.now(timezone.utc).isoformat(),
+                },
+                handle,
+                indent=2,
+                default=str,
+            )
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp_target, target)
+        logging.info(f"Spilled {len(data)} rows of {key} to {target} in {parts} parts.")
+        return parts
+
+    def describe(self, key: str):
+        """Get the spill record of a pipeline entry, or None if it was not (fully) spilled."""
+        path = os.path.join(self.entry_dir(key), SPILL_MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as handle:
+            return json.load(handle)
+
+    def has(self, key: str) -> bool:
+        """Check if a pipeline entry has a complete spill."""
+        return self.describe(key) is not None
+
+    def read(self, key: str) -> pd.DataFrame:
+        """Read the spilled data of a pipeline entry back, with the pandas dtypes it was written with."""
+        record = self.describe(key)
+        if record is None:
+            raise FileNotFoundError(f"No complete spill found for {key} in {self._spill_dir}")
+        parts = [
+            pq.read_table(os.path.join(self.entry_dir(key), f"part-{index:05d}.parquet")).to_pandas()
+            for index in range(record["parts"])
+        ]
+        return pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
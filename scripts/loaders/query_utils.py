@@ -9,11 +9,55 @@ from rpy2.robjects import pandas2ri
 import pyarrow.feather as feather
 from collections import defaultdict
 import uuid
+import os
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)  # Use DEBUG level for detailed logging
 
+# number of person ids sent per IN (...) list when a query is limited to some persons.
+PERSON_CHUNK_SIZE = 10000
+# when retrieve_concept_id consults the site's source_to_concept_map: "before" the vocabulary
+# lookups (curated mappings win), "after" them for the codes still unmapped, or "off".
+STCM_LOOKUP = os.getenv("STCM_LOOKUP", "off").lower()
+# concept domains a source_to_concept_map target may belong to, per CDM concept column, so a
+# source code shared by several domains only fills the columns of its target's domain.
+CONCEPT_DOMAINS = {
+    "gender_concept_id": ("Gender",),
+    "race_concept_id": ("Race",),
+    "ethnicity_concept_id": ("Ethnicity",),
+    "condition_concept_id": ("Condition",),
+    "drug_concept_id": ("Drug",),
+    "measurement_concept_id": ("Measurement",),
+    "observation_concept_id": ("Observation",),
+    "procedure_concept_id": ("Procedure",),
+    "specimen_concept_id": ("Specimen",),
+    "visit_concept_id": ("Visit",),
+    "visit_detail_concept_id": ("Visit",),
+    "device_concept_id": ("Device",),
+    "ingredient_concept_id": ("Drug",),
+    "unit_concept_id": ("Unit",),
+}
+# concept domains of the codes a loader resolves, per CDM table; the source_to_concept_map index
+# only resolves codes of tables listed here, to targets of their domain.
+TABLE_DOMAINS = {
+    "condition_occurrence": CONCEPT_DOMAINS["condition_concept_id"],
+    "drug_exposure": CONCEPT_DOMAINS["drug_concept_id"],
+    "measurement": CONCEPT_DOMAINS["measurement_concept_id"],
+    "observation": CONCEPT_DOMAINS["observation_concept_id"],
+    "procedure_occurrence": CONCEPT_DOMAINS["procedure_concept_id"],
+    "specimen": CONCEPT_DOMAINS["specimen_concept_id"],
+    "visit_occurrence": CONCEPT_DOMAINS["visit_concept_id"],
+    "visit_detail": CONCEPT_DOMAINS["visit_detail_concept_id"],
+    "device_exposure": CONCEPT_DOMAINS["device_concept_id"],
+}
+
 class QueryUtils:
+    # (source_code, domain_id) -> target_concept_id of source_to_concept_map, loaded once per run and schema.
+    _stcm_index = {}
+    # codes resolved (hits) and not resolved (misses) by the source_to_concept_map index.
+    stcm_hits = 0
+    stcm_misses = 0
+
     def __init__(self, conn, schema, table, csv_loader, vocab_schema: Optional[str] = None):
         """
         Initialize the QueryUtils with the given parameters.
@@ -46,17 +90,20 @@ class QueryUtils:
         # with (ro.default_converter + pandas2ri.converter).context():
         #     conversion = ro.conversion.get_conversion()
             
+        # suffix the exchange files with the process id so parallel workers do not overwrite each other.
         if direction == 'r_to_py':
             # Convert R DataFrame to pandas DataFrame
             logging.debug("Converting R DataFrame to pandas DataFrame.")
-            self._arrow.write_feather(data, 'rdf.feather')
-            return pd.read_feather('rdf.feather')
+            file_name = f'rdf_{os.getpid()}.feather'
+            self._arrow.write_feather(data, file_name)
+            return pd.read_feather(file_name)
         
         elif direction == 'py_to_r':
             # Convert pandas DataFrame to R DataFrame
             logging.debug("Converting pandas DataFrame to R DataFrame.")
-            feather.write_feather(data, 'pdf.feather')
-            return self._arrow.read_feather('pdf.feather')
+            file_name = f'pdf_{os.getpid()}.feather'
+            feather.write_feather(data, file_name)
+            return self._arrow.read_feather(file_name)
         else:
             raise ValueError("Invalid direction. Use 'r_to_py' or 'py_to_r'.")
 
@@ -147,6 +194,17 @@ class QueryUtils:
             queried_data_pandas = self.compare_and_convert(queried_data_pandas, 'visit_occurrence')
         return queried_data_pandas
     
+    def retrieve_visit_signature(self):
+        """Retrieve the count, max id and id checksum of visit_occurrence; a persisted visit index is valid while they match."""
+        query = f"""
+        SELECT COUNT(*) AS visit_count,
+               COALESCE(MAX(visit_occurrence_id), 0) AS max_visit_id,
+               COALESCE(SUM(visit_occurrence_id % 1000003), 0) AS visit_checksum
+        FROM {self._schema}.visit_occurrence
+        """
+        queried_data_pandas = self.fetch_query(query)
+        return tuple(int(queried_data_pandas[column].iloc[0]) for column in ('visit_count', 'max_visit_id', 'visit_checksum'))
+
     def retrieve_dated_visits(self):
         """Retrieve existing visit records with dates."""
         query = f"""
@@ -244,6 +302,26 @@ class QueryUtils:
         
         return queried_data_pandas
     
+    def retrieve_vocabulary_version(self):
+        """Retrieve the version of the loaded vocabulary release."""
+        query = f"SELECT vocabulary_version FROM {self._vocab_schema}.vocabulary WHERE vocabulary_id = 'None'"
+        queried_data_pandas = self.fetch_query(query)
+        if queried_data_pandas.empty:
+            return None
+        return str(queried_data_pandas['vocabulary_version'].iloc[0])
+
+    def retrieve_ingredient_ancestors(self):
+        """Retrieve every drug concept with the RxNorm ingredient(s) it rolls up to."""
+        query = f"""
+        SELECT ca.descendant_concept_id, ca.ancestor_concept_id AS ingredient_concept_id
+        FROM {self._vocab_schema}.concept_ancestor AS ca
+        JOIN {self._vocab_schema}.concept AS c ON c.concept_id = ca.ancestor_concept_id
+        WHERE c.vocabulary_id IN ('RxNorm', 'RxNorm Extension')
+        AND c.concept_class_id = 'Ingredient'
+        AND c.invalid_reason IS NULL
+        """
+        return self.fetch_query(query)
+
     def retrieve_conditions(self):
         """Retrieve existing condition records."""
         query = f"SELECT condition_occurrence_id, condition_source_value FROM {self._schema}.condition_occurrence"
@@ -334,6 +412,30 @@ class QueryUtils:
         
         return queried_data_pandas
     
+    def fetch_query(self, query):
+        """Run a query and return the result as a pandas DataFrame with lower case columns."""
+        queried_data = self._db_connector.querySql(
+            connection=self._conn,
+            sql=query
+        )
+        queried_data_pandas = self.convert_dataframe(queried_data, direction='r_to_py')
+        queried_data_pandas.columns = queried_data_pandas.columns.str.lower()
+        return queried_data_pandas
+
+    def execute_sql(self, query):
+        """Execute a statement that returns no rows and return the number of affected rows."""
+        affected = self._db_connector.dbExecute(self._conn, query)
+        return int(affected[0]) if len(affected) else 0
+
+    def retrieve_table_columns(self, table):
+        """Retrieve the columns of a table with their SQL types, in table order."""
+        query = (
+            "SELECT column_name, data_type, character_maximum_length "
+            f"FROM information_schema.columns WHERE table_name = '{table}' "
+            f"and table_schema = '{self._schema}' ORDER BY ordinal_position"
+        )
+        return self.fetch_query(query)
+
     def group_list(self, n_list):
         """Group a list of values into a string."""
         output = ', '.join(f"'{v}'" for v in n_list)
@@ -356,8 +458,22 @@ class QueryUtils:
         return queried_data_pandas.set_index('concept_code').to_dict()['concept_id']
 
     
-    def retrieve_concept_id(self, code, vocabulary):
-        """ Retrieve concept id given the code"""
+    def retrieve_concept_id(self, code, vocabulary, stcm_lookup: Optional[str] = None):
+        """ Retrieve concept id given the code.
+
+        The site's source_to_concept_map is consulted before the vocabulary lookups, so
+        curated mappings win and skip the queries, or after them for the codes that would
+        otherwise get 0 (STCM_LOOKUP: "before", "after" or "off", the default). Only mappings
+        to a target of this table's domain (TABLE_DOMAINS) are used.
+        """
+        stcm_lookup = (stcm_lookup or STCM_LOOKUP).lower()
+        if stcm_lookup == "before":
+            local_map = self.resolve_with_stcm(code)
+            remaining = [value for value in code if value not in local_map]
+            if not remaining:
+                return {k: int(v) for k, v in local_map.items()}
+            concept_map = self.retrieve_concept_id(remaining, vocabulary, stcm_lookup="off")
+            return concept_map | local_map
 
         vocab_list = self.group_list(vocabulary)
         code_list = self.group_list(code)
@@ -398,6 +514,10 @@ class QueryUtils:
         concept_id_map.update(concept_id_map_2)
         # get the missing codes
         missing_codes = set(code) - set(concept_id_map.keys())
+        if missing_codes and stcm_lookup == "after":
+            # locally curated mappings (pushed from Usagi) before falling back to 0.
+            concept_id_map.update(self.resolve_with_stcm(missing_codes))
+            missing_codes = set(code) - set(concept_id_map.keys())
         # if there are still missing codes, update them with 0 concept ids
         concept_map = dict.fromkeys(missing_codes, 0) | concept_id_map
 
@@ -427,9 +547,77 @@ class QueryUtils:
         """strip the length of the data."""
         return data[:length]
 
+    def person_chunks(self, person_ids):
+        """Split a set of person ids into comma separated lists for IN (...) clauses."""
+        ids = sorted(int(person_id) for person_id in person_ids)
+        for start in range(0, len(ids), PERSON_CHUNK_SIZE):
+            yield ', '.join(str(person_id) for person_id in ids[start:start + PERSON_CHUNK_SIZE])
+
+    def retrieve_person_rows(self, table, person_ids):
+        """Retrieve all rows of a table that belong to the given persons."""
+        frames = [
+            self.fetch_query(f"SELECT * FROM {self._schema}.{table} WHERE person_id IN ({ids})")
+            for ids in self.person_chunks(person_ids)
+        ]
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return pd.DataFrame()
+        queried_data_pandas = pd.concat(frames, ignore_index=True)
+        return self.compare_and_convert(queried_data_pandas, table)
+
+    def delete_person_rows(self, table, person_ids):
+        """Delete all rows of a table that belong to the given persons and return the number deleted."""
+        return sum(
+            self.execute_sql(f"DELETE FROM {self._schema}.{table} WHERE person_id IN ({ids})")
+            for ids in self.person_chunks(person_ids)
+        )
+
+    def replace_person_rows_sql(self, table, staging, key, columns, ids):
+        """
+        Build the statement swapping the rows of some persons for the rows of a staging table.
+        Rows missing from the staging table are deleted, changed rows updated and new rows
+        inserted. The three parts touch disjoint rows and run as one statement, so they are
+        applied together or not at all.
+        """
+        values = [column for column in columns if column not in (key, 'person_id')]
+        update = ""
+        if values:
+            update = f"""
+        updated AS (
+            UPDATE {self._schema}.{table} AS t
+            SET {', '.join(f"{column} = n.{column}" for column in values)}
+            FROM {self._schema}.{staging} AS n
+            WHERE t.{key} = n.{key} AND t.person_id IN ({ids})
+              AND ({', '.join(f"t.{column}" for column in values)}) IS DISTINCT FROM ({', '.join(f"n.{column}" for column in values)})
+            RETURNING 1
+        ),"""
+        return f"""
+        WITH{update}
+        deleted AS (
+            DELETE FROM {self._schema}.{table} AS t
+            WHERE t.person_id IN ({ids})
+              AND NOT EXISTS (SELECT 1 FROM {self._schema}.{staging} AS n WHERE n.{key} = t.{key})
+            RETURNING 1
+        )
+        INSERT INTO {self._schema}.{table} ({', '.join(columns)})
+        SELECT {', '.join(f"n.{column}" for column in columns)}
+        FROM {self._schema}.{staging} AS n
+        WHERE n.person_id IN ({ids})
+          AND NOT EXISTS (SELECT 1 FROM {self._schema}.{table} AS t WHERE t.{key} = n.{key})
+        """
+
+    def replace_person_rows(self, table, staging, key, columns, person_ids):
+        """Swap the rows of the given persons for the staged ones, one statement per chunk of persons."""
+        return sum(
+            self.execute_sql(self.replace_person_rows_sql(table, staging, key, columns, ids))
+            for ids in self.person_chunks(person_ids)
+        )
+
     # retrieve the drug exposure data from the database.
-    def retrieve_drug_exposure(self):
-        """Retrieve existing drug exposure records."""
+    def retrieve_drug_exposure(self, person_ids: Optional[set] = None):
+        """Retrieve existing drug exposure records, optionally only those of some persons."""
+        if person_ids is not None:
+            return self.retrieve_person_rows('drug_exposure', person_ids)
         query = f"SELECT * FROM {self._schema}.drug_exposure"
         queried_data = self._db_connector.querySql(
             connection=self._conn,
@@ -444,8 +632,10 @@ class QueryUtils:
         return queried_data_pandas
     
     # retrieve the condition occurrence data from the database.
-    def retrieve_condition_occurrence(self):
-        """Retrieve existing condition occurrence records."""
+    def retrieve_condition_occurrence(self, person_ids: Optional[set] = None):
+        """Retrieve existing condition occurrence records, optionally only those of some persons."""
+        if person_ids is not None:
+            return self.retrieve_person_rows('condition_occurrence', person_ids)
         query = f"SELECT * FROM {self._schema}.condition_occurrence"
         queried_data = self._db_connector.querySql(
             connection=self._conn,
@@ -567,6 +757,228 @@ class QueryUtils:
                 new_rdf[column] = new_rdf[column].astype(complex)
         return new_rdf
     
+    def retrieve_schema_columns(self, tables):
+        """Retrieve the columns and SQL types of several tables as {table: {column: data_type}}."""
+        if not tables:
+            return {}
+        query = (
+            "SELECT table_name, column_name, data_type FROM information_schema.columns "
+            f"WHERE table_schema = '{self._schema}' AND table_name IN ({self.group_list(tables)})"
+        )
+        columns = self.fetch_query(query)
+        schema_columns = defaultdict(dict)
+        for table, column, data_type in columns[['table_name', 'column_name', 'data_type']].itertuples(index=False):
+            schema_columns[str(table).lower()][str(column).lower()] = str(data_type)
+        return dict(schema_columns)
+
+    def null_concept_frequency_sql(self, fields, schema_columns, ordinals=None):
+        """
+        Build one UNION ALL query over the unmapped (concept id 0) rows of every
+        (table, concept column, source value column, source id column) in ``fields``.
+        Rows are grouped by source value and source id; concept id, table and field type
+        come from the first field (lowest ordinal, by default the ``fields`` order) the
+        pair was found in, and first_ord is that ordinal.
+        Returns None when none of the concept columns exist.
+        """
+        integer_types = ('integer', 'bigint', 'smallint')
+        ordinals = list(range(len(fields))) if ordinals is None else list(ordinals)
+        selects = []
+        for ordinal, (table, concept_column, source_value_column, source_id_column) in zip(ordinals, fields):
+            columns = schema_columns.get(table.lower(), {})
+            if concept_column not in columns:
+                logging.info(f"⚠️ Column {concept_column} not found in {table}, skipping...")
+                continue
+            source_value = f"CAST({source_value_column} AS VARCHAR)" if source_value_column in columns else "CAST('' AS VARCHAR)"
+            if columns.get(source_id_column) in integer_types:
+                source_id = f"COALESCE(CAST({source_id_column} AS BIGINT), 0)"
+            elif source_id_column in columns:
+                # text source ids (e.g. specimen_source_id) only count when they are numeric.
+                source_id = (
+                    f"CASE WHEN {source_id_column} ~ '^-?[0-9]+$' "
+                    f"THEN CAST({source_id_column} AS BIGINT) ELSE 0 END"
+                )
+            else:
+                source_id = "CAST(0 AS BIGINT)"
+            selects.append(
+                f"SELECT {ordinal} AS ord, '{table}' AS table_name, '{concept_column}' AS field_type, "
+                f"COALESCE(CAST({concept_column} AS BIGINT), 0) AS concept_id, "
+                f"{source_value} AS source_value, {source_id} AS source_id "
+                f"FROM {self._schema}.{table} WHERE {concept_column} = 0"
+            )
+        if not selects:
+            return None
+        union = "\n            UNION ALL\n            ".join(selects)
+        return f"""
+        WITH harvested AS (
+            {union}
+        )
+        SELECT (ARRAY_AGG(concept_id ORDER BY ord))[1] AS concept_id,
+               source_value,
+               source_id,
+               (ARRAY_AGG(table_name ORDER BY ord))[1] AS table_name,
+               (ARRAY_AGG(field_type ORDER BY ord))[1] AS field_type,
+               COUNT(*) AS frequency,
+               MIN(ord) AS first_ord
+        FROM harvested
+        GROUP BY source_value, source_id
+        """
+
+    def retrieve_null_concept_frequencies(self, fields, schema_columns=None, ordinals=None):
+        """
+        Retrieve the frequency of every unmapped source value/source id pair across the
+        given fields with a single aggregate query; see null_concept_frequency_sql.
+        The rows are not ordered; merge_null_concept_frequencies orders them.
+        """
+        columns = ["concept_id", "source_value", "source_id", "table_name", "field_type", "frequency", "first_ord"]
+        if schema_columns is None:
+            schema_columns = self.retrieve_schema_columns(sorted({field[0].lower() for field in fields}))
+        query = self.null_concept_frequency_sql(fields, schema_columns, ordinals)
+        if query is None:
+            return pd.DataFrame(columns=columns)
+        return self.fetch_query(query)[columns]
+
+    @staticmethod
+    def merge_null_concept_frequencies(partials):
+        """
+        Merge partial null concept frequencies (e.g. one per table) into the final list.
+        Frequencies of the same source value/source id pair are added up; concept id, table
+        and field type come from the lowest ordinal. Rows are ordered by frequency
+        (descending), first ordinal, source value and source id, so the result does not
+        depend on how the fields were split.
+        """
+        columns = ["concept_id", "source_value", "source_id", "table_name", "field_type", "frequency"]
+        partials = [partial for partial in partials if not partial.empty]
+        if not partials:
+            return pd.DataFrame(columns=columns)
+        combined = pd.concat(partials, ignore_index=True)
+        combined["frequency"] = pd.to_numeric(combined["frequency"]).fillna(0).astype(int)
+        combined["source_id"] = pd.to_numeric(combined["source_id"]).fillna(0).astype(int)
+        combined["first_ord"] = pd.to_numeric(combined["first_ord"]).astype(int)
+        combined = combined.sort_values("first_ord", kind="stable")
+        merged = combined.groupby(["source_value", "source_id"], dropna=False, sort=False).agg(
+            concept_id=("concept_id", "first"),
+            table_name=("table_name", "first"),
+            field_type=("field_type", "first"),
+            frequency=("frequency", "sum"),
+            first_ord=("first_ord", "min"),
+        ).reset_index()
+        merged = merged.sort_values(
+            ["frequency", "first_ord", "source_value", "source_id"],
+            ascending=[False, True, True, True], kind="stable", na_position="last",
+        )
+        return merged[columns].reset_index(drop=True)
+
+    def stcm_mapping_sql(self, stcm_table="source_to_concept_map", domains=None):
+        """
+        Select one valid, non-zero target concept per source code and target domain of a
+        source to concept map, or per source code when limited to some ``domains``.
+        A source code mapped to several targets takes the latest, lowest standard target concept.
+        """
+        domain_filter = (
+            f"\n            AND c.domain_id IN ({self.group_list(domains)})" if domains else ""
+        )
+        distinct = "m.source_code" if domains else "m.source_code, c.domain_id"
+        return f"""
+            SELECT DISTINCT ON ({distinct}) m.source_code, c.domain_id, m.target_concept_id
+            FROM {self._schema}.{stcm_table} AS m
+            JOIN {self._vocab_schema}.concept AS c ON c.concept_id = m.target_concept_id
+            WHERE m.target_concept_id <> 0
+            AND m.invalid_reason IS NULL
+            AND CURRENT_DATE BETWEEN COALESCE(m.valid_start_date, DATE '1970-01-01')
+                AND COALESCE(m.valid_end_date, DATE '2099-12-31'){domain_filter}
+            ORDER BY {distinct}, m.valid_start_date DESC,
+                (c.standard_concept = 'S') DESC, m.target_concept_id
+        """
+
+    def stcm_index(self, stcm_table="source_to_concept_map"):
+        """Get the (source_code, domain_id) -> target_concept_id index of the site's mappings, loading it once per run."""
+        key = (self._schema, stcm_table)
+        if key not in QueryUtils._stcm_index:
+            try:
+                mappings = self.fetch_query(self.stcm_mapping_sql(stcm_table))
+                index = {
+                    (str(code), str(domain)): int(concept)
+                    for code, domain, concept in zip(
+                        mappings['source_code'], mappings['domain_id'], mappings['target_concept_id']
+                    )
+                }
+            except Exception as e:
+                logging.error(f"Failed to load {self._schema}.{stcm_table}, local mappings are not used: {e}")
+                index = {}
+            logging.info(f"Loaded {len(index)} local mappings from {self._schema}.{stcm_table}.")
+            QueryUtils._stcm_index[key] = index
+        return QueryUtils._stcm_index[key]
+
+    def resolve_with_stcm(self, codes, domains=None):
+        """
+        Look codes up in the source_to_concept_map index, counting hits and misses. Only
+        targets of ``domains`` (by default the domains of this table) are used; codes of a
+        table without known domains are not resolved.
+        """
+        domains = TABLE_DOMAINS.get(self._table, ()) if domains is None else domains
+        if not domains:
+            return {}
+        index = self.stcm_index()
+        resolved = {}
+        for code in codes:
+            for domain in domains:
+                if (str(code), domain) in index:
+                    resolved[code] = index[(str(code), domain)]
+                    break
+        QueryUtils.stcm_hits += len(resolved)
+        QueryUtils.stcm_misses += len(set(codes)) - len(resolved)
+        return resolved
+
+    @classmethod
+    def reset_stcm_index(cls):
+        """Forget the loaded source_to_concept_map index, e.g. after new mappings were pushed."""
+        cls._stcm_index = {}
+
+    @classmethod
+    def stcm_summary(cls) -> str:
+        """Describe how many codes the source_to_concept_map index resolved."""
+        looked_up = cls.stcm_hits + cls.stcm_misses
+        return (
+            f"source_to_concept_map lookups: {cls.stcm_hits} hits, {cls.stcm_misses} misses"
+            + (f" ({cls.stcm_hits / looked_up:.1%} hit rate)." if looked_up else ".")
+        )
+
+    def retrieve_zero_concept_batches(self, table, concept_column, key, batch_size):
+        """
+        Retrieve the key values that start every batch of ``batch_size`` rows whose
+        concept column is 0, in key order.
+        """
+        query = f"""
+        SELECT {key} AS batch_start FROM (
+            SELECT {key}, ROW_NUMBER() OVER (ORDER BY {key}) AS row_number
+            FROM {self._schema}.{table} WHERE {concept_column} = 0
+        ) AS numbered
+        WHERE (row_number - 1) % {int(batch_size)} = 0
+        ORDER BY batch_start
+        """
+        return [int(value) for value in self.fetch_query(query)['batch_start']]
+
+    def backfill_concept_sql(self, table, concept_column, source_value_column, key, low, high=None,
+                             stcm_table="source_to_concept_map"):
+        """
+        Build the UPDATE ... FROM that sets the concept column of zero-concept rows with a
+        key in [low, high) from the valid source_to_concept_map row of their source value.
+        Only targets of the column's domain (CONCEPT_DOMAINS) are used; a source code mapped
+        to several of them takes the latest, lowest standard target concept.
+        """
+        domains = CONCEPT_DOMAINS.get(concept_column.lower())
+        if not domains:
+            raise ValueError(f"No concept domain known for {concept_column}")
+        upper = f" AND t.{key} < {int(high)}" if high is not None else ""
+        return f"""
+        UPDATE {self._schema}.{table} AS t
+        SET {concept_column} = m.target_concept_id
+        FROM ({self.stcm_mapping_sql(stcm_table, domains)}) AS m
+        WHERE t.{concept_column} = 0
+        AND t.{source_value_column} = m.source_code
+        AND t.{key} >= {int(low)}{upper}
+        """
+
     def retrieve_null_concepts(self, table_name, field_name):
         """Retrieve existing concepts records."""
         query = f"SELECT * FROM {self._schema}.{table_name} WHERE {field_name}=0"
@@ -579,6 +991,15 @@ class QueryUtils:
                 
         return queried_data_pandas
     
+    def retrieve_stcm_keys(self, table_name):
+        """Retrieve the distinct (source_concept_id, source_code_description) pairs of a source to concept map table."""
+        query = f"""
+        SELECT DISTINCT source_concept_id, source_code_description
+        FROM {self._schema}.{table_name}
+        WHERE source_concept_id IS NOT NULL AND source_code_description IS NOT NULL
+        """
+        return self.fetch_query(query)
+
     def retrieve_all_stcm(self, table_name):
         """Retrieve all standard concepts mappings."""
         query = f"SELECT * FROM {self._schema}.{table_name}"
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Optional
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)  # Use DEBUG level for detailed logging
+
+
+class RunManifest:
+    """Small JSON file that records the progress of pipeline runs.
+
+    Each entry of the pipeline (e.g. ``drug_exposure_medication``) gets its own
+    record holding the fingerprint of the source file it was built from, its
+    status, the row counts pushed per committed batch and, for incremental runs,
+    the watermark reached in the source file. Base tables whose derived tables
+    (eras, observation periods) still have to be built are listed under
+    ``derived_pending`` until the post-load stage built them.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initialise the RunManifest class.
+        Args:
+            path: str - This defines where the manifest file is stored.
+        """
+        self._path = path
+        self._state = {"tables": {}}
+        self.load()
+
+    def load(self):
+        """Load the manifest from disk if it exists."""
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r", encoding="utf-8") as handle:
+                self._state = json.load(handle)
+            self._state.setdefault("tables", {})
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read run manifest {self._path}, starting a new one: {e}")
+            self._state = {"tables": {}}
+
+    def save(self):
+        """Write the manifest atomically so a crash never leaves a half written file."""
+        directory = os.path.dirname(os.path.abspath(self._path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            json.dump(self._state, handle, indent=2, default=str)
+        os.replace(tmp_path, self._path)
+
+    @staticmethod
+    def fingerprint(file_path: str):
+        """Fingerprint a source file using its size and modification time."""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def get_table(self, key: str):
+        """Get the record of a pipeline entry."""
+        return self._state["tables"].get(key)
+
+    def is_complete(self, key: str, fingerprint) -> bool:
+        """Check if an entry was fully loaded from the same source file."""
+        record = self.get_table(key)
+        return bool(
+            record
+            and record.get("status") == "complete"
+            and fingerprint is not None
+            and record.get("fingerprint") == fingerprint
+        )
+
+    def start_table(self, key: str, fingerprint):
+        """Start (or resume) an entry. Committed batches are kept when the source file is unchanged."""
+        record = self.get_table(key)
+        if record and record.get("fingerprint") == fingerprint and record.get("batches"):
+            logging.info(
+                f"Resuming {key} after {len(record['batches'])} committed batches "
+                f"({self.committed_rows(key)} rows)."
+            )
+        else:
+            record = {"fingerprint": fingerprint, "batches": [], "watermark": (record or {}).get("watermark")}
+        record["status"] = "running"
+        record["error"] = None
+        record["started_at"] = self._now()
+        self._state["tables"][key] = record
+        self.save()
+
+    def committed_batches(self, key: str) -> int:
+        """Number of batches already committed for an entry."""
+        record = self.get_table(key)
+        return len(record["batches"]) if record else 0
+
+    def committed_rows(self, key: str) -> int:
+        """Number of rows already committed for an entry."""
+        record = self.get_table(key)
+        return sum(batch["rows"] for batch in record["batches"]) if record else 0
+
+    def record_batch(self, key: str, table_name: str, rows: int):
+        """Record a batch that was committed to the database."""
+        record = self._state["tables"].setdefault(key, {"fingerprint": None, "batches": [], "status": "running"})
+        record["batches"].append({"table": table_name, "rows": int(rows), "committed_at": self._now()})
+        self.save()
+
+    def mark_failed(self, key: str, error):
+        """Mark an entry as failed so the next run does not skip it."""
+        record = self._state["tables"].setdefault(key, {"fingerprint": None, "batches": []})
+        record["status"] = "failed"
+        record["error"] = str(error)
+        self.save()
+
+    def finish_table(self, key: str, watermark: Optional[dict] = None) -> bool:
+        """Mark an entry as complete unless a failure was recorded while loading it.
+
+        The watermark of an incremental read is only stored once the entry is complete,
+        so the rows of a failed load are read again by the next run.
+        """
+        record = self.get_table(key)
+        if not record or record.get("status") == "failed":
+            return False
+        record["status"] = "complete"
+        record["completed_at"] = self._now()
+        if watermark is not None:
+            record["watermark"] = watermark
+        self.save()
+        return True
+
+    def get_watermark(self, key: str) -> dict:
+        """Get the watermark stored for an entry, or an empty dict if there is none."""
+        record = self.get_table(key)
+        return dict(record.get("watermark") or {}) if record else {}
+
+    def mark_derived_pending(self, table: str):
+        """Flag a base table that received rows, so its derived tables are built even after a crash."""
+        pending = self._state.setdefault("derived_pending", [])
+        if table not in pending:
+            pending.append(table)
+            self.save()
+
+    def derived_pending(self) -> list:
+        """Base tables whose derived tables have not been built since they received rows."""
+        return list(self._state.get("derived_pending", []))
+
+    def clear_derived_pending(self, tables):
+        """Clear the flags of base tables once their derived tables are built."""
+        pending = self._state.get("derived_pending", [])
+        remaining = [table for table in pending if table not in set(tables)]
+        if remaining != pending:
+            self._state["derived_pending"] = remaining
+            self.save()
+
+    def _now(self):
+        return datetime.now(timezone.utc).isoformat()
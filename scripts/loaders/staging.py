@@ -0,0 +1,238 @@
+import os
+import logging
+import pandas as pd
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)  # Use DEBUG level for detailed logging
+
+# id column -> (dimension table, source value column used to resolve it)
+RESOLVERS = {
+    "person_id": ("person", "person_source_value"),
+    "visit_occurrence_id": ("visit_occurrence", "visit_source_value"),
+    "provider_id": ("provider", "provider_source_value"),
+    "care_site_id": ("care_site", "care_site_source_value"),
+}
+
+
+class StagingMerge:
+    """
+    Load rows into an UNLOGGED staging table and merge them into a CDM table
+    with a single set-based INSERT ... SELECT.
+
+    The staging rows still carry the source values (person_source_value,
+    visit_source_value, ...). The ids are resolved by joining the dimension
+    tables inside the database, and rows whose key already exists are skipped,
+    so no dimension table has to be downloaded.
+    """
+
+    def __init__(self, query_utils, bulk_load, schema: str):
+        """
+        Initialise the StagingMerge class.
+        Args:
+            query_utils: QueryUtils - Used to run the statements.
+            bulk_load: coroutine - The CSVLoader bulk_load_data used to fill the staging table.
+            schema: str - The CDM schema holding both the staging and the target table.
+        """
+        self._query_utils = query_utils
+        self._bulk_load = bulk_load
+        self._schema = schema
+
+    def staging_name(self, table: str) -> str:
+        """Name of the staging table; suffixed with the process id so shards do not collide."""
+        return f"stg_{table}_{os.getpid()}"
+
+    def create_staging(self, data, table: str, target_columns: pd.DataFrame) -> str:
+        """Create the UNLOGGED staging table using the target column types where they exist."""
+        staging = self.staging_name(table)
+        target_types = dict(zip(target_columns['column_name'], target_columns['data_type']))
+        definitions = ", ".join(
+            f"{column} {target_types.get(column, 'text')}" for column in data.columns
+        )
+        self._query_utils.execute_sql(f"DROP TABLE IF EXISTS {self._schema}.{staging}")
+        self._query_utils.execute_sql(f"CREATE UNLOGGED TABLE {self._schema}.{staging} ({definitions})")
+        return staging
+
+    def build_merge_sql(self, staging: str, table: str, key: str, staging_columns, target_columns, required=("person_id",)):
+        """Build the INSERT ... SELECT that resolves ids, deduplicates and skips existing keys."""
+        target = list(target_columns)
+        select_map = {column: f"s.{column}" for column in staging_columns if column in target}
+        joins = []
+        for index, (id_column, (dimension, source_column)) in enumerate(RESOLVERS.items()):
+            if dimension == table or id_column not in target or source_column not in staging_columns:
+                continue
+            alias = f"r{index}"
+            join_type = "JOIN" if id_column in required else "LEFT JOIN"
+            joins.append(
+                f"{join_type} {self._schema}.{dimension} AS {alias} "
+                f"ON {alias}.{source_column} = s.{source_column}"
+            )
+            resolved = f"{alias}.{id_column}"
+            select_map[id_column] = f"COALESCE(s.{id_column}, {resolved})" if id_column in staging_columns else resolved
+
+        columns = [column for column in target if column in select_map]
+        join_sql = "\n".join(joins)
+        returning = "person_id" if "person_id" in columns else key
+        return f"""
+        WITH inserted AS (
+            INSERT INTO {self._schema}.{table} ({', '.join(columns)})
+            SELECT DISTINCT ON (s.{key}) {', '.join(select_map[column] for column in columns)}
+            FROM {self._schema}.{staging} AS s
+            {join_sql}
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {self._schema}.{table} AS t WHERE t.{key} = s.{key}
+            )
+            ORDER BY s.{key}
+            RETURNING {returning}
+        )
+        SELECT {returning}, COUNT(*) AS row_count FROM inserted GROUP BY {returning}
+        """
+
+    async def load(self, data, table: str, key: str, required=("person_id",), batch_size: int = 250000):
+        """
+        Stage the rows and merge them into the target table.
+        Returns the merged rows per person (or per key when the table has no person_id).
+        """
+        target_columns = self._query_utils.retrieve_table_columns(table)
+        staging = self.create_staging(data, table, target_columns)
+        try:
+            await self._bulk_load(batch_size=batch_size, data=data, table_name=staging)
+            query = self.build_merge_sql(
+                staging, table, key, list(data.columns), list(target_columns['column_name']), required
+            )
+            merged = self._query_utils.fetch_query(query)
+            logging.info(
+                f"Merged {int(merged['row_count'].sum()) if not merged.empty else 0} rows "
+                f"from '{self._schema}.{staging}' into '{self._schema}.{table}'."
+            )
+            return merged
+        finally:
+            self._query_utils.execute_sql(f"DROP TABLE IF EXISTS {self._schema}.{staging}")
+
+    async def replace_persons(self, data, table: str, key: str, columns, person_ids: set, batch_size: int = 250000) -> int:
+        """
+        Replace the rows of some persons by the given rows, which must hold all of their rows.
+        The rows are staged first and only swapped in once all of them arrived, one statement
+        per chunk of persons, so a failed load keeps the existing rows.
+        Returns the number of inserted rows.
+        """
+        staging = self.staging_name(table)
+        self._query_utils.execute_sql(f"DROP TABLE IF EXISTS {self._schema}.{staging}")
+        self._query_utils.execute_sql(
+            f"CREATE UNLOGGED TABLE {self._schema}.{staging} AS "
+            f"SELECT {', '.join(columns)} FROM {self._schema}.{table} WITH NO DATA"
+        )
+        try:
+            await self._bulk_load(batch_size=batch_size, data=data[columns], table_name=staging)
+            staged = self._query_utils.fetch_query(f"SELECT COUNT(*) AS row_count FROM {self._schema}.{staging}")
+            staged = int(staged.iloc[0, 0]) if not staged.empty else 0
+            if staged != len(data):
+                raise RuntimeError(f"only {staged} of {len(data)} {table} rows were staged; the existing rows are kept")
+            inserted = self._query_utils.replace_person_rows(table, staging, key, columns, person_ids)
+            logging.info(f"Replaced the {table} rows of {len(person_ids)} persons ({inserted} new).")
+            return inserted
+        finally:
+            self._query_utils.execute_sql(f"DROP TABLE IF EXISTS {self._schema}.{staging}")
+
+    def duplicate_keys_sql(self, table: str, conflict_columns) -> str:
+        """Count the keys held by more than one row; rows with a NULL key column never conflict."""
+        columns = ', '.join(conflict_columns)
+        not_null = ' AND '.join(f"{column} IS NOT NULL" for column in conflict_columns)
+        return f"""
+        SELECT COUNT(*) AS duplicate_keys FROM (
+            SELECT 1 FROM {self._schema}.{table}
+            WHERE {not_null}
+            GROUP BY {columns}
+            HAVING COUNT(*) > 1
+        ) AS duplicates
+        """
+
+    def dedupe_sql(self, table: str, conflict_columns) -> str:
+        """Build the DELETE keeping one row (the first stored) of every duplicate key."""
+        not_null = ' AND '.join(f"{column} IS NOT NULL" for column in conflict_columns)
+        return (
+            f"DELETE FROM {self._schema}.{table} AS t USING ("
+            f"SELECT ctid, ROW_NUMBER() OVER (PARTITION BY {', '.join(conflict_columns)} ORDER BY ctid) AS row_number "
+            f"FROM {self._schema}.{table} WHERE {not_null}) AS d "
+            f"WHERE t.ctid = d.ctid AND d.row_number > 1"
+        )
+
+    def ensure_unique_index(self, table: str, conflict_columns) -> str:
+        """
+        Create the unique index ON CONFLICT needs when it does not exist yet.
+        Rows sharing a key (e.g. from earlier appends) would make the index fail, so they
+        are counted first and reported with the statement that removes them.
+        """
+        index = f"ux_{table}_{'_'.join(column[:12] for column in conflict_columns)}"[:63]
+        existing = self._query_utils.fetch_query(
+            f"SELECT COUNT(*) AS index_count FROM pg_indexes "
+            f"WHERE schemaname = '{self._schema}' AND indexname = '{index}'"
+        )
+        if not existing.empty and int(existing.iloc[0, 0]):
+            return index
+        duplicates = self._query_utils.fetch_query(self.duplicate_keys_sql(table, conflict_columns))
+        duplicates = int(duplicates.iloc[0, 0]) if not duplicates.empty else 0
+        if duplicates:
+            raise ValueError(
+                f"{duplicates} keys ({', '.join(conflict_columns)}) are held by more than one row of "
+                f"{self._schema}.{table}, so the unique index for upserts cannot be created. "
+                f"Remove the duplicates first, e.g. keeping one row per key with: "
+                f"{self.dedupe_sql(table, conflict_columns)}"
+            )
+        self._query_utils.execute_sql(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {index} "
+            f"ON {self._schema}.{table} ({', '.join(conflict_columns)})"
+        )
+        return index
+
+    def build_upsert_sql(self, staging: str, table: str, conflict_columns, staging_columns, target_columns):
+        """
+        Build the INSERT ... ON CONFLICT DO UPDATE that merges the staged rows.
+        Rows whose values did not change are left alone, so only new and changed rows are written.
+        """
+        columns = [column for column in target_columns if column in staging_columns]
+        conflict = ', '.join(conflict_columns)
+        updated = [column for column in columns if column not in conflict_columns]
+        if updated:
+            assignments = ', '.join(f"{column} = EXCLUDED.{column}" for column in updated)
+            changed = (
+                f"({', '.join(f't.{column}' for column in updated)}) IS DISTINCT FROM "
+                f"({', '.join(f'EXCLUDED.{column}' for column in updated)})"
+            )
+            action = f"DO UPDATE SET {assignments} WHERE {changed}"
+        else:
+            action = "DO NOTHING"
+        return f"""
+        WITH merged AS (
+            INSERT INTO {self._schema}.{table} AS t ({', '.join(columns)})
+            SELECT DISTINCT ON ({conflict}) {', '.join(columns)}
+            FROM {self._schema}.{staging}
+            ORDER BY {conflict}
+            ON CONFLICT ({conflict}) {action}
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT inserted, COUNT(*) AS row_count FROM merged GROUP BY inserted
+        """
+
+    async def upsert(self, data, table: str, conflict_columns, batch_size: int = 250000):
+        """
+        Stage the rows and upsert them into the target table on ``conflict_columns``.
+        Returns the number of inserted and updated rows.
+        """
+        target_columns = self._query_utils.retrieve_table_columns(table)
+        self.ensure_unique_index(table, conflict_columns)
+        staging = self.create_staging(data, table, target_columns)
+        try:
+            await self._bulk_load(batch_size=batch_size, data=data, table_name=staging)
+            query = self.build_upsert_sql(
+                staging, table, conflict_columns, list(data.columns), list(target_columns['column_name'])
+            )
+            merged = self._query_utils.fetch_query(query)
+            counts = {bool(row.inserted): int(row.row_count) for row in merged.itertuples(index=False)}
+            inserted, updated = counts.get(True, 0), counts.get(False, 0)
+            logging.info(
+                f"Upserted '{self._schema}.{staging}' into '{self._schema}.{table}': "
+                f"{inserted} inserted, {updated} updated."
+            )
+            return inserted, updated
+        finally:
+            self._query_utils.execute_sql(f"DROP TABLE IF EXISTS {self._schema}.{staging}")
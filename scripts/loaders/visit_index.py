@@ -0,0 +1,131 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# directory keeping the visit key index between runs; empty keeps it in memory only.
+VISIT_INDEX_DIR = os.getenv("VISIT_INDEX_DIR", "")
+
+
+def hash_keys(values) -> np.ndarray:
+    """Hash visit_source_value strings into int64 keys; missing values become -1."""
+    values = pd.Series(values, copy=False)
+    missing = values.isna().to_numpy()
+    hashed = pd.util.hash_array(values.fillna('').to_numpy(dtype=object), categorize=False).view(np.int64)
+    hashed[missing] = -1
+    return hashed
+
+
+class VisitKeyIndex:
+    """
+    visit_source_value -> visit_occurrence_id lookup held as two sorted int64 arrays.
+
+    Built once per run from visit_occurrence and shared by the clinical loaders through
+    the database connector, so each loader resolves its visits with a binary search
+    instead of downloading the visits again and merging on the string key.
+    """
+
+    def __init__(self, hashes: np.ndarray, visit_ids: np.ndarray):
+        """
+        Initialise the VisitKeyIndex class.
+        Args:
+            hashes: array - hash_keys of the visit source values.
+            visit_ids: array - visit_occurrence_id of every hash, same length.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        visit_ids = np.asarray(visit_ids, dtype=np.int64)
+        order = np.argsort(hashes, kind="stable")
+        hashes, visit_ids = hashes[order], visit_ids[order]
+        # a source value loaded twice (or a hash collision) resolves to its first visit.
+        keep = np.ones(len(hashes), dtype=bool)
+        keep[1:] = hashes[1:] != hashes[:-1]
+        self.duplicates = int(len(hashes) - keep.sum())
+        self._hashes = hashes[keep]
+        self._visit_ids = visit_ids[keep]
+
+    def __len__(self):
+        return len(self._hashes)
+
+    @classmethod
+    def from_visits(cls, visits: pd.DataFrame):
+        """Build the index from visit_occurrence_id/visit_source_value rows."""
+        visits = visits.dropna(subset=['visit_occurrence_id', 'visit_source_value'])
+        index = cls(
+            hash_keys(visits['visit_source_value']),
+            visits['visit_occurrence_id'].to_numpy(dtype=np.int64),
+        )
+        if index.duplicates:
+            logging.warning(f"{index.duplicates} visit source values map to more than one visit; the first one is used.")
+        return index
+
+    def probe(self, values) -> np.ndarray:
+        """Get the visit_occurrence_id of every source value, -1 when the visit is unknown."""
+        keys = hash_keys(values)
+        if not len(self):
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._hashes, keys), len(self) - 1)
+        found = (self._hashes[positions] == keys) & (keys != -1)
+        return np.where(found, self._visit_ids[positions], -1)
+
+    def resolve(self, data: pd.DataFrame, how: str = 'left', column: str = 'visit_source_value') -> pd.DataFrame:
+        """
+        Add visit_occurrence_id to a frame, like a merge on visit_source_value.
+        ``how='left'`` keeps unknown visits with a missing id, ``how='inner'`` drops them.
+        """
+        visit_ids = self.probe(data[column])
+        resolved = data.reset_index(drop=True)
+        if how == 'inner':
+            found = visit_ids != -1
+            resolved, visit_ids = resolved[found].reset_index(drop=True), visit_ids[found]
+        else:
+            resolved = resolved.copy()
+        resolved['visit_occurrence_id'] = pd.arrays.IntegerArray(visit_ids, visit_ids == -1)
+        return resolved
+
+    @staticmethod
+    def cache_path(cache_dir: str, schema: str) -> str:
+        """Path of the persisted index of a CDM schema."""
+        return os.path.join(cache_dir, f"visit_index_{schema}.npz")
+
+    def write(self, path: str, signature: tuple):
+        """Write the index and the visit_occurrence signature it was built from."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as handle:
+            np.savez(handle, hashes=self._hashes, visit_ids=self._visit_ids,
+                     signature=np.asarray(signature, dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def read(cls, path: str):
+        """Read a persisted index; returns the index and its signature."""
+        with np.load(path) as stored:
+            index = cls(stored['hashes'], stored['visit_ids'])
+            signature = tuple(int(value) for value in stored['signature'])
+        return index, signature
+
+    @classmethod
+    def load(cls, query_utils, schema: str, cache_dir: str = VISIT_INDEX_DIR):
+        """
+        Load the visit index of a schema. With a cache directory the persisted index is
+        reused while visit_occurrence still has the same count, max id and id checksum.
+        """
+        if not cache_dir:
+            return cls.from_visits(query_utils.retrieve_visits())
+        signature = query_utils.retrieve_visit_signature()
+        path = cls.cache_path(cache_dir, schema)
+        if os.path.exists(path):
+            try:
+                index, stored_signature = cls.read(path)
+                if stored_signature == signature:
+                    logging.info(f"Reusing the visit index in {path} ({len(index)} visits).")
+                    return index
+            except Exception as e:
+                logging.error(f"Failed to read the visit index {path}: {e}")
+        index = cls.from_visits(query_utils.retrieve_visits())
+        index.write(path, signature)
+        logging.info(f"Persisted the visit index of {len(index)} visits in {path}.")
+        return index
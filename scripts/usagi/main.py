@@ -1,19 +1,67 @@
 import os
+import numpy as np
 import pandas as pd
 from rpy2.robjects.packages import importr
 import logging
-from scripts.loaders.query_utils import QueryUtils
+from scripts.loaders.query_utils import QueryUtils, CONCEPT_DOMAINS
 import pyarrow.feather as feather
 from tqdm import tqdm
 from scripts.usagi.table_mappers import TableMapper
+from scripts.loaders.staging import StagingMerge
 # from scripts.loaders.main_load import LoadOmoppedData
 import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 pd.set_option('future.no_silent_downcasting', True)
 
+# "append" bulk loads the rows missing from source_to_concept_map, "upsert" merges every
+# Usagi row through a staging table with INSERT ... ON CONFLICT DO UPDATE.
+USAGI_PUSH_MODE = os.getenv("USAGI_PUSH_MODE", "append").lower()
+# natural key of a source_to_concept_map row, used as the upsert conflict target.
+STCM_CONFLICT_COLUMNS = ("source_code", "source_vocabulary_id", "target_concept_id", "valid_end_date")
+# database connections (worker processes) used to scan the tables in generate_map; 1 scans them in one query.
+MAPCODE_WORKERS = int(os.getenv("MAPCODE_WORKERS", "1"))
+# zero-concept rows updated per statement when Usagi mappings are applied to the CDM tables.
+APPLY_BATCH_SIZE = int(os.getenv("APPLY_BATCH_SIZE", "100000"))
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)  # Use DEBUG level for detailed logging
 
+def usagi_keys(concept_ids, descriptions) -> np.ndarray:
+    """
+    Hash (source_concept_id, lower case source_code_description) pairs into int64 keys.
+    Pairs with a missing value get -1 and never match.
+    """
+    keys = pd.DataFrame({
+        "source_concept_id": pd.to_numeric(pd.Series(concept_ids).reset_index(drop=True), errors="coerce").astype(float) + 0.0,
+        "source_code_description": pd.Series(descriptions).reset_index(drop=True).astype(object),
+    })
+    missing = keys.isna().any(axis=1).to_numpy()
+    keys["source_code_description"] = keys["source_code_description"].fillna("").astype(str).str.lower()
+    hashed = pd.util.hash_pandas_object(keys, index=False, categorize=False).to_numpy().view(np.int64).copy()
+    hashed[missing] = -1
+    return hashed
+
+
+# QueryUtils of a scan worker, connected once per worker process.
+_worker_query_utils = None
+
+
+def _connect_scan_worker(schema: str, vocab_schema: str):
+    """Open the database connection of a scan worker process."""
+    global _worker_query_utils
+    from mappers.main_mapper import BaseETLPipeline
+
+    pipeline = BaseETLPipeline()
+    _worker_query_utils = QueryUtils(pipeline.db_connector._conn, schema, "", "", vocab_schema)
+
+
+def scan_null_concepts(fields: list, schema_columns: dict, ordinals: list) -> pd.DataFrame:
+    """Harvest the null concept frequencies of some fields on the worker's connection."""
+    return _worker_query_utils.retrieve_null_concept_frequencies(fields, schema_columns, ordinals)
+
+
 class MapCodeGen:
     def __init__(
         self,
@@ -104,8 +152,9 @@ class MapCodeGen:
         """
         Generates a mapping of concept IDs across different tables in the schema.
 
-        This function retrieves concept IDs from different tables, processes missing values, 
-        calculates frequency, and saves the result as a CSV.
+        The unmapped rows (concept id 0) of every requested table and concept column are
+        harvested with a single UNION ALL query that groups them by source value and
+        source id and returns their frequency, so no row data leaves the database.
 
         Returns:
             pd.DataFrame: The final processed DataFrame.
@@ -116,9 +165,8 @@ class MapCodeGen:
         # Retrieve the mapping of concept IDs for different tables
         concept_id_map = self.arrange_map()
 
-        # Create an empty DataFrame with predefined column names
-
-        # Iterate through the tables
+        # collect (table, concept column, source value column, source id column) in harvest order.
+        fields = []
         for table in self._table_names:
             table_lower = table.lower()
 
@@ -131,60 +179,65 @@ class MapCodeGen:
             for concept in concept_ids:
                 logging.info(f"🔍 Processing {concept} for {table}")
                 concept = concept.lower()
-                # Retrieve rows where concept values are null
-                result = self._query_utils.retrieve_null_concepts(table, concept)
-                # Skip empty results
-                if result.empty:
-                    logging.info(f"⚠️ Empty result for {concept} in {table}, skipping...")
-                    continue
                 # Extract fields from the table mapper.
-                fields = table_mapper.call_table(table, concept)
-                if not fields:
-                    logging.info(f"⚠️ No fields found for {concept} in {table}, skipping...")
-                    continue
-
-                if fields is None:
+                mapped_fields = table_mapper.call_table(table, concept)
+                if mapped_fields is None:
                     logging.info(f"⚠️ Table '{table}' not found in the table mapper, skipping...")
                     continue
-                
+                if not mapped_fields:
+                    logging.info(f"⚠️ No fields found for {concept} in {table}, skipping...")
+                    continue
                 # unpack the fields
-                concept_id_col, source_value_col, source_id_col = fields                           
-                # Ensure these columns exist in the result DataFrame
-                for col, default_value in [(concept_id_col, 0), (source_value_col, ""), (source_id_col, 0)]:
-                    if col not in result.columns:
-                        result[col] = default_value
-
-                # Create a DataFrame for the current iteration
-                temp_df = pd.DataFrame({
-                    "concept_id": result[concept_id_col],
-                    "source_value": result[source_value_col],
-                    "source_id": result[source_id_col],
-                    "table_name": table,
-                    "field_type": concept_id_col
-                })
-
-                # Concatenate results to the main DataFrame
-                if not temp_df.empty:
-                    self._df = pd.concat([self._df, temp_df], ignore_index=True)
-
-        # Convert data types once after the loop for efficiency
+                concept_id_col, source_value_col, source_id_col = mapped_fields
+                fields.append((table, concept_id_col, source_value_col, source_id_col))
+
+        self._df = self.harvest_null_concepts(fields)
+
+        # Convert data types once the frequencies are retrieved
         self._df["concept_id"] = self._df["concept_id"].fillna(0).astype(int)
         self._df["source_id"] = self._df["source_id"].fillna(0).astype(int)
+        self._df["frequency"] = self._df["frequency"].fillna(0).astype(int)
 
-        # Count occurrences of (source_value, source_id) and assign as frequency
-        self._df["frequency"] = self._df.groupby(["source_value", "source_id"])["concept_id"].transform("size")
+        logging.info("✅ Mapping code generated successfully")
+        return self._df
 
-        # Drop duplicates while keeping the first occurrence
-        self._df.drop_duplicates(subset=["source_value", "source_id"], keep="first", inplace=True)
+    def harvest_null_concepts(self, fields: list, workers: int = None) -> pd.DataFrame:
+        """
+        Harvest the null concept frequencies of the fields. With one worker this is a single
+        query; with more, every table is scanned on its own connection in a bounded pool
+        of worker processes and the partial frequencies are merged, giving the same rows
+        in the same order.
+        """
+        workers = MAPCODE_WORKERS if workers is None else workers
+        tables = list(dict.fromkeys(field[0] for field in fields))
+        if workers <= 1 or len(tables) <= 1:
+            partials = [self._query_utils.retrieve_null_concept_frequencies(fields)]
+            return QueryUtils.merge_null_concept_frequencies(partials)
+
+        schema_columns = self._query_utils.retrieve_schema_columns(sorted({table.lower() for table in tables}))
+        tasks = []
+        for table in tables:
+            ordinals = [ordinal for ordinal, field in enumerate(fields) if field[0] == table]
+            table_columns = {table.lower(): schema_columns.get(table.lower(), {})}
+            tasks.append(([fields[ordinal] for ordinal in ordinals], table_columns, ordinals))
+        logging.info(f"🔍 Scanning {len(tables)} tables on {min(workers, len(tables))} connections")
+        # spawn keeps the embedded R session of this process out of the workers.
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(tables)),
+            mp_context=context,
+            initializer=_connect_scan_worker,
+            initargs=(self._schema, self._vocab_schema),
+        ) as executor:
+            partials = list(executor.map(scan_null_concepts, *zip(*tasks)))
+        return QueryUtils.merge_null_concept_frequencies(partials)
 
-        logging.info("✅ Mapping code generated successfully")
-    
     def convert_to_csv(self, file_name: str):
         if not file_name.endswith(".csv"):
             logging.error("File name must end with .csv")
             return
-        # sort the dataframe based on the frequency
-        self._df.sort_values(by="frequency", ascending=False, inplace=True)
+        # sort the dataframe based on the frequency; ties keep the query order.
+        self._df.sort_values(by="frequency", ascending=False, kind="stable", inplace=True)
         file_path = os.path.join(self._save_dir, file_name)
         self._df.to_csv(file_path, index=False)
         logging.info(f"✅ Results successfully saved to {file_path}")
@@ -227,20 +280,24 @@ class MapCodeGen:
             logging.error(f"Unexpected error loading data: {e}")
 
     def save_usagi(self, dir_path: str = "", file_name: str = ""):
-        
+        """
+        Get the Usagi rows whose (source_concept_id, source_code_description) pair is not
+        in source_to_concept_map yet. Only the two key columns are fetched; both sides are
+        hashed into int64 keys and compared with a sorted-array membership test.
+        """
         self.load_usagi(dir_path=dir_path, file_name=file_name)
-        new_data = self._query_utils.retrieve_all_stcm("source_to_concept_map")
-        # lower the columns
-        new_data.columns = new_data.columns.str.lower()
-        new_data['source_code_description'] = new_data['source_code_description'].str.lower()
-        # get unique values based on source_concept_id and source_code_description
-        new_data = set(
-            tuple(row) for row in new_data[['source_concept_id', 'source_code_description']].dropna().values
-        )        # retain only the rows that are not in the new data
+        existing = self._query_utils.retrieve_stcm_keys("source_to_concept_map")
+        existing_keys = np.unique(usagi_keys(existing['source_concept_id'], existing['source_code_description']))
+        existing_keys = existing_keys[existing_keys != -1]
+        # retain only the rows that are not in the source to concept map
         self._source_data['source_code_description'] = self._source_data['source_code_description'].str.lower()
-        unique_rows = self._source_data[
-            ~self._source_data[['source_concept_id', 'source_code_description']].apply(tuple, axis=1).isin(new_data)
-        ]
+        source_keys = usagi_keys(self._source_data['source_concept_id'], self._source_data['source_code_description'])
+        if len(existing_keys):
+            positions = np.minimum(np.searchsorted(existing_keys, source_keys), len(existing_keys) - 1)
+            known = existing_keys[positions] == source_keys
+        else:
+            known = np.zeros(len(source_keys), dtype=bool)
+        unique_rows = self._source_data[~known]
         
         # check if it is empty.
         if unique_rows.empty:
@@ -251,13 +308,96 @@ class MapCodeGen:
         unique_rows = unique_rows.drop_duplicates(subset=['source_concept_id', 'source_code_description'], keep='first')
         return unique_rows
     
-    def push_usagi(self, connector, data, table_name, batch_size=250000):
+    def apply_usagi(self, table_names: list = None, batch_size: int = APPLY_BATCH_SIZE, stcm_table: str = "source_to_concept_map"):
+        """
+        Apply source_to_concept_map to the rows of the CDM tables whose concept id is still 0.
+
+        Every concept column is updated in the database with one UPDATE ... FROM per batch
+        of ``batch_size`` zero-concept rows, ranged on the table's primary key so locks
+        stay short. Type concept columns are not mapped from source codes and are skipped,
+        as are columns without a known concept domain (CONCEPT_DOMAINS): only mappings to
+        a target of the column's domain are applied.
+
+        Returns:
+            dict: Rows updated per table.
+        """
+        table_mapper = TableMapper()
+        concept_id_map = self.arrange_map()
+        updated = {}
+        for table in table_names or self._table_names:
+            table_lower = table.lower()
+            columns = self._query_utils.retrieve_table_columns(table_lower)
+            if columns.empty:
+                logging.info(f"⚠️ Table {table} not found, skipping...")
+                continue
+            column_types = dict(zip(columns['column_name'].str.lower(), columns['data_type']))
+            # the first column of a CDM table is its integer primary key.
+            key = str(columns['column_name'].iloc[0]).lower()
+            if column_types[key] not in ('integer', 'bigint'):
+                logging.info(f"⚠️ No integer key found for {table}, skipping...")
+                continue
+            table_updated = 0
+            for concept in concept_id_map.get(table_lower, []):
+                concept = concept.lower()
+                if concept.endswith("_type_concept_id"):
+                    continue
+                fields = table_mapper.call_table(table_lower, concept)
+                if not fields:
+                    continue
+                concept_id_col, source_value_col, _ = fields
+                if concept_id_col not in CONCEPT_DOMAINS:
+                    logging.info(f"⚠️ No concept domain known for {table}.{concept_id_col}, skipping...")
+                    continue
+                if concept_id_col not in column_types or source_value_col not in column_types:
+                    logging.info(f"⚠️ Columns for {concept} not found in {table}, skipping...")
+                    continue
+                batch_starts = self._query_utils.retrieve_zero_concept_batches(table_lower, concept_id_col, key, batch_size)
+                column_updated = 0
+                for index, low in enumerate(batch_starts):
+                    high = batch_starts[index + 1] if index + 1 < len(batch_starts) else None
+                    column_updated += self._query_utils.execute_sql(
+                        self._query_utils.backfill_concept_sql(
+                            table_lower, concept_id_col, source_value_col, key, low, high, stcm_table
+                        )
+                    )
+                logging.info(f"🔁 Updated {column_updated} rows of {table}.{concept_id_col} in {len(batch_starts)} batches")
+                table_updated += column_updated
+            updated[table] = table_updated
+        for table, count in updated.items():
+            logging.info(f"{table}: {count} rows updated from {stcm_table}")
+        return updated
+
+    def usagi_rows(self, dir_path: str = "", file_name: str = "", mode: str = None):
+        """
+        Get the Usagi rows to push: the rows missing from source_to_concept_map in append
+        mode, every row of the Usagi file in upsert mode (the database does the diff).
+        """
+        if (mode or USAGI_PUSH_MODE).lower() != "upsert":
+            return self.save_usagi(dir_path=dir_path, file_name=file_name)
+        self.load_usagi(dir_path=dir_path, file_name=file_name)
+        return getattr(self, "_source_data", pd.DataFrame())
+
+    def push_usagi(self, connector, data, table_name, batch_size=250000, mode: str = None):
+        """
+        Push Usagi rows into source_to_concept_map.
+        mode: "append" bulk loads the rows; "upsert" stages them and merges them on
+            STCM_CONFLICT_COLUMNS, creating the unique index when it is missing.
+            Defaults to USAGI_PUSH_MODE.
+        """
         try:
-            if data.empty:
-                logging.info("smiles")
+            if data is None or data.empty:
+                logging.info("No Usagi rows to push.")
                 return
-            # load_omop = LoadOmoppedData(connector, data, table_name)
             loader = connector._db_loader
+            if (mode or USAGI_PUSH_MODE).lower() == "upsert":
+                staging = StagingMerge(self._query_utils, loader.bulk_load_data, self._schema)
+                inserted, updated = asyncio.run(staging.upsert(
+                    data, table_name, list(STCM_CONFLICT_COLUMNS), batch_size=batch_size
+                ))
+                logging.info(f"Upserted into table '{self._schema}.{table_name}': {inserted} inserted, {updated} updated.")
+                QueryUtils.reset_stcm_index()
+                return
+            # load_omop = LoadOmoppedData(connector, data, table_name)
             # push the filtered data to the database
             asyncio.run(loader.bulk_load_data(
                 batch_size=batch_size,
@@ -265,6 +405,8 @@ class MapCodeGen:
                 table_name=table_name
             ))
             logging.info(f"Loaded data into table '{self._schema}.{table_name}'.")
+            # the next concept lookups must see the new mappings.
+            QueryUtils.reset_stcm_index()
         
         except Exception as e:
             logging.error(f"Failed to load data into table: {e}")
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 from scripts.etls.person_etl import Person
@@ -8,6 +9,8 @@ from scripts.etls.encounter_etl import Encounters
 from scripts.etls.observation_period_etl import ObservationPeriod
 from scripts.etls.obs_measurement_etl import ObserMeasurement
 from scripts.etls.observation_etl import Observation
+from scripts.etls.era_kernel import collapse_frame, hash_columns
+from scripts.etls.ingredient_map import IngredientMap
 
 
 def _run_etl(etl_cls, data):
@@ -93,6 +96,48 @@ def test_encounter_normalizes_missing_end():
     assert mapped["visit_end_date"].iloc[0] == mapped["visit_start_date"].iloc[0]
 
 
+def test_encounter_aggregation_matches_groupby():
+    rng = np.random.default_rng(0)
+    start = pd.Timestamp("2020-01-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 200 * 24, 300), unit="h")
+    stop = start + pd.to_timedelta(rng.integers(0, 72, 300), unit="h")
+    data = pd.DataFrame(
+        {
+            "person_source_value": rng.choice(["x", "y", "z"], 300),
+            "visit_concept_id": rng.choice([9201, 9202], 300),
+            "visit_start_datetime": start,
+            "visit_end_datetime": stop,
+            "visit_start_date": start.date,
+            "visit_end_date": stop.date,
+            "visit_type_concept_id": 32827,
+            "visit_occurrence_id": rng.integers(0, 10 ** 9, 300),
+            "care_site_source_value": rng.choice(["s1", "s2"], 300),
+            "provider_source_value": pd.Series(rng.choice(["a", "b", None], 300), dtype=object),
+            "visit_source_value": [f"v{i}" for i in range(300)],
+        }
+    )
+    # the previous shift/groupby aggregation.
+    expected = data.sort_values(["person_source_value", "visit_concept_id", "visit_start_date"])
+    expected["prev_visit_end_date"] = expected.groupby(["person_source_value", "visit_concept_id"])["visit_end_datetime"].shift(1)
+    expected["visit_gap"] = (expected["visit_start_datetime"] - expected["prev_visit_end_date"]).dt.days.fillna(0)
+    expected["new_visit"] = (expected["visit_gap"] > 1).astype(int).cumsum()
+    expected = expected.groupby(["person_source_value", "visit_concept_id", "new_visit"]).agg(
+        visit_start_date=("visit_start_date", "min"),
+        visit_end_date=("visit_end_date", "max"),
+        visit_start_datetime=("visit_start_datetime", "min"),
+        visit_end_datetime=("visit_end_datetime", "max"),
+        visit_type_concept_id=("visit_type_concept_id", "first"),
+        visit_occurrence_id=("visit_occurrence_id", "first"),
+        care_site_source_value=("care_site_source_value", "first"),
+        provider_source_value=("provider_source_value", "first"),
+        visit_source_value=("visit_source_value", "first"),
+    ).reset_index()
+
+    etl = Encounters(file_path="unused.csv", table_name="test", fields_map=list(data.columns))
+    etl._source_data = data.copy()
+    etl._aggregate_data()
+    pd.testing.assert_frame_equal(etl._source_data, expected)
+
+
 def test_observation_period_uses_valid_ranges():
     data = pd.DataFrame(
         {
@@ -153,3 +198,176 @@ def test_quality_scores_remain_observations():
     mapped_observation = _run_etl(Observation, data)
     assert mapped_measurement.empty
     assert len(mapped_observation) == 1
+
+
+def test_watermark_reads_only_appended_rows(tmp_path):
+    source = tmp_path / "conditions.csv"
+    source.write_text("PATIENT,START\np1,2020-01-01\n")
+    first = Condition(file_path=str(source), table_name="test", watermark={})
+    first.load_data()
+    assert list(first._source_data["patient"]) == ["p1"]
+
+    with open(source, "a") as handle:
+        handle.write("p2,2020-01-02\n")
+    second = Condition(file_path=str(source), table_name="test", watermark=first.get_watermark())
+    second.load_data()
+    assert list(second._source_data["patient"]) == ["p2"]
+    assert second.get_watermark()["rows"] == 2
+
+    source.write_text("PATIENT,START\np3,2020-01-03\n")
+    rewritten = Condition(file_path=str(source), table_name="test", watermark=second.get_watermark())
+    rewritten.load_data()
+    assert list(rewritten._source_data["patient"]) == ["p3"]
+
+
+def test_incremental_encounters_merge_with_earlier_visits(tmp_path):
+    fields = [
+        "visit_occurrence_id", "visit_concept_id", "visit_start_date", "visit_start_datetime",
+        "visit_end_date", "visit_end_datetime", "person_source_value", "visit_type_concept_id",
+        "visit_source_value", "provider_source_value", "care_site_source_value",
+    ]
+    source = tmp_path / "encounters.csv"
+    source.write_text(
+        "Id,START,STOP,PATIENT,ORGANIZATION,PROVIDER,ENCOUNTERCLASS\n"
+        "v1,2020-01-01T08:00:00Z,2020-01-05T08:00:00Z,p1,org1,pr1,inpatient\n"
+        "v2,2020-03-01T08:00:00Z,2020-03-01T09:00:00Z,p2,org1,pr1,outpatient\n"
+    )
+    initial = Encounters(file_path=str(source), table_name="visit_occurrence", fields_map=fields, watermark={})
+    initial.run_mapping(fields)
+    # an encounter starting a day after the loaded visit of p1 ends.
+    with open(source, "a") as handle:
+        handle.write("v3,2020-01-06T08:00:00Z,2020-01-08T08:00:00Z,p1,org1,pr1,inpatient\n")
+    incremental = Encounters(
+        file_path=str(source), table_name="visit_occurrence", fields_map=fields, watermark=initial.get_watermark()
+    )
+    incremental.run_mapping(fields)
+    full = Encounters(file_path=str(source), table_name="visit_occurrence", fields_map=fields)
+    full.run_mapping(fields)
+
+    delta = incremental.get_omopped_data().reset_index(drop=True)
+    expected = full.get_omopped_data()
+    expected = expected[expected["person_source_value"].isin(delta["person_source_value"])].reset_index(drop=True)
+    # the new encounter extends the earlier visit, as in a full run.
+    assert len(delta) == 1 and delta["visit_source_value"].iloc[0] == "v1"
+    assert str(delta["visit_end_date"].iloc[0]) == "2020-01-08"
+    pd.testing.assert_frame_equal(delta, expected)
+
+
+def test_era_kernel_uses_running_max_end():
+    data = pd.DataFrame(
+        {
+            "person_id": [1, 1, 1, 2],
+            "concept_id": [10, 10, 10, 10],
+            "start": pd.to_datetime(["2020-01-01", "2020-01-05", "2020-03-01", "2020-01-01"]),
+            # the short second exposure lies inside the first one, which runs until March.
+            "end": pd.to_datetime(["2020-02-25", "2020-01-10", "2020-03-10", "2020-01-31"]),
+        }
+    )
+    eras = collapse_frame(data, ["person_id", "concept_id"], "start", "end", window_size=30)
+    assert eras["person_id"].tolist() == [1, 2]
+    assert eras["era_start_date"].tolist() == [pd.Timestamp("2020-01-01"), pd.Timestamp("2020-01-01")]
+    assert eras["era_end_date"].tolist() == [pd.Timestamp("2020-03-10"), pd.Timestamp("2020-01-31")]
+    assert eras["exposure_count"].tolist() == [3, 1]
+    # 2020-02-25 .. 2020-03-01 is not covered by any exposure.
+    assert eras["gap_days"].tolist() == [5, 0]
+
+
+def test_era_kernel_parallel_matches_single_process(monkeypatch):
+    from scripts.etls import era_kernel
+
+    rng = np.random.default_rng(0)
+    start_days = rng.integers(18000, 18400, 600)
+    data = pd.DataFrame(
+        {
+            "person_id": rng.integers(1, 40, 600),
+            "concept_id": rng.integers(1, 4, 600),
+            "start": pd.to_datetime(start_days, unit="D"),
+            "end": pd.to_datetime(start_days + rng.integers(0, 40, 600), unit="D"),
+        }
+    )
+    keys = ["person_id", "concept_id"]
+    serial = collapse_frame(data, keys, "start", "end", window_size=30, workers=1)
+    monkeypatch.setattr(era_kernel, "PARALLEL_MIN_ROWS", 100)
+    parallel = collapse_frame(data, keys, "start", "end", window_size=30, workers=3)
+    pd.testing.assert_frame_equal(parallel, serial)
+
+
+def test_era_sql_collapse_matches_pandas_kernel():
+    import sqlite3
+    from scripts.etls.era_sql import collapse_ctes
+
+    rng = np.random.default_rng(1)
+    start_days = rng.integers(18000, 18400, 400)
+    data = pd.DataFrame(
+        {
+            "person_id": rng.integers(1, 30, 400),
+            "concept_id": rng.integers(1, 4, 400),
+            "start_date": start_days,
+            "end_date": start_days + rng.integers(0, 60, 400),
+        }
+    )
+    # the gaps-and-islands part of the sql backend runs on day numbers in sqlite.
+    connection = sqlite3.connect(":memory:")
+    data.to_sql("filled", connection, index=False)
+    query = f"WITH {collapse_ctes('person_id, concept_id', 30)} SELECT * FROM eras ORDER BY person_id, concept_id, era_start"
+    sql_eras = pd.read_sql_query(query, connection)
+
+    frame = data.assign(
+        start=pd.to_datetime(data["start_date"], unit="D"), end=pd.to_datetime(data["end_date"], unit="D")
+    )
+    kernel = collapse_frame(frame, ["person_id", "concept_id"], "start", "end", window_size=30)
+    kernel = kernel.sort_values(["person_id", "concept_id", "era_start_date"]).reset_index(drop=True)
+    epoch = pd.Timestamp("1970-01-01")
+    assert sql_eras["person_id"].tolist() == kernel["person_id"].tolist()
+    assert sql_eras["concept_id"].tolist() == kernel["concept_id"].tolist()
+    assert sql_eras["era_start"].tolist() == ((kernel["era_start_date"] - epoch).dt.days).tolist()
+    assert sql_eras["era_end"].tolist() == ((kernel["era_end_date"] - epoch).dt.days).tolist()
+    assert sql_eras["exposure_count"].tolist() == kernel["exposure_count"].tolist()
+    assert sql_eras["gap_days"].tolist() == kernel["gap_days"].tolist()
+
+
+def test_era_id_hash_is_deterministic_per_key():
+    eras = pd.DataFrame(
+        {
+            "person_id": [1, 1, 2, 1],
+            "drug_concept_id": [200, 200, 200, 200],
+            "dose_value": [5.0, 5.0, 5.0, -0.0],
+            "dose_era_start_date": pd.to_datetime(["2020-01-01", "2020-01-01", "2020-01-01", "2020-01-01"]),
+        }
+    )
+    columns = ["person_id", "drug_concept_id", "dose_value", "dose_era_start_date"]
+    ids = hash_columns(eras, columns, "dose era")
+    assert ids[0] == ids[1]
+    assert len({ids[0], ids[2], ids[3]}) == 3
+    assert (ids >= 0).all()
+    assert (hash_columns(eras, columns, "dose era") == ids).all()
+    assert hash_columns(eras, columns, "drug era")[0] != ids[0]
+    zero = eras.assign(dose_value=[0.0, 0.0, 0.0, 0.0])
+    assert hash_columns(zero, columns, "dose era")[3] == ids[3]
+
+
+def test_ingredient_map_rolls_up_and_caches(tmp_path):
+    class VocabularyQueryUtils:
+        calls = 0
+
+        def retrieve_vocabulary_version(self):
+            return "v5.0 31-AUG-24"
+
+        def retrieve_ingredient_ancestors(self):
+            VocabularyQueryUtils.calls += 1
+            return pd.DataFrame(
+                {
+                    # 300 is a two-ingredient drug; 10 is an ingredient (maps to itself).
+                    "descendant_concept_id": [300, 300, 400, 10],
+                    "ingredient_concept_id": [20, 10, 10, 10],
+                }
+            )
+
+    ingredient_map = IngredientMap.load(VocabularyQueryUtils(), cache_dir=str(tmp_path))
+    cached = IngredientMap.load(VocabularyQueryUtils(), cache_dir=str(tmp_path))
+    assert VocabularyQueryUtils.calls == 1
+    assert len(cached) == 4
+    exposures = pd.DataFrame({"person_id": [1, 2, 3], "drug_concept_id": [300, 999, 400]})
+    rolled = cached.roll_up(exposures)
+    assert rolled["person_id"].tolist() == [1, 1, 2, 3]
+    assert rolled["drug_concept_id"].tolist() == [10, 20, 999, 10]
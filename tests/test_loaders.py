@@ -1,4 +1,6 @@
+import asyncio
 import importlib
+import re
 import uuid
 
 import pandas as pd
@@ -16,6 +18,13 @@ from scripts.loaders.load_drug import LoadDrug
 from scripts.loaders.load_measurement import LoadMeasurement
 from scripts.loaders.load_observation import LoadObservation
 from scripts.loaders.load_death import LoadDeath
+from scripts.loaders.run_manifest import RunManifest
+from scripts.loaders.parquet_spill import ParquetSpill
+from scripts.loaders.visit_index import VisitKeyIndex
+from scripts.etls.condition_era_etl import ConditionEraETL
+from scripts.etls.drug_era_stage import DrugEraStage
+from mappers.derived import changed_derived_tables
+from mappers.sharding import partition_file, shard_of
 
 
 def _empty(columns):
@@ -281,6 +290,71 @@ def test_load_encounter_inserts(monkeypatch):
     assert pushes and pushes[0][0] == "visit_occurrence"
 
 
+def test_incremental_encounters_replace_the_visits_of_their_persons(monkeypatch):
+    from scripts.loaders import load_encounter
+    from scripts.loaders.query_utils import QueryUtils
+
+    omop = pd.DataFrame(
+        {
+            "visit_occurrence_id": [1, 2],
+            "visit_concept_id": [9201, 9202],
+            "visit_start_date": [pd.Timestamp("2020-01-01").date(), pd.Timestamp("2020-03-01").date()],
+            "visit_end_date": [pd.Timestamp("2020-01-08").date(), pd.Timestamp("2020-03-01").date()],
+            "person_source_value": ["p1", "p1"],
+            "visit_source_value": ["v1", "v2"],
+            "provider_source_value": ["pr1", "pr1"],
+            "care_site_source_value": ["cs1", "cs1"],
+        }
+    )
+    statements, staged = [], []
+
+    class SwapQueryUtils(FakeQueryUtils):
+        _schema = "cdm"
+        replace_person_rows = QueryUtils.replace_person_rows
+        replace_person_rows_sql = QueryUtils.replace_person_rows_sql
+
+        def retrieve_visit_occurrences(self):
+            raise AssertionError("existing visits must not be filtered out in incremental mode")
+
+        def retrieve_table_columns(self, table):
+            columns = ["visit_occurrence_id", "person_id", "visit_concept_id", "visit_start_date",
+                       "visit_end_date", "visit_source_value", "provider_id", "care_site_id"]
+            return pd.DataFrame({"column_name": columns})
+
+        def person_chunks(self, person_ids):
+            yield ", ".join(str(person_id) for person_id in sorted(person_ids))
+
+        def execute_sql(self, query):
+            statements.append(query)
+            return 1
+
+        def fetch_query(self, query):
+            return pd.DataFrame({"row_count": [sum(len(data) for _, data in staged)]})
+
+    class RecordingLoader:
+        async def bulk_load_data(self, batch_size, data, table_name):
+            staged.append((table_name, data.copy()))
+
+    monkeypatch.setattr(load_encounter, "QueryUtils", SwapQueryUtils)
+    FakeQueryUtils.responses = {
+        "retrieve_persons": pd.DataFrame({"person_source_value": ["p1"], "person_id": [7]}),
+        "retrieve_providers": pd.DataFrame({"provider_id": [1], "provider_source_value": ["pr1"]}),
+        "retrieve_care_sites": pd.DataFrame({"care_site_id": [1], "care_site_source_value": ["cs1"]}),
+    }
+    affected = set()
+    loader = LoadEncounter(FakeConnector(), omop, "visit_occurrence", affected_persons=affected)
+    loader._db_loader = RecordingLoader()
+    loader.load_data()
+    assert staged[0][0].startswith("stg_visit_occurrence_")
+    assert staged[0][1]["visit_occurrence_id"].tolist() == [1, 2]
+    # the person's visits are swapped with one statement: stale ones deleted, extended ones updated.
+    swap = next(statement for statement in statements if "INSERT INTO cdm.visit_occurrence" in statement)
+    assert "DELETE FROM cdm.visit_occurrence AS t" in swap and "UPDATE cdm.visit_occurrence AS t" in swap
+    assert "t.person_id IN (7)" in swap
+    assert statements[-1].startswith("DROP TABLE IF EXISTS cdm.stg_visit_occurrence_")
+    assert affected == {7} and loader.rows_loaded == 1
+
+
 def test_load_visit_detail_inserts(monkeypatch):
     omop = pd.DataFrame(
         {
@@ -613,3 +687,941 @@ def test_dose_era_groups(monkeypatch):
     loader.load_dose_era_data(window_size=30)
     assert pushes and pushes[0][0] == "dose_era"
     assert len(pushes[0][1]) == 2
+
+
+def test_push_to_db_records_batches_in_manifest(monkeypatch, tmp_path):
+    manifest = RunManifest(str(tmp_path / "manifest.json"))
+    manifest.start_table("location_", {"size": 1, "mtime_ns": 1})
+    omop = pd.DataFrame({"location_id": [1, 2, 3], "location_source_value": ["a", "b", "c"]})
+    loader = LoadLocation(FakeConnector(), omop, "location", manifest=manifest, manifest_key="location_")
+    pushed = []
+
+    class RecordingLoader:
+        async def bulk_load_data(self, batch_size, data, table_name):
+            pushed.append(len(data))
+
+    loader._db_loader = RecordingLoader()
+    asyncio.run(loader.push_to_db(batch_size=2, data=omop, table_name="location"))
+    manifest.finish_table("location_")
+    reloaded = RunManifest(str(tmp_path / "manifest.json"))
+    assert pushed == [2, 1]
+    assert reloaded.committed_rows("location_") == 3
+    assert reloaded.is_complete("location_", {"size": 1, "mtime_ns": 1})
+    assert not reloaded.is_complete("location_", {"size": 2, "mtime_ns": 1})
+
+
+def test_parquet_spill_round_trip(tmp_path):
+    spill = ParquetSpill(str(tmp_path), rows_per_part=2)
+    omop = pd.DataFrame(
+        {
+            "condition_occurrence_id": pd.array([1, 2, None], dtype="Int64"),
+            "condition_start_date": pd.to_datetime(["2020-01-01", "2020-02-01", "2020-03-01"]),
+            "person_source_value": ["p1", "p2", None],
+        }
+    )
+    assert not spill.has("condition_occurrence_")
+    assert spill.write("condition_occurrence_", "condition_occurrence", omop) == 2
+    record = spill.describe("condition_occurrence_")
+    assert record["table"] == "condition_occurrence" and record["rows"] == 3
+    restored = spill.read("condition_occurrence_")
+    pd.testing.assert_frame_equal(restored, omop)
+
+
+def test_condition_era_rebuilds_only_affected_persons():
+    from scripts.loaders.query_utils import QueryUtils
+
+    condition_data = pd.DataFrame(
+        {
+            "person_id": [2, 2],
+            "condition_concept_id": [100, 100],
+            "condition_start_date": [pd.Timestamp("2020-01-01"), pd.Timestamp("2020-01-15")],
+            "condition_end_date": [pd.Timestamp("2020-01-10"), pd.Timestamp("2020-01-20")],
+        }
+    )
+    calls = []
+    statements = []
+    staged = []
+
+    class IncrementalQueryUtils(FakeQueryUtils):
+        _schema = "cdm"
+        replace_person_rows = QueryUtils.replace_person_rows
+        replace_person_rows_sql = QueryUtils.replace_person_rows_sql
+
+        def retrieve_condition_occurrence(self, person_ids=None):
+            calls.append(("retrieve", person_ids))
+            return condition_data if person_ids != {3} else pd.DataFrame()
+
+        def retrieve_condition_era(self):
+            raise AssertionError("existing eras must not be downloaded in incremental mode")
+
+        def delete_person_rows(self, table, person_ids):
+            calls.append(("delete", table, person_ids))
+            return 1
+
+        def person_chunks(self, person_ids):
+            yield ", ".join(str(person_id) for person_id in sorted(person_ids))
+
+        def execute_sql(self, query):
+            statements.append(query)
+            return 1
+
+        def fetch_query(self, query):
+            return pd.DataFrame({"row_count": [sum(len(data) for _, data in staged)]})
+
+    async def fake_push_to_db(batch_size, data, table_name):
+        staged.append((table_name, data.copy()))
+
+    query_utils = IncrementalQueryUtils()
+    builder = ConditionEraETL(query_utils, fake_push_to_db, "cdm")
+    builder.build(window_size=30, person_ids=set())
+    assert not calls and not staged
+    builder.build(window_size=30, person_ids={2})
+    # the rebuilt eras are staged and swapped in with one statement, never deleted first.
+    assert calls == [("retrieve", {2})]
+    assert staged[0][0].startswith("stg_condition_era_")
+    assert staged[0][1]["person_id"].tolist() == [2]
+    swap = next(statement for statement in statements if "INSERT INTO cdm.condition_era" in statement)
+    assert "DELETE FROM cdm.condition_era AS t" in swap and "UPDATE cdm.condition_era AS t" in swap
+    assert statements[-1].startswith("DROP TABLE IF EXISTS cdm.stg_condition_era_")
+
+    # a push that loses rows keeps the existing eras.
+    async def failing_push_to_db(batch_size, data, table_name):
+        pass
+
+    statements.clear()
+    staged.clear()
+    ConditionEraETL(query_utils, failing_push_to_db, "cdm").build(window_size=30, person_ids={2})
+    assert not any("INSERT INTO cdm.condition_era" in statement for statement in statements)
+
+    # persons left without conditions lose their old eras.
+    builder.build(window_size=30, person_ids={3})
+    assert calls[-1] == ("delete", "condition_era", {3})
+
+
+def test_era_rebuild_leaves_run_manifest_entries_unchanged(tmp_path):
+    import json
+    from scripts.loaders.query_utils import QueryUtils
+
+    manifest = RunManifest(str(tmp_path / "manifest.json"))
+    manifest.start_table("conditions", {"size": 1, "mtime_ns": 1})
+    loader = LoadCondition(FakeConnector(), pd.DataFrame(), "condition_occurrence", manifest=manifest, manifest_key="conditions")
+    staged = []
+
+    class RecordingLoader:
+        async def bulk_load_data(self, batch_size, data, table_name):
+            staged.append((table_name, len(data)))
+
+    class EraQueryUtils(FakeQueryUtils):
+        _schema = "cdm"
+        replace_person_rows = QueryUtils.replace_person_rows
+        replace_person_rows_sql = QueryUtils.replace_person_rows_sql
+
+        def retrieve_condition_occurrence(self, person_ids=None):
+            return pd.DataFrame(
+                {
+                    "person_id": [2],
+                    "condition_concept_id": [100],
+                    "condition_start_date": [pd.Timestamp("2020-01-01")],
+                    "condition_end_date": [pd.Timestamp("2020-01-10")],
+                }
+            )
+
+        def person_chunks(self, person_ids):
+            yield ", ".join(str(person_id) for person_id in sorted(person_ids))
+
+        def execute_sql(self, query):
+            return 1
+
+        def fetch_query(self, query):
+            return pd.DataFrame({"row_count": [sum(rows for _, rows in staged)]})
+
+    loader._db_loader = RecordingLoader()
+    before = json.loads((tmp_path / "manifest.json").read_text())["tables"]
+    ConditionEraETL(EraQueryUtils(), loader.push_to_db, "cdm").build(window_size=30, person_ids={2})
+    assert staged and staged[0][0].startswith("stg_condition_era_")
+    # the staging push neither adds an entry nor records batches of the loader's own entry.
+    assert json.loads((tmp_path / "manifest.json").read_text())["tables"] == before
+    assert loader.rows_loaded == 0
+
+
+def test_condition_era_sql_backend_runs_in_database():
+    statements = []
+
+    class SqlQueryUtils(FakeQueryUtils):
+        def retrieve_condition_occurrence(self, person_ids=None):
+            raise AssertionError("the sql backend must not download conditions")
+
+        def execute_sql(self, query):
+            statements.append(query)
+            return 3
+
+    async def fake_push_to_db(batch_size, data, table_name):
+        raise AssertionError("the sql backend must not push data")
+
+    builder = ConditionEraETL(SqlQueryUtils(), fake_push_to_db, "cdm", backend="sql")
+    builder.build(window_size=45)
+    assert len(statements) == 1
+    assert "INSERT INTO cdm.condition_era" in statements[0]
+    assert "<= 45 THEN 0 ELSE 1" in statements[0]
+
+
+def test_drug_era_stage_scans_drug_exposure_once():
+    drug_data = pd.DataFrame(
+        {
+            "person_id": [1, 1, 1],
+            "drug_concept_id": [200, 200, 200],
+            "drug_exposure_start_date": [
+                pd.Timestamp("2020-01-01"),
+                pd.Timestamp("2020-01-10"),
+                pd.Timestamp("2020-03-15"),
+            ],
+            "drug_exposure_end_date": [
+                pd.Timestamp("2020-01-05"),
+                pd.Timestamp("2020-01-12"),
+                None,
+            ],
+            "quantity": [5, 10, 5],
+        }
+    )
+    scans = []
+
+    class CountingQueryUtils(FakeQueryUtils):
+        def retrieve_drug_exposure(self):
+            scans.append(1)
+            return drug_data.copy()
+
+    pushes = []
+
+    async def fake_push_to_db(batch_size, data, table_name):
+        pushes.append((table_name, data.copy()))
+
+    DrugEraStage(CountingQueryUtils(), fake_push_to_db, "cdm", backend="pandas").build(30, 30)
+    assert len(scans) == 1
+    assert [table for table, _ in pushes] == ["drug_era", "dose_era"]
+    assert len(pushes[0][1]) == 2
+    assert len(pushes[1][1]) == 3
+
+
+def test_derived_tables_follow_changed_base_tables():
+    assert changed_derived_tables({}) == []
+    assert changed_derived_tables({"drug_exposure": 0, "location": 4}) == []
+    assert changed_derived_tables({"drug_exposure": 10}) == ["drug_era"]
+    assert changed_derived_tables({"visit_occurrence": 1, "condition_occurrence": 2}) == [
+        "observation_period",
+        "condition_era",
+    ]
+
+
+def test_push_to_db_counts_rows_loaded():
+    omop = pd.DataFrame({"location_id": [1, 2, 3], "location_source_value": ["a", "b", "c"]})
+    loader = LoadLocation(FakeConnector(), omop, "location")
+
+    class RecordingLoader:
+        async def bulk_load_data(self, batch_size, data, table_name):
+            return None
+
+    loader._db_loader = RecordingLoader()
+    asyncio.run(loader.push_to_db(batch_size=2, data=omop, table_name="location"))
+    asyncio.run(loader.push_to_db(batch_size=2, data=omop, table_name="location_history"))
+    assert loader.rows_loaded == 3
+
+
+def test_visit_key_index_is_shared_and_persisted(tmp_path):
+    calls = []
+
+    class VisitQueryUtils:
+        def retrieve_visits(self):
+            calls.append("visits")
+            return pd.DataFrame({"visit_occurrence_id": [11, 12], "visit_source_value": ["v1", "v2"]})
+
+        def retrieve_visit_signature(self):
+            return (2, 12, 23)
+
+    connector = FakeConnector()
+    data = pd.DataFrame({"visit_source_value": ["v2", "unknown", None, "v1"]})
+    first = LoadCondition(connector, pd.DataFrame(), "condition_occurrence")
+    second = LoadDrug(connector, pd.DataFrame(), "drug_exposure")
+    resolved = first.resolve_visits(VisitQueryUtils(), data)
+    assert resolved["visit_occurrence_id"].tolist() == [12, pd.NA, pd.NA, 11]
+    inner = second.resolve_visits(VisitQueryUtils(), data, how="inner")
+    assert inner["visit_source_value"].tolist() == ["v2", "v1"]
+    assert calls == ["visits"]
+
+    VisitKeyIndex.load(VisitQueryUtils(), "cdm", cache_dir=str(tmp_path))
+    reused = VisitKeyIndex.load(VisitQueryUtils(), "cdm", cache_dir=str(tmp_path))
+    assert calls == ["visits", "visits"]
+    assert reused.probe(pd.Series(["v1"])).tolist() == [11]
+
+
+def test_generate_map_harvests_null_concepts_in_one_query(monkeypatch, tmp_path):
+    from scripts.loaders.query_utils import QueryUtils
+    from scripts.usagi.main import MapCodeGen
+
+    queries = []
+
+    def fake_fetch_query(self, query):
+        queries.append(query)
+        if "information_schema" in query:
+            return pd.DataFrame(
+                {
+                    "table_name": ["condition_occurrence"] * 4 + ["person"],
+                    "column_name": [
+                        "condition_concept_id",
+                        "condition_type_concept_id",
+                        "condition_source_value",
+                        "condition_source_concept_id",
+                        "gender_concept_id",
+                    ],
+                    "data_type": ["integer", "integer", "character varying", "integer", "integer"],
+                }
+            )
+        return pd.DataFrame(
+            {
+                "concept_id": [0, 0],
+                "source_value": ["c1", "M"],
+                "source_id": [12.0, None],
+                "table_name": ["condition_occurrence", "person"],
+                "field_type": ["condition_concept_id", "gender_concept_id"],
+                "frequency": [5.0, 2.0],
+                "first_ord": [0, 2],
+            }
+        )
+
+    monkeypatch.setattr(QueryUtils, "fetch_query", fake_fetch_query)
+    generator = MapCodeGen(None, ["condition_occurrence", "person"], str(tmp_path), "cdm", "vocab")
+    mapping = generator.generate_map()
+    assert len(queries) == 2
+    harvest = queries[1]
+    # race and ethnicity are not in the schema, so three of the five fields are harvested.
+    assert harvest.count("UNION ALL") == 2
+    assert "WHERE condition_type_concept_id = 0" in harvest
+    assert "WHERE race_concept_id = 0" not in harvest
+    assert "COUNT(*) AS frequency" in harvest
+    assert "MIN(ord) AS first_ord" in harvest
+    assert mapping["source_id"].tolist() == [12, 0]
+    assert mapping["frequency"].tolist() == [5, 2]
+
+
+def test_save_usagi_keeps_only_new_pairs(monkeypatch, tmp_path):
+    from scripts.loaders.query_utils import QueryUtils
+    from scripts.usagi.main import MapCodeGen
+
+    pd.DataFrame(
+        {
+            "source_concept_id": [1, 1, 2, None, 3],
+            "source_code_description": ["Fever", "Cough", "FEVER", "Fever", "Rash"],
+            "target_concept_id": [10, 11, 12, 13, 14],
+        }
+    ).to_csv(tmp_path / "usagi_result.csv", index=False)
+    queries = []
+
+    def fake_fetch_query(self, query):
+        queries.append(query)
+        return pd.DataFrame({"source_concept_id": [1, 3], "source_code_description": ["fever", None]})
+
+    monkeypatch.setattr(QueryUtils, "fetch_query", fake_fetch_query)
+    generator = MapCodeGen(None, [], str(tmp_path), "cdm", "vocab")
+    new_rows = generator.save_usagi(file_name="usagi_result.csv")
+    assert "SELECT *" not in queries[0]
+    assert new_rows["target_concept_id"].tolist() == [11, 12, 13, 14]
+
+
+def test_push_usagi_upserts_through_staging(monkeypatch, tmp_path):
+    from scripts.loaders.query_utils import QueryUtils
+    from scripts.usagi.main import MapCodeGen
+
+    statements = []
+    staged = []
+
+    def fake_execute_sql(self, query):
+        statements.append(query)
+        return 0
+
+    def fake_fetch_query(self, query):
+        statements.append(query)
+        if "pg_indexes" in query:
+            return pd.DataFrame({"index_count": [0]})
+        if "duplicate_keys" in query:
+            return pd.DataFrame({"duplicate_keys": [0]})
+        return pd.DataFrame({"inserted": [True, False], "row_count": [2, 1]})
+
+    def fake_table_columns(self, table):
+        return pd.DataFrame(
+            {
+                "column_name": ["source_code", "source_vocabulary_id", "target_concept_id", "valid_end_date", "invalid_reason"],
+                "data_type": ["character varying", "character varying", "integer", "date", "character varying"],
+            }
+        )
+
+    class StagingLoader:
+        async def bulk_load_data(self, batch_size, data, table_name):
+            staged.append((table_name, len(data)))
+
+    connector = FakeConnector()
+    connector._db_loader = StagingLoader()
+    monkeypatch.setattr(QueryUtils, "execute_sql", fake_execute_sql)
+    monkeypatch.setattr(QueryUtils, "fetch_query", fake_fetch_query)
+    monkeypatch.setattr(QueryUtils, "retrieve_table_columns", fake_table_columns)
+    generator = MapCodeGen(None, [], str(tmp_path), "cdm", "vocab")
+    data = pd.DataFrame(
+        {
+            "source_code": ["a", "b", "c"],
+            "source_vocabulary_id": ["V", "V", "V"],
+            "target_concept_id": [1, 2, 3],
+            "valid_end_date": ["2099-12-31"] * 3,
+            "invalid_reason": [None, None, "U"],
+        }
+    )
+    generator.push_usagi(connector, data, "source_to_concept_map", mode="upsert")
+    # the existing rows are checked for duplicate keys before the index is created.
+    assert "HAVING COUNT(*) > 1" in statements[1]
+    assert statements[2].startswith("CREATE UNIQUE INDEX IF NOT EXISTS")
+    assert staged and staged[0][0].startswith("stg_source_to_concept_map_")
+    upsert = next(statement for statement in statements if "ON CONFLICT" in statement)
+    assert "ON CONFLICT (source_code, source_vocabulary_id, target_concept_id, valid_end_date) DO UPDATE" in upsert
+    assert statements[-1].startswith("DROP TABLE IF EXISTS")
+
+
+def test_push_usagi_reports_duplicate_conflict_keys(monkeypatch, tmp_path, caplog):
+    from scripts.loaders.query_utils import QueryUtils
+    from scripts.usagi.main import MapCodeGen
+
+    statements = []
+    staged = []
+
+    def fake_execute_sql(self, query):
+        statements.append(query)
+        return 0
+
+    def fake_fetch_query(self, query):
+        statements.append(query)
+        if "pg_indexes" in query:
+            return pd.DataFrame({"index_count": [0]})
+        return pd.DataFrame({"duplicate_keys": [3]})
+
+    class StagingLoader:
+        async def bulk_load_data(self, batch_size, data, table_name):
+            staged.append(table_name)
+
+    connector = FakeConnector()
+    connector._db_loader = StagingLoader()
+    monkeypatch.setattr(QueryUtils, "execute_sql", fake_execute_sql)
+    monkeypatch.setattr(QueryUtils, "fetch_query", fake_fetch_query)
+    monkeypatch.setattr(QueryUtils, "retrieve_table_columns", lambda self, table: pd.DataFrame({"column_name": ["source_code"]}))
+    generator = MapCodeGen(None, [], str(tmp_path), "cdm", "vocab")
+    data = pd.DataFrame({"source_code": ["a"], "source_vocabulary_id": ["V"], "target_concept_id": [1], "valid_end_date": ["2099-12-31"]})
+    with caplog.at_level("ERROR"):
+        generator.push_usagi(connector, data, "source_to_concept_map", mode="upsert")
+    # neither the index nor the staging table is created.
+    assert not any("CREATE" in statement for statement in statements)
+    assert not staged
+    assert "3 keys (source_code, source_vocabulary_id, target_concept_id, valid_end_date)" in caplog.text
+    assert "DELETE FROM cdm.source_to_concept_map AS t USING" in caplog.text
+
+
+def test_apply_usagi_updates_zero_concepts_in_key_batches(monkeypatch, tmp_path):
+    from scripts.loaders.query_utils import QueryUtils
+    from scripts.usagi.main import MapCodeGen
+
+    updates = []
+
+    def fake_table_columns(self, table):
+        return pd.DataFrame(
+            {
+                "column_name": ["condition_occurrence_id", "condition_concept_id", "condition_type_concept_id", "condition_source_value"],
+                "data_type": ["integer", "integer", "integer", "character varying"],
+            }
+        )
+
+    def fake_batches(self, table, concept_column, key, batch_size):
+        return [5, 900]
+
+    def fake_execute_sql(self, query):
+        updates.append(query)
+        return 3
+
+    monkeypatch.setattr(QueryUtils, "retrieve_table_columns", fake_table_columns)
+    monkeypatch.setattr(QueryUtils, "retrieve_zero_concept_batches", fake_batches)
+    monkeypatch.setattr(QueryUtils, "execute_sql", fake_execute_sql)
+    generator = MapCodeGen(None, ["condition_occurrence"], str(tmp_path), "cdm", "vocab")
+    assert generator.apply_usagi(batch_size=2) == {"condition_occurrence": 6}
+    # one statement per batch, only for the condition concept (type concepts are skipped).
+    assert len(updates) == 2
+    assert "SET condition_concept_id = m.target_concept_id" in updates[0]
+    assert "t.condition_occurrence_id >= 5 AND t.condition_occurrence_id < 900" in updates[0]
+    assert "t.condition_occurrence_id >= 900\n" in updates[1]
+    # only targets in the condition domain may fill the condition concept.
+    assert "JOIN vocab.concept AS c ON c.concept_id = m.target_concept_id" in updates[0]
+    assert "AND c.domain_id IN ('Condition')" in updates[0]
+    assert "DISTINCT ON (m.source_code)" in updates[0]
+
+
+def test_retrieve_concept_id_consults_source_to_concept_map(monkeypatch):
+    from scripts.loaders.query_utils import QueryUtils
+
+    stcm_queries = []
+    vocabulary_queries = []
+
+    def fake_fetch_query(self, query):
+        stcm_queries.append(query)
+        return pd.DataFrame(
+            {
+                "source_code": ["b", "d", "c", "b"],
+                "domain_id": ["Condition", "Condition", "Drug", "Drug"],
+                "target_concept_id": [20, 40, 30, 99],
+            }
+        )
+
+    def fake_run_query(self, query):
+        vocabulary_queries.append(query)
+        return {"a": 10} if "'a'" in query else {}
+
+    monkeypatch.setattr(QueryUtils, "fetch_query", fake_fetch_query)
+    monkeypatch.setattr(QueryUtils, "run_query", fake_run_query)
+    monkeypatch.setattr(QueryUtils, "_stcm_index", {})
+    monkeypatch.setattr(QueryUtils, "stcm_hits", 0)
+    monkeypatch.setattr(QueryUtils, "stcm_misses", 0)
+    query_utils = QueryUtils(None, "cdm", "condition_occurrence", None)
+
+    after = query_utils.retrieve_concept_id(["a", "b", "c"], ("SNOMED",), stcm_lookup="after")
+    assert after == {"a": 10, "b": 20, "c": 0}
+    assert (QueryUtils.stcm_hits, QueryUtils.stcm_misses) == (1, 1)
+
+    vocabulary_queries.clear()
+    before = query_utils.retrieve_concept_id(["b", "d"], ("SNOMED",), stcm_lookup="before")
+    assert before == {"b": 20, "d": 40}
+    # every code was resolved locally, so the vocabulary was not queried.
+    assert vocabulary_queries == []
+    # the index was loaded once for both lookups.
+    assert len(stcm_queries) == 1
+
+    # another table only takes the targets of its own domain.
+    drug_utils = QueryUtils(None, "cdm", "drug_exposure", None)
+    assert drug_utils.retrieve_concept_id(["b", "c", "d"], ("RxNorm",), stcm_lookup="before") == {"b": 99, "c": 30, "d": 0}
+    # a table without a known domain does not use the local mappings.
+    care_utils = QueryUtils(None, "cdm", "care_site", None)
+    assert care_utils.resolve_with_stcm(["b", "c"]) == {}
+    assert len(stcm_queries) == 1
+
+
+def test_null_concept_partials_merge_like_one_query():
+    from scripts.loaders.query_utils import QueryUtils
+
+    rows = pd.DataFrame(
+        {
+            "ord": [0, 0, 1, 2, 2, 2, 3],
+            "table_name": ["condition_occurrence"] * 2 + ["condition_occurrence"] + ["person"] * 3 + ["drug_exposure"],
+            "field_type": ["c", "c", "ct", "g", "g", "g", "d"],
+            "concept_id": [0] * 7,
+            "source_value": ["x", "y", "y", "M", "x", "F", None],
+            "source_id": [1, 2, 2, 0, 1, 0, 0],
+        }
+    )
+
+    def aggregate(part):
+        # what the harvesting query returns for some of the fields.
+        ordered = part.sort_values("ord", kind="stable")
+        return ordered.groupby(["source_value", "source_id"], dropna=False, sort=False).agg(
+            concept_id=("concept_id", "first"),
+            table_name=("table_name", "first"),
+            field_type=("field_type", "first"),
+            frequency=("ord", "size"),
+            first_ord=("ord", "min"),
+        ).reset_index()
+
+    whole = QueryUtils.merge_null_concept_frequencies([aggregate(rows)])
+    per_table = QueryUtils.merge_null_concept_frequencies(
+        [aggregate(part) for _, part in rows.groupby("table_name", sort=False)][::-1]
+    )
+    pd.testing.assert_frame_equal(whole, per_table)
+    assert whole["source_value"].tolist()[:2] == ["x", "y"]
+    assert whole["frequency"].tolist() == [2, 2, 1, 1, 1]
+    assert whole["table_name"].tolist()[1] == "condition_occurrence"
+
+
+class FakeCopyCursor:
+    def __init__(self, chunks, statements):
+        self._chunks = chunks
+        self._statements = statements
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, params=None):
+        self._statements.append(query)
+
+    def fetchall(self):
+        return [("person_id", "integer"), ("year_of_birth", "integer")]
+
+    def copy(self, statement):
+        self._statements.append(statement)
+        return self
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+
+class FakeNativeConnection:
+    def __init__(self, chunks, statements):
+        self._cursor = FakeCopyCursor(chunks, statements)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def cursor(self):
+        return self._cursor
+
+
+def test_csv_gen_streams_tables_with_copy(tmp_path):
+    from scripts.csv_gen.main import CSVGen
+
+    statements = []
+    chunks = [b"PERSON_ID,YEAR_OF_BIRTH\n", b"1,1980\n2,", b"1990\n"]
+    generator = CSVGen(
+        None, ["person", ""], str(tmp_path), "cdm",
+        native_connect=lambda: FakeNativeConnection(chunks, statements),
+    )
+    generator.generate_csv()
+    assert (tmp_path / "person.csv").read_text() == "PERSON_ID,YEAR_OF_BIRTH\n1,1980\n2,1990\n"
+    assert statements[-1].startswith('COPY (SELECT "person_id" AS "PERSON_ID", "year_of_birth" AS "YEAR_OF_BIRTH" FROM cdm.person) TO STDOUT')
+    assert not (tmp_path / "person.csv.tmp").exists()
+
+
+class FakeNamedCursorConnection:
+    def __init__(self, columns, rows):
+        self._columns = columns
+        self._rows = list(rows)
+        self.named = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def cursor(self, name=None):
+        if name is not None:
+            self.named.append(name)
+        return self
+
+    def execute(self, query, params=None):
+        self.query = query
+
+    def fetchall(self):
+        return self._columns
+
+    def fetchmany(self, size):
+        batch, self._rows = self._rows[:size], self._rows[size:]
+        return batch
+
+
+def test_csv_gen_exports_partitioned_parquet(tmp_path):
+    import datetime
+    import pyarrow.parquet as pq
+    from scripts.csv_gen.main import CSVGen
+
+    columns = [("measurement_id", "bigint"), ("person_id", "integer"),
+               ("measurement_date", "date"), ("value_as_number", "numeric")]
+    rows = [(i, i % 3, datetime.date(2000 + i % 2, 1, 1), i / 2) for i in range(10)]
+    connection = FakeNamedCursorConnection(columns, rows)
+    generator = CSVGen(
+        None, ["measurement"], str(tmp_path), "cdm", native_connect=lambda: connection,
+        export_format="parquet", partition_by="year", batch_rows=4, row_group_rows=3,
+    )
+    generator.generate_csv()
+
+    assert connection.named == ["export_measurement"]
+    assert '"value_as_number"::double precision' in connection.query
+    years = sorted(path.name for path in (tmp_path / "measurement").iterdir())
+    assert years == ["year=2000", "year=2001"]
+    part = pq.ParquetFile(tmp_path / "measurement" / "year=2000" / "part-0.parquet")
+    assert [part.metadata.row_group(i).num_rows for i in range(part.num_row_groups)] == [3, 2]
+    exported = pq.read_table(tmp_path / "measurement").to_pandas().sort_values("measurement_id")
+    assert exported["measurement_id"].tolist() == list(range(10))
+    assert exported["value_as_number"].tolist() == [i / 2 for i in range(10)]
+    assert not (tmp_path / "measurement.tmp").exists()
+
+
+class FakeRangeConnection:
+    """Native connection serving person rows 1..10 to range COPY statements."""
+
+    def __init__(self, statements):
+        self._statements = statements
+        self._result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        self._statements.append(query)
+        if "pg_export_snapshot" in query:
+            self._result = [("00000003-0000001B-1",)]
+        elif "reltuples" in query:
+            self._result = [(10,)]
+        elif "MIN(" in query:
+            self._result = [(1, 10)]
+        else:
+            self._result = [("person_id", "integer"), ("year_of_birth", "integer")]
+        return self
+
+    def fetchone(self):
+        return self._result[0]
+
+    def fetchall(self):
+        return self._result
+
+    def copy(self, statement):
+        self._statements.append(statement)
+        start, stop = (int(value) for value in re.search(r'>= (\d+) AND "person_id" < (\d+)', statement).groups())
+        chunks = [b"PERSON_ID,YEAR_OF_BIRTH\n"] if "HEADER true" in statement else []
+        chunks += [f"{i},{1970 + i}\n".encode() for i in range(start, stop)]
+        return FakeCopyCursor(chunks, self._statements)
+
+
+def test_csv_gen_parallel_export_stitches_ranges_in_order(tmp_path):
+    from scripts.csv_gen.main import CSVGen
+
+    statements = []
+    generator = CSVGen(
+        None, ["person"], str(tmp_path), "cdm",
+        native_connect=lambda: FakeRangeConnection(statements), workers=3, split_rows=4,
+    )
+    generator.generate_csv()
+
+    expected = "PERSON_ID,YEAR_OF_BIRTH\n" + "".join(f"{i},{1970 + i}\n" for i in range(1, 11))
+    assert (tmp_path / "person.csv").read_text() == expected
+    copies = [statement for statement in statements if statement.startswith("COPY")]
+    assert len(copies) == 3
+    assert statements.count("SET TRANSACTION SNAPSHOT '00000003-0000001B-1'") == 3
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["person.csv"]
+
+
+class FakeDeltaConnection(FakeRangeConnection):
+    """Native connection serving (person id, writing transaction) ``rows`` below a transaction ``horizon``."""
+
+    def __init__(self, statements, rows, horizon):
+        super().__init__(statements)
+        self._rows = rows
+        self._horizon = horizon
+
+    def execute(self, query, params=None):
+        if "pg_current_snapshot" in query:
+            self._statements.append(query)
+            self._result = [(self._horizon[0],)]
+            return self
+        return super().execute(query, params)
+
+    def copy(self, statement):
+        self._statements.append(statement)
+        window = re.search(r"\(xmin::text::bigint - (\d+) \+ (\d+)\) % \d+ < (\d+)", statement)
+        chunks = [b"PERSON_ID,YEAR_OF_BIRTH\n"]
+        for person_id, xid in self._rows:
+            xmin = xid % 2 ** 32
+            if window is None or (xmin - int(window.group(1)) + int(window.group(2))) % 2 ** 32 < int(window.group(3)):
+                chunks.append(f"{person_id},{1970 + person_id % 50}\n".encode())
+        return FakeCopyCursor(chunks, self._statements)
+
+
+def test_csv_gen_incremental_export_writes_deltas_and_manifest(tmp_path):
+    import json
+    from scripts.csv_gen.main import CSVGen
+
+    # hashed ids do not grow with the inserts; the transactions writing them do.
+    statements, rows, horizon = [], [(912345, 100), (17, 4294967000), (503, 4294967200)], [4294967290]
+
+    def export():
+        generator = CSVGen(
+            None, ["person"], str(tmp_path), "cdm", mode="incremental",
+            native_connect=lambda: FakeDeltaConnection(statements, rows, horizon),
+        )
+        return json.loads(open(generator._export_incremental(["person"])).read())
+
+    first = export()
+    assert first["tables"][0]["mode"] == "full"
+    assert (tmp_path / first["tables"][0]["file"]).read_text().count("\n") == 4
+    # new rows with smaller ids, written by transactions whose xmin wrapped around.
+    rows.extend([(3, 4294967295), (8, 2 ** 32 + 3)])
+    horizon[0] = 2 ** 32 + 10
+    second = export()
+    entry = second["tables"][0]
+    assert (entry["mode"], entry["key"], entry["from"], entry["until"]) == ("delta", "xmin", 4294967290, 2 ** 32 + 10)
+    assert (tmp_path / entry["file"]).read_text() == "PERSON_ID,YEAR_OF_BIRTH\n3,1973\n8,1978\n"
+    state = json.loads((tmp_path / "export_state.json").read_text())
+    assert state["tables"]["cdm.person"]["mark"] == 2 ** 32 + 10
+    assert export()["tables"][0]["file"] is None
+    # a mark ahead of the horizon (a restored database) exports the table in full again.
+    horizon[0] = 50
+    assert export()["tables"][0]["mode"] == "full"
+
+
+def test_shard_assignment_is_deterministic():
+    patients = pd.Series([f"patient-{i}" for i in range(200)])
+    first = shard_of(patients, 4)
+    assert (first == shard_of(patients, 4)).all()
+    # the shard of a patient does not depend on the other values of the chunk.
+    assert (shard_of(patients.iloc[::-1].reset_index(drop=True), 4) == first[::-1]).all()
+    assert set(first) == {0, 1, 2, 3}
+
+
+def test_partition_file_keeps_every_row_in_exactly_one_shard(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    patients = pd.DataFrame({"Id": [f"p{i}" for i in range(50)], "GENDER": ["F", "M"] * 25})
+    conditions = pd.DataFrame({"PATIENT": [f"p{i % 50}" for i in range(170)], "CODE": [str(i) for i in range(170)]})
+    patients.to_csv(source / "patients.csv", index=False)
+    conditions.to_csv(source / "conditions.csv", index=False)
+    shard_dirs = [str(tmp_path / f"shard_{index}") for index in range(3)]
+    for shard_dir in shard_dirs:
+        (tmp_path / shard_dir).mkdir()
+    for name in ("patients.csv", "conditions.csv"):
+        partition_file(str(source / name), shard_dirs, chunk_size=40)
+
+    shard_patients = [pd.read_csv(f"{shard_dir}/patients.csv", dtype=str) for shard_dir in shard_dirs]
+    shard_conditions = [pd.read_csv(f"{shard_dir}/conditions.csv", dtype=str) for shard_dir in shard_dirs]
+    merged = pd.concat(shard_conditions, ignore_index=True).sort_values("CODE", key=lambda codes: codes.astype(int))
+    assert merged.reset_index(drop=True).equals(conditions.astype(str))
+    assert sorted(pd.concat(shard_patients)["Id"]) == sorted(patients["Id"])
+    for part_patients, part_conditions in zip(shard_patients, shard_conditions):
+        # every condition lands in the shard of its patient.
+        assert set(part_conditions["PATIENT"]) <= set(part_patients["Id"])
+
+
+def test_staging_merge_sql_resolves_ids_and_skips_existing_keys():
+    from scripts.loaders.staging import StagingMerge
+
+    merge = StagingMerge(None, None, "cdm")
+    target = ["condition_occurrence_id", "person_id", "condition_concept_id", "visit_occurrence_id", "provider_id"]
+    query = merge.build_merge_sql(
+        "stg_condition_occurrence_1", "condition_occurrence", "condition_occurrence_id",
+        ["condition_occurrence_id", "person_source_value", "condition_concept_id", "visit_source_value"],
+        target,
+    )
+    assert "INSERT INTO cdm.condition_occurrence (condition_occurrence_id, person_id, condition_concept_id, visit_occurrence_id)" in query
+    assert "SELECT DISTINCT ON (s.condition_occurrence_id) s.condition_occurrence_id, r0.person_id, s.condition_concept_id, r1.visit_occurrence_id" in query
+    # person_id is required, the visit is optional and the provider is not staged.
+    assert "JOIN cdm.person AS r0 ON r0.person_source_value = s.person_source_value" in query
+    assert "LEFT JOIN cdm.visit_occurrence AS r1 ON r1.visit_source_value = s.visit_source_value" in query
+    assert "LEFT JOIN cdm.person" not in query and "cdm.provider" not in query
+    assert "SELECT 1 FROM cdm.condition_occurrence AS t WHERE t.condition_occurrence_id = s.condition_occurrence_id" in query
+    assert "RETURNING person_id" in query
+
+    plain = merge.build_merge_sql(
+        "stg_location_1", "location", "location_id",
+        ["location_id", "city", "location_source_value"], ["location_id", "city", "zip"], required=(),
+    )
+    assert "INSERT INTO cdm.location (location_id, city)" in plain
+    assert "SELECT DISTINCT ON (s.location_id) s.location_id, s.city" in plain
+    assert "JOIN" not in plain
+    assert "WHERE NOT EXISTS (" in plain and "t.location_id = s.location_id" in plain
+    assert "RETURNING location_id" in plain and "GROUP BY location_id" in plain
+
+
+class FakeSourceETL:
+    def __init__(self, file_path, table_name, fields_map, watermark=None):
+        self._data = pd.DataFrame({"condition_occurrence_id": [1, 2, 3], "person_id": [1, 1, 2]})
+
+    def run_mapping(self, fields=None):
+        pass
+
+    def get_omopped_data(self):
+        return self._data
+
+    def get_watermark(self):
+        return {"rows": 3}
+
+
+class FakeRecordingLoader:
+    loads = []
+
+    def __init__(self, connector, data, table, manifest=None, manifest_key=None, affected_persons=None):
+        self._data = data
+        self.rows_loaded = 0
+
+    def load_data(self):
+        FakeRecordingLoader.loads.append(len(self._data))
+        self.rows_loaded = len(self._data)
+
+
+def _pipeline(monkeypatch, tmp_path, **env):
+    import mappers.main_mapper as main_mapper
+
+    monkeypatch.setattr(main_mapper, "ConnectToDatabase", lambda **kwargs: FakeConnector())
+    monkeypatch.setattr(main_mapper.time, "sleep", lambda seconds: None)
+    monkeypatch.setenv("FILE_PATH", str(tmp_path))
+    monkeypatch.setenv("RUN_MANIFEST", str(tmp_path / "run_manifest.json"))
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    (tmp_path / "conditions.csv").write_text("PATIENT\np1\n")
+    return main_mapper.BaseETLPipeline()
+
+
+def test_spill_only_entries_are_completed_by_replay(monkeypatch, tmp_path):
+    mapping = {"condition_occurrence_": (FakeSourceETL, FakeRecordingLoader, {})}
+    files = {"condition_occurrence_": ["conditions.csv"]}
+    FakeRecordingLoader.loads = []
+    pipeline = _pipeline(monkeypatch, tmp_path, SPILL_DIR=str(tmp_path / "spill"), SPILL_ONLY="true")
+    pipeline.process_file("condition_occurrence_", files["condition_occurrence_"], mapping)
+    assert FakeRecordingLoader.loads == []
+    record = pipeline.manifest.get_table("condition_occurrence_")
+    assert record["status"] == "running" and not record.get("watermark")
+
+    # a shard of a sharded spill-only run spills the same entry to its own directory.
+    pipeline.spill.shard(1).write("condition_occurrence_", "condition_occurrence", pd.DataFrame({"condition_occurrence_id": [4]}))
+    monkeypatch.setattr(pipeline, "run_post_load", lambda: None)
+    pipeline.replay(mapping, files)
+    assert FakeRecordingLoader.loads == [3, 1]
+    record = RunManifest(str(tmp_path / "run_manifest.json")).get_table("condition_occurrence_")
+    assert record["status"] == "complete" and record["watermark"] == {"rows": 3}
+
+
+def test_shards_spill_to_their_own_directories(tmp_path):
+    spill = ParquetSpill(str(tmp_path))
+    for index in range(2):
+        spill.shard(index).write("person_", "person", pd.DataFrame({"person_id": [index]}))
+    assert [shard.read("person_")["person_id"].tolist() for shard in spill.shards()] == [[0], [1]]
+    assert not spill.has("person_")
+    spill.clear_shards()
+    assert spill.shards() == []
+
+
+def test_resumed_run_builds_derived_tables_of_an_interrupted_run(monkeypatch, tmp_path):
+    import mappers.main_mapper as main_mapper
+
+    mapping = {"condition_occurrence_": (FakeSourceETL, FakeRecordingLoader, {})}
+    files = {"condition_occurrence_": ["conditions.csv"]}
+    FakeRecordingLoader.loads = []
+    pipeline = _pipeline(monkeypatch, tmp_path, INCREMENTAL="true")
+    pipeline.process_file("condition_occurrence_", files["condition_occurrence_"], mapping)
+    # the run crashes here, after the entry is complete but before the post-load stage.
+    assert pipeline.manifest.derived_pending() == ["condition_occurrence"]
+
+    builds = []
+
+    def failing_build(connector, name, affected_persons=None):
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(main_mapper, "build_derived", failing_build)
+    resumed = main_mapper.BaseETLPipeline()
+    resumed.process_file("condition_occurrence_", files["condition_occurrence_"], mapping)
+    assert FakeRecordingLoader.loads == [3]
+    resumed.run_post_load()
+    assert resumed.manifest.derived_pending() == ["condition_occurrence"]
+
+    monkeypatch.setattr(main_mapper, "build_derived", lambda connector, name, persons=None: builds.append((name, persons)))
+    resumed = main_mapper.BaseETLPipeline()
+    resumed.run_post_load()
+    # the persons of the interrupted run are unknown, so the eras are built for everyone.
+    assert builds == [("condition_era", None)]
+    assert RunManifest(str(tmp_path / "run_manifest.json")).derived_pending() == []